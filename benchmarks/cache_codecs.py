@@ -0,0 +1,60 @@
+import scryfall_api
+import cache_codec
+import argparse
+import tempfile
+import mtg_api
+import sys
+
+from benchmarks.timing import time_call, measure_peak_memory, format_table
+from pathlib import Path
+from typing import Any, Callable
+
+CACHE_CODECS_CORPORA: dict[str, Callable[[], Any]] = {
+    "scryfall": scryfall_api.load_scryfall_cards_from_pickle,
+    "mtg": mtg_api.load_all_mtg_cards_from_pickle,
+}
+CACHE_CODECS_DEFAULT = ("pickle", "marshal", "jsonl",
+                        "pickle+gzip:1", "pickle+gzip:6", "pickle+gzip:9",
+                        "pickle+lzma:0", "pickle+lzma:6", "pickle+bz2:9",
+                        "marshal+gzip:6", "jsonl+gzip:6", "jsonl+lzma:6")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare cache codecs on the cached card corpora.")
+    parser.add_argument("--corpus", choices=CACHE_CODECS_CORPORA, default="scryfall")
+    parser.add_argument("--codecs", nargs="+", default=CACHE_CODECS_DEFAULT,
+                        help="format[+compression[:level]], e.g. pickle+gzip:6")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    records: list = list(CACHE_CODECS_CORPORA[args.corpus]())
+    codecs: list[cache_codec.CacheCodec] = [cache_codec.parse_cache_codec(name) for name in args.codecs]
+    print(run_benchmark(records, codecs, args.repeat))
+
+
+def count_records(path: Path) -> int:
+    # Reads the whole cache without keeping the records, like the jobs do.
+    return sum(1 for _ in cache_codec.load_records(path))
+
+
+def run_benchmark(records: list, codecs: list[cache_codec.CacheCodec], repeat: int = 1) -> str:
+    rows: list[list] = []
+    baseline_size: int = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for codec in codecs:
+            path: Path = Path(directory) / 'cards.cache'
+            write_seconds, _ = time_call(cache_codec.dump_records, path, records, codec, repeat=repeat)
+            read_seconds, count = time_call(count_records, path, repeat=repeat)
+            if count != len(records):
+                raise ValueError(f"{codec} read back {count} records, expected {len(records)}")
+            write_peak, _ = measure_peak_memory(cache_codec.dump_records, path, records, codec)
+            read_peak, _ = measure_peak_memory(count_records, path)
+            size: int = path.stat().st_size
+            baseline_size = baseline_size or size
+            rows.append([str(codec), f"{write_seconds:.2f}", f"{read_seconds:.2f}", f"{size / 1e6:.1f}",
+                         f"{size / baseline_size:.2f}", f"{write_peak / 1e6:.1f}", f"{read_peak / 1e6:.1f}"])
+    return format_table(["codec", "write s", "read s", "size MB", "size ratio", "write peak MB", "read peak MB"],
+                        rows)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import column_extractors
+import scryfall_api
+import card_records
+import argparse
+import mtg_api
+import sys
+
+from benchmarks.timing import time_calls_interleaved, format_table
+from collections import OrderedDict
+from database import scryfall_to_google_api, mtg_to_google_api
+from typing import Any, Callable, Iterable, NamedTuple
+
+
+class DedupSource(NamedTuple):
+    load_cards: Callable[[], Any]
+    name_attr: str
+    image_attr: str
+    derived_columns: dict[str, column_extractors.Extractor]
+    policy: card_records.PrintingPolicy
+    columns: tuple[str, ...]
+
+
+CARD_DEDUP_SOURCES: dict[str, DedupSource] = {
+    "scryfall": DedupSource(scryfall_api.load_all_scryfall_cards, "name", "image_uris",
+                            scryfall_to_google_api.SCRYFALL_DERIVED_COLUMNS,
+                            scryfall_to_google_api.SCRYFALL_PRINTING_POLICY,
+                            ("id", "name", "set", "collector_number", "rarity", "type_line", "image_uris")),
+    "mtg": DedupSource(mtg_api.load_all_mtg_cards, "name", "imageUrl",
+                       mtg_to_google_api.MTG_DERIVED_COLUMNS,
+                       mtg_to_google_api.MTG_PRINTING_POLICY,
+                       ("id", "name", "set", "number", "types", "imageUrl")),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the sorting and single-pass card dedup.")
+    parser.add_argument("--source", choices=CARD_DEDUP_SOURCES, default="scryfall")
+    parser.add_argument("--columns", nargs="+")
+    parser.add_argument("--repeat", type=int, default=9)
+    args = parser.parse_args()
+    source: DedupSource = CARD_DEDUP_SOURCES[args.source]
+    print(run_benchmark(list(source.load_cards()), source, args.columns or list(source.columns), args.repeat))
+
+
+def build_rows_sorted(cards: list[dict], source: DedupSource, columns: list[str]) -> list[list]:
+    # What the database jobs did before: sort every printing by name, keep
+    # the last one with images per name, copy the survivors and build their
+    # rows.
+    cards_by_name: OrderedDict[str, dict] = OrderedDict()
+    for card in sorted(cards, key=lambda card_: card_[source.name_attr]):
+        if card[source.name_attr] not in cards_by_name or card.get(source.image_attr) is not None:
+            cards_by_name[card[source.name_attr]] = card
+    extractors: tuple[column_extractors.Extractor, ...] = column_extractors.compile_column_extractors(
+        columns, source.derived_columns)
+    return [[extractor(card) for extractor in extractors]
+            for card in [dict(card_.items()) for card_ in cards_by_name.values()]]
+
+
+def build_rows_single_pass(cards: Iterable[dict], source: DedupSource, columns: list[str]) -> list[list]:
+    extractors: tuple[column_extractors.Extractor, ...] = column_extractors.compile_column_extractors(
+        columns, source.derived_columns)
+    return [list(card.values) for card in
+            card_records.collect_card_records(cards, extractors, source.name_attr, source.policy)]
+
+
+def run_benchmark(cards: list[dict], source: DedupSource, columns: list[str], repeat: int = 1) -> str:
+    # The jobs hand over the MTG cards as a list and stream the Scryfall cards
+    # from their cache, which takes the other path of collect_card_records.
+    timings: dict[str, tuple[float, list[list]]] = time_calls_interleaved({
+        "sort + OrderedDict": lambda: build_rows_sorted(cards, source, columns),
+        "single pass": lambda: build_rows_single_pass(cards, source, columns),
+        "single pass, streamed": lambda: build_rows_single_pass(iter(cards), source, columns),
+    }, repeat)
+    baseline_seconds, baseline_rows = timings["sort + OrderedDict"]
+    table: list[list] = []
+    for name, (seconds, rows) in timings.items():
+        if rows != baseline_rows:
+            raise ValueError(f"Dedup '{name}' kept different printings than the sorting dedup")
+        table.append([name, len(cards), len(rows), len(columns), f"{seconds:.3f}", f"{baseline_seconds / seconds:.2f}"])
+    return format_table(["dedup", "printings", "unique", "columns", "median seconds", "speedup"], table)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
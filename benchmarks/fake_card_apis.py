@@ -0,0 +1,285 @@
+import scryfall_api
+import threading
+import mtg_api
+import shutil
+import random
+import json
+import uuid
+import re
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prices import scryfall_prices
+from pathlib import Path
+from typing import Any, Iterator, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+FAKE_CARD_API_SETS = ('ltr', 'neo', 'dmu', 'bro', 'one', 'mom', 'woe', 'lci', 'mkm', 'otj')
+FAKE_CARD_API_RARITIES = ('common', 'uncommon', 'rare', 'mythic')
+FAKE_CARD_API_TYPE_LINES = ('Creature — Elf Druid', 'Legendary Creature — Human Wizard', 'Instant',
+                            'Sorcery', 'Artifact — Equipment', 'Enchantment — Aura', 'Basic Land — Forest')
+FAKE_CARD_API_ORACLE_TEXT = ("When this creature enters the battlefield, draw a card, then discard a card.\n"
+                             "{T}: Add one mana of any color. Activate only as a sorcery.")
+FAKE_CARD_API_PRINTINGS_PER_NAME = 4
+FAKE_CARD_API_UPDATED_AT = '2024-01-01T09:00:00.000+00:00'
+FAKE_CARD_API_MTG_PAGE_SIZE = 100
+
+# Module constants holding the URLs of the real APIs; point_clients_at()
+# moves them onto the local server, keeping their paths and queries.
+FAKE_CARD_API_ENDPOINTS = (
+    (scryfall_api, 'SCRYFALL_API_ENDPOINT_BULK_DATA'),
+    (scryfall_prices, 'SCRYFALL_API_ENDPOINT_CARD_SEARCH'),
+    (scryfall_prices, 'SCRYFALL_API_ENDPOINT_CARD_BY_PRINTING'),
+    (scryfall_prices, 'SCRYFALL_API_ENDPOINT_CARD_COLLECTION'),
+    (mtg_api, 'MTG_API_ENDPOINT_CARDS'),
+)
+
+FAKE_CARD_API_SEARCH_QUERY = re.compile(r'e:(\S+) cn:"([^"]+)" lang:(\S+)')
+
+
+class FakeCardApiServer(ThreadingHTTPServer):
+    # Serves a Scryfall bulk file (synthetic or recorded), card lookups and
+    # searches answered with synthetic cards, and the paged MTG card list.
+    # The hosts of the real APIs are rate limited by http_client but the local
+    # one is not, so runs measure the jobs rather than the throttling. To
+    # exercise the retries, the API endpoints can answer 429 to a random
+    # `throttle_rate` of the requests (with Retry-After) and to every request
+    # beyond `max_in_flight` concurrent ones (without).
+    daemon_threads = True
+
+    def __init__(self, bulk_data_path: Path, mtg_card_count: int, mtg_page_size: int = FAKE_CARD_API_MTG_PAGE_SIZE,
+                 throttle_rate: float = 0.0, max_in_flight: Optional[int] = None, seed: int = 0):
+        super().__init__(('127.0.0.1', 0), FakeCardApiHandler)
+        self.bulk_data_path: Path = bulk_data_path
+        self.mtg_card_count: int = mtg_card_count
+        self.mtg_page_size: int = mtg_page_size
+        self.throttle_rate: float = throttle_rate
+        self.max_in_flight: Optional[int] = max_in_flight
+        self.in_flight: int = 0
+        self.random = random.Random(seed)
+        self.requests: dict[str, int] = {}
+        self.bytes_sent: int = 0
+        self.stats_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count_request(self, endpoint: str, size: int) -> None:
+        with self.stats_lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_sent += size
+
+    def get_stats(self) -> tuple[dict[str, int], int]:
+        with self.stats_lock:
+            return dict(self.requests), self.bytes_sent
+
+    def start_api_request(self) -> Optional[str]:
+        # Returns the Retry-After value of a throttled request ('' for none),
+        # or None when the request may go ahead.
+        with self.stats_lock:
+            if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+                return ''
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                return '1'
+            self.in_flight += 1
+            return None
+
+    def finish_api_request(self) -> None:
+        with self.stats_lock:
+            self.in_flight -= 1
+
+
+class FakeCardApiHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real APIs, so the pooled session is exercised.
+    protocol_version = 'HTTP/1.1'
+    server: FakeCardApiServer
+
+    def do_GET(self) -> None:
+        # Some clients send an (empty) JSON body with their GET requests; it
+        # has to be read for the next request on the connection to parse.
+        self.read_body()
+        url = urlsplit(self.path)
+        if url.path == '/bulk/all-cards.json':
+            self.send_file('scryfall bulk file', self.server.bulk_data_path)
+        elif self.try_start_request():
+            try:
+                self.serve_api_get(url)
+            finally:
+                self.server.finish_api_request()
+
+    def serve_api_get(self, url: Any) -> None:
+        query: dict[str, list[str]] = parse_qs(url.query)
+        parts: list[str] = [unquote(part) for part in url.path.strip('/').split('/')]
+        if url.path == '/bulk-data':
+            self.send_json('scryfall bulk-data', self.make_bulk_data_info())
+        elif url.path == '/cards/search':
+            match: Optional[re.Match] = FAKE_CARD_API_SEARCH_QUERY.search(query.get('q', [''])[0])
+            cards: list[dict] = [] if match is None else [make_scryfall_card_for_printing(*match.groups())]
+            self.send_json('scryfall search', dict(object='list', total_cards=len(cards), data=cards))
+        elif len(parts) == 4 and parts[0] == 'cards':
+            self.send_json('scryfall card', make_scryfall_card_for_printing(*parts[1:]))
+        elif url.path == '/v1/cards':
+            page: int = int(query.get('page', ['1'])[0])
+            self.send_json('mtg cards', dict(cards=self.make_mtg_card_page(page)), {
+                'Total-Count': str(self.server.mtg_card_count), 'Page-Size': str(self.server.mtg_page_size)})
+        else:
+            self.send_json('not found', dict(object='error', status=404), status=404)
+
+    def do_POST(self) -> None:
+        body: dict = json.loads(self.read_body() or b'{}')
+        if not self.try_start_request():
+            return
+        try:
+            self.serve_api_post(body)
+        finally:
+            self.server.finish_api_request()
+
+    def serve_api_post(self, body: dict) -> None:
+        if urlsplit(self.path).path == '/cards/collection':
+            cards: list[dict] = [make_scryfall_card_for_printing(identifier['set'], identifier['collector_number'])
+                                 for identifier in body.get('identifiers', [])]
+            self.send_json('scryfall collection', dict(object='list', not_found=[], data=cards))
+        else:
+            self.send_json('not found', dict(object='error', status=404), status=404)
+
+    def try_start_request(self) -> bool:
+        retry_after: Optional[str] = self.server.start_api_request()
+        if retry_after is None:
+            return True
+        self.send_json('throttled', dict(object='error', status=429),
+                       {'Retry-After': retry_after} if retry_after else None, status=429)
+        return False
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def make_bulk_data_info(self) -> dict:
+        return dict(object='list', data=[dict(
+            type='all_cards', updated_at=FAKE_CARD_API_UPDATED_AT, size=self.server.bulk_data_path.stat().st_size,
+            download_uri=f'{self.server.base_url}/bulk/all-cards.json')])
+
+    def make_mtg_card_page(self, page: int) -> list[dict]:
+        # Like the real API, page 0 is served like page 1.
+        page_size: int = self.server.mtg_page_size
+        start: int = (max(page, 1) - 1) * page_size
+        name_count: int = max(1, self.server.mtg_card_count // FAKE_CARD_API_PRINTINGS_PER_NAME)
+        return [make_mtg_card(index, name_count)
+                for index in range(start, min(start + page_size, self.server.mtg_card_count))]
+
+    def send_json(self, endpoint: str, payload: Any, headers: Optional[dict] = None, status: int = 200) -> None:
+        data: bytes = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count_request(endpoint, len(data))
+
+    def send_file(self, endpoint: str, path: Path) -> None:
+        # Range requests are not supported; the download then starts over,
+        # which the client handles.
+        size: int = path.stat().st_size
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        with path.open(mode='rb') as fp:
+            shutil.copyfileobj(fp, self.wfile)
+        self.server.count_request(endpoint, size)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def point_clients_at(base_url: str) -> None:
+    for module, name in FAKE_CARD_API_ENDPOINTS:
+        url = urlsplit(getattr(module, name))
+        setattr(module, name, base_url + url.path + (f'?{url.query}' if url.query else ''))
+
+
+def make_scryfall_card(index: int, name_count: int) -> dict:
+    # Deterministic synthetic card with the attributes of a real Scryfall
+    # card that the jobs read, and enough text to be of a similar size.
+    card: dict = {
+        "object": "card",
+        "id": str(uuid.UUID(int=index)),
+        "oracle_id": str(uuid.UUID(int=(1 << 64) + index % name_count)),
+        "multiverse_ids": [index + 1],
+        "name": f"Card {index % name_count}",
+        "lang": "en",
+        "released_at": f"{2010 + index % 14}-{1 + index % 12:02}-{1 + index % 28:02}",
+        "layout": "normal",
+        "mana_cost": "{2}{G}",
+        "cmc": 3.0,
+        "type_line": FAKE_CARD_API_TYPE_LINES[index % len(FAKE_CARD_API_TYPE_LINES)],
+        "oracle_text": FAKE_CARD_API_ORACLE_TEXT,
+        "colors": ["G"],
+        "color_identity": ["G"],
+        "set": FAKE_CARD_API_SETS[index % len(FAKE_CARD_API_SETS)],
+        "collector_number": str(index),
+        "rarity": FAKE_CARD_API_RARITIES[index % len(FAKE_CARD_API_RARITIES)],
+        "promo": index % 11 == 0,
+        "artist": f"Artist {index % 97}",
+        "prices": {"usd": f"{index % 2000 / 100:.2f}", "usd_foil": f"{index % 5000 / 100:.2f}",
+                   "eur": f"{index % 1800 / 100:.2f}", "tix": None},
+    }
+    if index % 5:
+        card["image_uris"] = {size: f"https://cards.scryfall.io/{size}/front/{card['id']}.jpg"
+                              for size in ("small", "normal", "large", "png", "art_crop", "border_crop")}
+    return card
+
+
+def make_scryfall_card_for_printing(set_code: str, collector_number: str, lang: str = 'en') -> dict:
+    # Any printing that is asked for exists; the card only has to carry the
+    # requested set, collector number and language.
+    index: int = int(collector_number) if collector_number.isdigit() else len(collector_number)
+    card: dict = make_scryfall_card(index, index + 1)
+    card.update(set=set_code.lower(), collector_number=collector_number, lang=lang.lower())
+    return card
+
+
+def make_mtg_card(index: int, name_count: int) -> dict:
+    card: dict = {
+        "name": f"Card {index % name_count}",
+        "manaCost": "{2}{G}",
+        "cmc": 3.0,
+        "colors": ["Green"],
+        "colorIdentity": ["G"],
+        "type": FAKE_CARD_API_TYPE_LINES[index % len(FAKE_CARD_API_TYPE_LINES)],
+        "types": [FAKE_CARD_API_TYPE_LINES[index % len(FAKE_CARD_API_TYPE_LINES)].split(' — ')[0].split()[-1]],
+        "rarity": FAKE_CARD_API_RARITIES[index % len(FAKE_CARD_API_RARITIES)].capitalize(),
+        "set": FAKE_CARD_API_SETS[index % len(FAKE_CARD_API_SETS)].upper(),
+        "text": FAKE_CARD_API_ORACLE_TEXT,
+        "artist": f"Artist {index % 97}",
+        "number": str(index),
+        "layout": "normal",
+        "multiverseid": str(index + 1),
+        "id": str(uuid.UUID(int=index)),
+    }
+    if index % 3:
+        card["imageUrl"] = f"http://gatherer.wizards.com/Handlers/Image.ashx?multiverseid={index + 1}&type=card"
+    return card
+
+
+def write_synthetic_bulk_data(path: Path, card_count: int) -> None:
+    # Same layout as the real file: a JSON array with one card per line.
+    name_count: int = max(1, card_count // FAKE_CARD_API_PRINTINGS_PER_NAME)
+    with path.open(mode='w', encoding='utf-8') as fp:
+        fp.write('[\n')
+        for index in range(card_count):
+            fp.write(json.dumps(make_scryfall_card(index, name_count), ensure_ascii=False))
+            fp.write(',\n' if index < card_count - 1 else '\n')
+        fp.write(']\n')
+
+
+def iterate_printings_in_bulk_data(path: Path) -> Iterator[tuple[str, str, str, str]]:
+    # Name, set, collector number and language of every card in a bulk file.
+    previous_path: Path = scryfall_api.SCRYFALL_ALL_CARDS_BULK_DATA_PATH
+    scryfall_api.SCRYFALL_ALL_CARDS_BULK_DATA_PATH = path
+    try:
+        for card in scryfall_api.iterate_scryfall_cards_from_bulk_data():
+            yield card["name"], card["set"], card["collector_number"], card["lang"]
+    finally:
+        scryfall_api.SCRYFALL_ALL_CARDS_BULK_DATA_PATH = previous_path
@@ -0,0 +1,144 @@
+import threading
+import json
+import re
+
+from typing import Any, Callable, Optional
+
+# A1 ranges as the jobs write them: 'Sheet name!B2:F', 'Sheet name!A:E',
+# 'Sheet name!B1:1' or a single cell such as 'Sheet name!A2'.
+FAKE_SHEETS_A1_RANGE = re.compile(r'([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?')
+FAKE_SHEETS_MAX_ROWS = 10_000_000
+FAKE_SHEETS_MAX_COLUMNS = 26
+
+
+class FakeRequest:
+    # Stands in for googleapiclient.http.HttpRequest: nothing happens until
+    # execute() is called.
+    def __init__(self, sheets: 'FakeSpreadsheets', method: str, func: Callable[[], dict]):
+        self.sheets: FakeSpreadsheets = sheets
+        self.method: str = method
+        self.func: Callable[[], dict] = func
+
+    def execute(self, num_retries: int = 0) -> dict:
+        result: dict = self.func()
+        self.sheets.count_request(self.method, result)
+        return result
+
+
+class FakeValues:
+    def __init__(self, sheets: 'FakeSpreadsheets'):
+        self.sheets: FakeSpreadsheets = sheets
+
+    def get(self, spreadsheetId: str, range: str, **kwargs) -> FakeRequest:
+        return FakeRequest(self.sheets, 'get', lambda: dict(range=range, **self.sheets.read_value_range(range)))
+
+    def batchGet(self, spreadsheetId: str, ranges: list[str], **kwargs) -> FakeRequest:
+        return FakeRequest(self.sheets, 'batchGet', lambda: dict(valueRanges=[
+            dict(range=range_, **self.sheets.read_value_range(range_)) for range_ in ranges]))
+
+    def update(self, spreadsheetId: str, range: str, body: dict, **kwargs) -> FakeRequest:
+        return FakeRequest(self.sheets, 'update', lambda: dict(
+            updatedRange=range, updatedCells=self.sheets.write_value_range(dict(body, range=range))))
+
+    def batchUpdate(self, spreadsheetId: str, body: dict) -> FakeRequest:
+        return FakeRequest(self.sheets, 'batchUpdate', lambda: dict(totalUpdatedCells=sum(
+            self.sheets.write_value_range(value_range) for value_range in body['data'])))
+
+    def batchClear(self, spreadsheetId: str, body: dict) -> FakeRequest:
+        def __clear() -> dict:
+            for range_ in body['ranges']:
+                self.sheets.clear_range(range_)
+            return dict(clearedRanges=body['ranges'])
+        return FakeRequest(self.sheets, 'batchClear', __clear)
+
+
+class FakeSpreadsheets:
+    # In-memory stand-in for the object returned by
+    # google_api.obtain_google_api_service, i.e. service.spreadsheets(). Every
+    # sheet is a list of rows; like the real API, reads leave out trailing
+    # empty cells and rows. Requests are counted per method, and written
+    # values are encoded to JSON once, as the real client does for the body.
+    def __init__(self):
+        self.grids: dict[str, list[list[Any]]] = {}
+        self.requests: dict[str, int] = {}
+        self.cells_updated: int = 0
+        self.lock = threading.Lock()
+
+    def values(self) -> FakeValues:
+        return FakeValues(self)
+
+    def count_request(self, method: str, result: dict) -> None:
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            self.cells_updated += result.get('totalUpdatedCells', result.get('updatedCells', 0))
+
+    def set_values(self, sheet_name: str, col_start: int, row_start: int, rows: list[list[Any]]) -> None:
+        # Seeds a sheet; col_start is 0-based like util.number_to_column_letter,
+        # row_start is 1-based like A1 notation.
+        grid: list[list[Any]] = self.grids.setdefault(sheet_name, [])
+        for row_idx, row in enumerate(rows, start=row_start - 1):
+            while len(grid) <= row_idx:
+                grid.append([])
+            grid_row: list[Any] = grid[row_idx]
+            if len(grid_row) < col_start + len(row):
+                grid_row.extend([''] * (col_start + len(row) - len(grid_row)))
+            grid_row[col_start:col_start + len(row)] = ['' if value is None else value for value in row]
+
+    def read_value_range(self, range_: str) -> dict:
+        sheet_name, col_start, row_start, col_end, row_end = parse_a1_range(range_)
+        with self.lock:
+            grid: list[list[Any]] = self.grids.get(sheet_name, [])
+            rows: list[list[Any]] = []
+            for grid_row in grid[row_start - 1:row_end]:
+                row: list[Any] = grid_row[col_start:col_end + 1]
+                while row and row[-1] == '':
+                    row.pop()
+                rows.append(row)
+        while rows and not rows[-1]:
+            rows.pop()
+        return dict(values=rows) if rows else {}
+
+    def write_value_range(self, value_range: dict) -> int:
+        json.dumps(value_range['values'], ensure_ascii=False)
+        sheet_name, col_start, row_start, _, _ = parse_a1_range(value_range['range'])
+        rows: list[list[Any]] = value_range['values']
+        if value_range.get('majorDimension', 'ROWS') == 'COLUMNS':
+            rows = [list(row) for row in zip(*rows)]
+        with self.lock:
+            self.set_values(sheet_name, col_start, row_start, rows)
+        return sum(len(row) for row in rows)
+
+    def clear_range(self, range_: str) -> None:
+        sheet_name, col_start, row_start, col_end, row_end = parse_a1_range(range_)
+        with self.lock:
+            for grid_row in self.grids.get(sheet_name, [])[row_start - 1:row_end]:
+                for col in range(col_start, min(col_end + 1, len(grid_row))):
+                    grid_row[col] = ''
+
+    def read_rows(self, sheet_name: str) -> list[list[Any]]:
+        return self.read_value_range(f'{sheet_name}!A1:Z').get('values', [])
+
+
+def parse_a1_range(range_: str) -> tuple[str, int, int, int, int]:
+    # Returns the sheet name, the 0-based first and last column and the
+    # 1-based first and last row; open ends extend to the edge of the sheet.
+    sheet_name, _, cells = range_.rpartition('!')
+    match: Optional[re.Match] = FAKE_SHEETS_A1_RANGE.fullmatch(cells)
+    if not sheet_name or match is None:
+        raise ValueError(f"Unsupported range: {range_}")
+    first_col, first_row, last_col, last_row = match.groups()
+    col_start: int = column_to_index(first_col) if first_col else 0
+    row_start: int = int(first_row) if first_row else 1
+    if last_col is None and last_row is None:
+        return sheet_name, col_start, row_start, col_start if first_col else FAKE_SHEETS_MAX_COLUMNS - 1, \
+            row_start if first_row else FAKE_SHEETS_MAX_ROWS
+    col_end: int = column_to_index(last_col) if last_col else FAKE_SHEETS_MAX_COLUMNS - 1
+    row_end: int = int(last_row) if last_row else FAKE_SHEETS_MAX_ROWS
+    return sheet_name, col_start, row_start, col_end, row_end
+
+
+def column_to_index(column: str) -> int:
+    index: int = 0
+    for letter in column:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
@@ -0,0 +1,238 @@
+import subprocess
+import google_api
+import threading
+import argparse
+import tempfile
+import profiling
+import logging
+import metrics
+import random
+import json
+import time
+import sys
+import os
+
+from benchmarks import fake_card_apis
+from benchmarks.fake_sheets import FakeSpreadsheets
+from benchmarks.sheet_rows import SHEET_ROWS_COLUMNS
+from benchmarks.timing import format_table
+from database import scryfall_to_google_api, mtg_to_google_api
+from prices import scryfall_prices_to_google_api
+from pathlib import Path
+from typing import Any, Callable, NamedTuple, Optional
+
+OFFLINE_JOBS_REPO_PATH = Path(__file__).resolve().parent.parent
+
+# A cold run starts from an empty directory and an empty sheet; a warm run
+# follows it with the caches and the sheet it left behind, like the next
+# nightly run.
+OFFLINE_JOBS_RUNS = ('cold', 'warm')
+OFFLINE_JOBS_SHEET_PATH = Path('sheet.json')
+OFFLINE_JOBS_MTG_COLUMNS = ("name", "set", "number", "types", "rarity", "imageUrl")
+OFFLINE_JOBS_FOIL_TYPES = ("None", "None", "None", "Traditional")
+
+
+class OfflineJob(NamedTuple):
+    update_spreadsheet: Callable[[], None]
+    sheet_name: str
+    header_col_offset: int
+    header: tuple[str, ...]
+
+
+OFFLINE_JOBS: dict[str, OfflineJob] = {
+    "mtg": OfflineJob(mtg_to_google_api.update_spreadsheet_with_mtg_data,
+                      mtg_to_google_api.GOOGLE_SPREADSHEET_SHEET_NAME,
+                      mtg_to_google_api.GOOGLE_SPREADSHEET_HEADER_COL_OFFSET,
+                      OFFLINE_JOBS_MTG_COLUMNS),
+    "scryfall": OfflineJob(scryfall_to_google_api.update_spreadsheet_with_scryfall_data,
+                           scryfall_to_google_api.GOOGLE_SPREADSHEET_SHEET_NAME,
+                           scryfall_to_google_api.GOOGLE_SPREADSHEET_HEADER_COL_OFFSET,
+                           SHEET_ROWS_COLUMNS),
+    "prices": OfflineJob(scryfall_prices_to_google_api.update_spreadsheet_with_scryfall_price_data,
+                         scryfall_prices_to_google_api.GOOGLE_SPREADSHEET_SHEET_NAME,
+                         scryfall_prices_to_google_api.GOOGLE_SPREADSHEET_HEADER_COL_OFFSET,
+                         scryfall_prices_to_google_api.GOOGLE_SPREADSHEET_CARD_INFO_COLUMNS
+                         + ("Prices", "Scryfall Name")),
+}
+
+
+class JobRun(NamedTuple):
+    job: str
+    run: str
+    seconds: float
+    peak_memory_bytes: Optional[int]
+    sheets_requests: int
+    cells_updated: int
+    stages: dict[str, dict]
+    retries: int
+    http_requests: dict[str, int]
+    http_bytes: int
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the sheet jobs end to end against local stand-ins for the Scryfall, MTG and Sheets APIs.")
+    parser.add_argument("--jobs", nargs="+", choices=OFFLINE_JOBS, default=list(OFFLINE_JOBS))
+    parser.add_argument("--runs", nargs="+", choices=OFFLINE_JOBS_RUNS, default=list(OFFLINE_JOBS_RUNS))
+    parser.add_argument("--cards", type=int, default=20_000, help="printings in the synthetic Scryfall bulk file")
+    parser.add_argument("--bulk-data", type=Path, help="serve a recorded Scryfall all-cards file instead")
+    parser.add_argument("--mtg-cards", type=int, default=5_000)
+    parser.add_argument("--collection", type=int, default=500, help="rows in the price sheet")
+    parser.add_argument("--missing", type=int, default=50,
+                        help="price sheet rows that are not in the bulk data and go to the Scryfall API")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of API requests answered 429 with Retry-After: 1")
+    parser.add_argument("--max-in-flight", type=int,
+                        help="answer 429 to API requests beyond this many concurrent ones")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", nargs="?", const=",".join(profiling.PROFILE_MODES),
+                        help="profile every job run (cpu, memory or both) into ./profiles")
+    parser.add_argument("--child", choices=OFFLINE_JOBS, help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    parser.add_argument("--collection-path", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--profile-path", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args.child, args.base_url, args.collection_path, args.profile, args.profile_path)
+    if args.missing > args.collection:
+        raise ValueError("--missing cannot exceed --collection")
+    print(format_job_runs(run_benchmark(args)))
+
+
+def run_benchmark(args: argparse.Namespace) -> list[JobRun]:
+    # The fake card APIs are served from this process while every job runs
+    # in a child process of its own, so that module state, caches and peak
+    # memory are those of a single job.
+    job_runs: list[JobRun] = []
+    with tempfile.TemporaryDirectory() as directory:
+        bulk_data_path: Path = args.bulk_data or Path(directory) / 'all-cards.json'
+        if args.bulk_data is None:
+            fake_card_apis.write_synthetic_bulk_data(bulk_data_path, args.cards)
+        collection_path: Path = Path(directory) / 'collection.json'
+        with collection_path.open(mode='w') as fp:
+            json.dump(make_collection(bulk_data_path, args.collection, args.missing, random.Random(args.seed)), fp)
+        server = fake_card_apis.FakeCardApiServer(bulk_data_path, args.mtg_cards, throttle_rate=args.throttle_rate,
+                                                  max_in_flight=args.max_in_flight, seed=args.seed)
+        threading.Thread(target=server.serve_forever, name='fake-card-apis', daemon=True).start()
+        try:
+            for job in args.jobs:
+                job_path: Path = Path(directory) / job
+                job_path.mkdir()
+                for run in OFFLINE_JOBS_RUNS:
+                    if run not in args.runs and run != 'cold':
+                        continue
+                    job_run: JobRun = run_job_in_child(job, run, job_path, server, collection_path, args.profile)
+                    if run in args.runs:
+                        job_runs.append(job_run)
+        finally:
+            server.shutdown()
+            server.server_close()
+    return job_runs
+
+
+def run_job_in_child(
+        job: str, run: str, job_path: Path, server: fake_card_apis.FakeCardApiServer, collection_path: Path,
+        profile: Optional[str] = None) -> JobRun:
+    # Profiles go to the directory the benchmark was started from, the job
+    # directories are removed at the end.
+    requests_before, bytes_before = server.get_stats()
+    env: dict[str, str] = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(OFFLINE_JOBS_REPO_PATH), env.get('PYTHONPATH')]))
+    profile_args: list[str] = [] if profile is None else [
+        f'--profile={profile}', '--profile-path', str(Path.cwd() / profiling.PROFILE_OUTPUT_PATH / f'{job}-{run}')]
+    process = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.offline_jobs', '--child', job,
+         '--base-url', server.base_url, '--collection-path', str(collection_path)] + profile_args,
+        cwd=job_path, env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise ValueError(f"Job '{job}' ({run}) failed:\n{process.stderr}")
+    result: dict = json.loads(process.stdout.splitlines()[-1])
+    requests_after, bytes_after = server.get_stats()
+    http_requests: dict[str, int] = {endpoint: count - requests_before.get(endpoint, 0)
+                                     for endpoint, count in requests_after.items()
+                                     if count != requests_before.get(endpoint, 0)}
+    return JobRun(job, run, result['seconds'], result['peak_memory_bytes'], result['sheets_requests'],
+                  result['cells_updated'], result['stages'], result['retries'], http_requests,
+                  bytes_after - bytes_before)
+
+
+def run_child(job: str, base_url: str, collection_path: Path,
+              profile: Optional[str] = None, profile_path: Optional[Path] = None) -> int:
+    logging.basicConfig(level=logging.WARNING, format=metrics.METRICS_LOG_FORMAT)
+    fake_card_apis.point_clients_at(base_url)
+    sheet: FakeSpreadsheets = load_fake_sheet(job, collection_path)
+    google_api.obtain_google_api_credentials = lambda: None
+    google_api.obtain_google_api_service = lambda creds, thread_safe=False: sheet
+    if profile is not None:
+        profiling.start_profiling(profiling.parse_profile_modes([f'--profile={profile}']), profile_path)
+    started_at: float = time.perf_counter()
+    OFFLINE_JOBS[job].update_spreadsheet()
+    seconds: float = time.perf_counter() - started_at
+    profiling.stop_profiling()
+    report: dict = metrics.build_run_report()
+    with OFFLINE_JOBS_SHEET_PATH.open(mode='w') as fp:
+        json.dump(sheet.grids, fp)
+    print(json.dumps(dict(seconds=seconds, peak_memory_bytes=report['peak_memory_bytes'],
+                          sheets_requests=sum(sheet.requests.values()), cells_updated=sheet.cells_updated,
+                          stages=report['stages'],
+                          retries=sum(count for name, count in report['counters'].items()
+                                      if name.startswith('http.retries.')))))
+    return 0
+
+
+def load_fake_sheet(job: str, collection_path: Path) -> FakeSpreadsheets:
+    # The sheet a previous run wrote is picked up again; a new sheet only
+    # holds the header and, for the price job, the collection.
+    sheet: FakeSpreadsheets = FakeSpreadsheets()
+    if OFFLINE_JOBS_SHEET_PATH.exists():
+        with OFFLINE_JOBS_SHEET_PATH.open(mode='r') as fp:
+            sheet.grids = json.load(fp)
+        return sheet
+    offline_job: OfflineJob = OFFLINE_JOBS[job]
+    sheet.set_values(offline_job.sheet_name, offline_job.header_col_offset, 1, [list(offline_job.header)])
+    if job == "prices":
+        with collection_path.open(mode='r') as fp:
+            sheet.set_values(offline_job.sheet_name, offline_job.header_col_offset, 2, json.load(fp))
+    return sheet
+
+
+def make_collection(bulk_data_path: Path, size: int, missing: int, rng: random.Random) -> list[list[Any]]:
+    # Rows of the price sheet: printings sampled from the bulk file, plus
+    # `missing` printings it does not have, half of them not in English so
+    # that both the batched and the single printing lookups are exercised.
+    sample: list[tuple[str, str, str, str]] = []
+    for seen, printing in enumerate(fake_card_apis.iterate_printings_in_bulk_data(bulk_data_path)):
+        if len(sample) < size - missing:
+            sample.append(printing)
+        elif (idx := rng.randrange(seen + 1)) < len(sample):
+            sample[idx] = printing
+    for idx in range(missing):
+        sample.append((f"Missing {idx}", rng.choice(fake_card_apis.FAKE_CARD_API_SETS),
+                       str(10_000_000 + idx), "ja" if idx % 2 else "en"))
+    rng.shuffle(sample)
+    return [[name, collector_number, set_code.upper(), lang.upper(), rng.choice(OFFLINE_JOBS_FOIL_TYPES)]
+            for name, set_code, collector_number, lang in sample]
+
+
+def format_job_runs(job_runs: list[JobRun]) -> str:
+    summary: str = format_table(
+        ["job", "run", "seconds", "http requests", "retries", "http MB", "sheets requests", "cells updated",
+         "peak RSS MB"],
+        [[job_run.job, job_run.run, f"{job_run.seconds:.2f}", sum(job_run.http_requests.values()), job_run.retries,
+          f"{job_run.http_bytes / 1e6:.1f}", job_run.sheets_requests, job_run.cells_updated,
+          "-" if job_run.peak_memory_bytes is None else f"{job_run.peak_memory_bytes / 1e6:.0f}"]
+         for job_run in job_runs])
+    stages: str = format_table(
+        ["job", "run", "stage", "runs", "seconds"],
+        [[job_run.job, job_run.run, name, timing['count'], f"{timing['seconds']:.3f}"]
+         for job_run in job_runs for name, timing in job_run.stages.items()
+         if not name.startswith(('http.', 'sheets.'))])
+    requests: str = format_table(
+        ["job", "run", "endpoint", "requests"],
+        [[job_run.job, job_run.run, endpoint, count]
+         for job_run in job_runs for endpoint, count in sorted(job_run.http_requests.items())])
+    return '\n\n'.join([summary, stages, requests])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+import scryfall_api
+import argparse
+import os
+import sys
+
+from benchmarks.timing import time_call, format_table
+from pathlib import Path
+
+# Attributes projected by the "projected" variant; roughly what the database
+# sheet asks for.
+PROJECTED_ATTRIBUTES = ("name", "set", "collector_number", "lang", "rarity", "type_line", "image_uris")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare serial and parallel parsing of the Scryfall bulk file.")
+    parser.add_argument("--path", type=Path, default=scryfall_api.SCRYFALL_ALL_CARDS_BULK_DATA_PATH)
+    parser.add_argument("--workers", type=int, nargs="+", default=default_worker_counts())
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    scryfall_api.SCRYFALL_ALL_CARDS_BULK_DATA_PATH = args.path
+    print(run_benchmark(args.workers, args.repeat))
+
+
+def default_worker_counts() -> list[int]:
+    cpu_count: int = os.cpu_count() or 1
+    counts: list[int] = [1]
+    while counts[-1] * 2 <= cpu_count:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cpu_count:
+        counts.append(cpu_count)
+    return counts
+
+
+def run_benchmark(worker_counts: list[int], repeat: int = 1) -> str:
+    baseline_seconds, baseline_cards = time_call(scryfall_api.load_scryfall_cards_from_bulk_data, repeat=repeat)
+    baseline_count: int = len(baseline_cards)
+    rows: list[list] = [["json.load", "-", f"{baseline_seconds:.2f}", "1.00", baseline_count]]
+    del baseline_cards
+    for workers in worker_counts:
+        seconds, cards = time_call(
+            scryfall_api.load_scryfall_cards_from_bulk_data_parallel, workers, repeat=repeat)
+        if len(cards) != baseline_count:
+            raise ValueError(f"Parallel parse with {workers} workers returned {len(cards)} cards, "
+                             f"expected {baseline_count}")
+        rows.append(["parallel", workers, f"{seconds:.2f}", f"{baseline_seconds / seconds:.2f}", len(cards)])
+        del cards
+        seconds, cards = time_call(
+            scryfall_api.load_scryfall_cards_from_bulk_data_parallel, workers, PROJECTED_ATTRIBUTES, repeat=repeat)
+        rows.append(["projected", workers, f"{seconds:.2f}", f"{baseline_seconds / seconds:.2f}", len(cards)])
+        del cards
+    return format_table(["loader", "workers", "seconds", "speedup", "cards"], rows)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
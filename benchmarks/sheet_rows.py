@@ -0,0 +1,45 @@
+import column_extractors
+import scryfall_api
+import argparse
+import sys
+
+from benchmarks.timing import time_call, format_table
+from database import scryfall_to_google_api
+
+# Header of the Scryfall database sheet, including both derived columns.
+SHEET_ROWS_COLUMNS = ("name", "set", "collector_number", "lang", "rarity", "type_line", "image_uris",
+                      "mana_cost", "colors", "multiverse_ids")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-cell and compiled row building on the Scryfall cards.")
+    parser.add_argument("--columns", nargs="+", default=SHEET_ROWS_COLUMNS)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(run_benchmark(list(scryfall_api.load_all_scryfall_cards()), args.columns, args.repeat))
+
+
+def build_rows_per_cell(cards: list[dict], attrs: list[str]) -> list[list]:
+    return [[scryfall_to_google_api.get_attribute_from_card(card, attr) for attr in attrs] for card in cards]
+
+
+def build_rows_compiled(cards: list[dict], attrs: list[str]) -> list[list]:
+    extractors: tuple[column_extractors.Extractor, ...] = column_extractors.compile_column_extractors(
+        attrs, scryfall_to_google_api.SCRYFALL_DERIVED_COLUMNS)
+    return [[extractor(card) for extractor in extractors] for card in cards]
+
+
+def run_benchmark(cards: list[dict], attrs: list[str], repeat: int = 1) -> str:
+    baseline_seconds, baseline_rows = time_call(build_rows_per_cell, cards, attrs, repeat=repeat)
+    seconds, rows = time_call(build_rows_compiled, cards, attrs, repeat=repeat)
+    if rows != baseline_rows:
+        raise ValueError("Compiled extractors built different rows than get_attribute_from_card")
+    cells: int = len(cards) * len(attrs)
+    return format_table(["builder", "cards", "cells", "seconds", "speedup"], [
+        ["per-cell", len(cards), cells, f"{baseline_seconds:.2f}", "1.00"],
+        ["compiled", len(cards), cells, f"{seconds:.2f}", f"{baseline_seconds / seconds:.2f}"],
+    ])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
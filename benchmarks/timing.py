@@ -0,0 +1,53 @@
+import tracemalloc
+import statistics
+import time
+import gc
+
+from typing import Any, Callable
+
+
+def time_call(func: Callable, *args, repeat: int = 1, **kwargs) -> tuple[float, Any]:
+    best: float = float('inf')
+    result: Any = None
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def time_calls_interleaved(calls: dict[str, Callable[[], Any]], repeat: int = 1) -> dict[str, tuple[float, Any]]:
+    # Median seconds of every call, running them in turn rather than one after
+    # the other so that drift in the machine's speed hits all of them alike.
+    # Garbage left by the previous call is collected before each one so that
+    # its collection is not timed as part of the next call.
+    seconds: dict[str, list[float]] = {name: [] for name in calls}
+    results: dict[str, Any] = {}
+    for _ in range(repeat):
+        for name, call in calls.items():
+            gc.collect()
+            start: float = time.perf_counter()
+            results[name] = call()
+            seconds[name].append(time.perf_counter() - start)
+    return {name: (statistics.median(seconds[name]), results[name]) for name in calls}
+
+
+def measure_peak_memory(func: Callable, *args, **kwargs) -> tuple[int, Any]:
+    # Peak bytes allocated by Python while `func` runs, above what was already
+    # allocated when it started.
+    tracemalloc.start()
+    try:
+        baseline: int = tracemalloc.get_traced_memory()[0]
+        result: Any = func(*args, **kwargs)
+        peak: int = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def format_table(header: list[str], rows: list[list[Any]]) -> str:
+    cells: list[list[str]] = [header] + [[str(value) for value in row] for row in rows]
+    widths: list[int] = [max(len(row[col]) for row in cells) for col in range(len(header))]
+    lines: list[str] = ['  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in cells]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
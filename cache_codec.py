@@ -0,0 +1,171 @@
+import contextlib
+import marshal
+import struct
+import pickle
+import lzma
+import gzip
+import json
+import bz2
+import sys
+import os
+
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, ContextManager, Iterable, Iterator, NamedTuple, Optional
+
+# Cache files start with this line followed by the format and compression
+# they were written with, so a cache can always be read back whatever codec is
+# configured now. Files without it are plain pickles from before codecs.
+CACHE_CODEC_MAGIC = b'CARDCACHE1'
+
+CACHE_CODEC_FORMATS = ('pickle', 'marshal', 'jsonl')
+CACHE_CODEC_COMPRESSIONS = ('gzip', 'lzma', 'bz2')
+
+# Marshal records are framed with their length: marshal.load() on a file reads
+# a few bytes at a time, which is very slow through a decompressor.
+CACHE_CODEC_MARSHAL_LENGTH = struct.Struct('<I')
+
+
+class CacheCodec(NamedTuple):
+    # format: how every record is serialized, one of CACHE_CODEC_FORMATS
+    # compression: None or one of CACHE_CODEC_COMPRESSIONS
+    # level: compression level (preset for lzma); None for the library default
+    format: str = 'pickle'
+    compression: Optional[str] = None
+    level: Optional[int] = None
+
+    def __str__(self) -> str:
+        name: str = self.format
+        if self.compression:
+            name += f"+{self.compression}"
+            if self.level is not None:
+                name += f":{self.level}"
+        return name
+
+
+def main():
+    for path in sys.argv[1:]:
+        print(f"{path}: {read_cache_codec(Path(path))}")
+
+
+def parse_cache_codec(name: str) -> CacheCodec:
+    # Inverse of str(CacheCodec), e.g. "pickle", "jsonl+gzip" or "marshal+lzma:9".
+    format_, _, compression = name.partition('+')
+    compression, _, level = compression.partition(':')
+    if format_ not in CACHE_CODEC_FORMATS:
+        raise ValueError(f"Unknown cache format: {format_}")
+    if compression and compression not in CACHE_CODEC_COMPRESSIONS:
+        raise ValueError(f"Unknown cache compression: {compression}")
+    return CacheCodec(format_, compression or None, int(level) if level else None)
+
+
+def dump_records(path: Path, records: Iterable[Any], codec: CacheCodec) -> int:
+    # Records are written one after another rather than as a single list so
+    # that neither writing nor reading the cache needs all of them in memory.
+    write_record: Callable[[Any, BinaryIO], None] = get_record_writer(codec.format)
+    part_path: Path = path.with_name(path.name + '.part')
+    count: int = 0
+    with part_path.open(mode='wb') as raw_fp:
+        raw_fp.write(b' '.join([CACHE_CODEC_MAGIC, codec.format.encode(),
+                                (codec.compression or 'none').encode()]) + b'\n')
+        with open_compressed(raw_fp, codec, 'wb') as fp:
+            for record in records:
+                write_record(record, fp)
+                count += 1
+    os.replace(part_path, path)
+    return count
+
+
+def load_records(path: Path) -> Iterator[Any]:
+    with path.open(mode='rb') as raw_fp:
+        codec: Optional[CacheCodec] = read_cache_codec_header(raw_fp)
+        if codec is None:
+            raw_fp.seek(0)
+            codec = CacheCodec()
+        with open_compressed(raw_fp, codec, 'rb') as fp:
+            yield from get_record_reader(codec.format)(fp)
+
+
+def read_cache_codec(path: Path) -> CacheCodec:
+    with path.open(mode='rb') as fp:
+        return read_cache_codec_header(fp) or CacheCodec()
+
+
+def read_cache_codec_header(fp: BinaryIO) -> Optional[CacheCodec]:
+    line: bytes = fp.readline()
+    fields: list[bytes] = line.split()
+    if len(fields) != 3 or fields[0] != CACHE_CODEC_MAGIC:
+        return None
+    compression: str = fields[2].decode()
+    return CacheCodec(fields[1].decode(), None if compression == 'none' else compression)
+
+
+def open_compressed(fp: BinaryIO, codec: CacheCodec, mode: str) -> ContextManager[BinaryIO]:
+    if codec.compression == 'gzip':
+        return gzip.GzipFile(fileobj=fp, mode=mode, compresslevel=9 if codec.level is None else codec.level)
+    elif codec.compression == 'lzma':
+        return lzma.LZMAFile(fp, mode=mode, preset=codec.level if 'w' in mode else None)
+    elif codec.compression == 'bz2':
+        return bz2.BZ2File(fp, mode=mode, compresslevel=9 if codec.level is None else codec.level)
+    elif codec.compression is None:
+        return contextlib.nullcontext(fp)
+    else:
+        raise ValueError(f"Unknown cache compression: {codec.compression}")
+
+
+def get_record_writer(format_: str) -> Callable[[Any, BinaryIO], None]:
+    if format_ == 'pickle':
+        return write_pickle_record
+    elif format_ == 'marshal':
+        return write_marshal_record
+    elif format_ == 'jsonl':
+        return write_json_line_record
+    raise ValueError(f"Unknown cache format: {format_}")
+
+
+def get_record_reader(format_: str) -> Callable[[BinaryIO], Iterator[Any]]:
+    if format_ == 'pickle':
+        return read_pickle_records
+    elif format_ == 'marshal':
+        return read_marshal_records
+    elif format_ == 'jsonl':
+        return read_json_line_records
+    raise ValueError(f"Unknown cache format: {format_}")
+
+
+def write_pickle_record(record: Any, fp: BinaryIO) -> None:
+    pickle.dump(record, fp, protocol=5)
+
+
+def read_pickle_records(fp: BinaryIO) -> Iterator[Any]:
+    while True:
+        # A new unpickler for every record: a shared one keeps every object
+        # it has loaded in its memo, i.e. the whole cache.
+        try:
+            yield pickle.load(fp)
+        except EOFError:
+            break
+
+
+def write_marshal_record(record: Any, fp: BinaryIO) -> None:
+    data: bytes = marshal.dumps(record)
+    fp.write(CACHE_CODEC_MARSHAL_LENGTH.pack(len(data)))
+    fp.write(data)
+
+
+def read_marshal_records(fp: BinaryIO) -> Iterator[Any]:
+    while length_data := fp.read(CACHE_CODEC_MARSHAL_LENGTH.size):
+        yield marshal.loads(fp.read(CACHE_CODEC_MARSHAL_LENGTH.unpack(length_data)[0]))
+
+
+def write_json_line_record(record: Any, fp: BinaryIO) -> None:
+    fp.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode())
+    fp.write(b'\n')
+
+
+def read_json_line_records(fp: BinaryIO) -> Iterator[Any]:
+    for line in fp:
+        yield json.loads(line)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
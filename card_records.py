@@ -0,0 +1,139 @@
+import column_extractors
+import sys
+
+from typing import Any, Callable, Iterable, NamedTuple, Optional, Sequence
+
+# Strings up to this length are interned when a card is projected: set codes,
+# rarities, languages and types repeat across tens of thousands of printings,
+# while longer strings such as image URIs are unique and gain nothing.
+CARD_RECORDS_INTERN_MAX_LENGTH = 32
+
+# A printing policy ranks a card among the printings of the same name, given
+# the card and its position in the load order; the printing with the highest
+# rank is the one that is kept.
+PrintingPolicy = Callable[[dict, int], tuple]
+
+
+class CardRecord(NamedTuple):
+    # What a sheet job keeps of a card once it is loaded: the name and rank
+    # the dedup needs and the cells of its sheet row, already extracted.
+    name: str
+    rank: tuple
+    values: tuple
+
+
+def collect_card_records(
+        cards: Iterable[dict], extractors: tuple[column_extractors.Extractor, ...],
+        name_attr: str, policy: PrintingPolicy) -> list[CardRecord]:
+    # Deduplicates the printings by name and projects the best-ranked
+    # printing of every name onto the sheet columns; only the unique names
+    # are sorted. Neither way holds more than the cells of one printing per
+    # name besides what the caller already holds.
+    if isinstance(cards, Sequence):
+        return collect_card_records_by_position(cards, extractors, name_attr, policy)
+    return collect_card_records_streamed(cards, extractors, name_attr, policy)
+
+
+def collect_card_records_by_position(
+        cards: Sequence[dict], extractors: tuple[column_extractors.Extractor, ...],
+        name_attr: str, policy: PrintingPolicy) -> list[CardRecord]:
+    # Cards that are already in memory are ranked first, keeping only the
+    # position of the best printing per name, and then only the winners are
+    # projected, so every name's cells are extracted exactly once.
+    ranks: dict[str, tuple] = {}
+    positions: dict[str, int] = {}
+    for position, card in enumerate(cards):
+        name: str = card[name_attr]
+        rank: tuple = policy(card, position)
+        current: Optional[tuple] = ranks.get(name)
+        if current is None or rank > current:
+            ranks[name] = rank
+            positions[name] = position
+    return [CardRecord(card_name, ranks[card_name],
+                       tuple([intern_value(extractor(cards[positions[card_name]])) for extractor in extractors]))
+            for card_name in sorted(ranks)]
+
+
+def collect_card_records_streamed(
+        cards: Iterable[dict], extractors: tuple[column_extractors.Extractor, ...],
+        name_attr: str, policy: PrintingPolicy) -> list[CardRecord]:
+    # Cards read once from a cache cannot be looked up again, so the cells
+    # are extracted whenever a printing takes the lead and every card dict is
+    # dropped right after. The cells of the winners are only interned at the
+    # end. Ranks and cells are kept in two dicts rather than one of pairs:
+    # on ordered input a pair per lead change is an allocation per card,
+    # which makes the garbage collector run more often.
+    ranks: dict[str, tuple] = {}
+    values: dict[str, tuple] = {}
+    for position, card in enumerate(cards):
+        name: str = card[name_attr]
+        rank: tuple = policy(card, position)
+        current: Optional[tuple] = ranks.get(name)
+        if current is None or rank > current:
+            ranks[name] = rank
+            values[name] = tuple([extractor(card) for extractor in extractors])
+    return [CardRecord(card_name, ranks[card_name], tuple([intern_value(value) for value in values[card_name]]))
+            for card_name in sorted(ranks)]
+
+
+def intern_value(value: Any) -> Any:
+    if type(value) is str and len(value) <= CARD_RECORDS_INTERN_MAX_LENGTH:
+        return sys.intern(value)
+    return value
+
+
+def prefer_last_with_image(image_attr: str) -> PrintingPolicy:
+    # The historical behavior of the database sheets: the last printing with
+    # images, or the first printing when none of them has images.
+    def __rank(card: dict, position: int) -> tuple:
+        has_image: bool = card.get(image_attr) is not None
+        return has_image, position if has_image else -position
+    return __rank
+
+
+def prefer_image(image_attr: str) -> PrintingPolicy:
+    def __rank(card: dict, position: int) -> tuple:
+        return card.get(image_attr) is not None,
+    return __rank
+
+
+def prefer_newest(date_attr: str) -> PrintingPolicy:
+    # Dates in ISO format compare correctly as strings.
+    def __rank(card: dict, position: int) -> tuple:
+        return card.get(date_attr) or '',
+    return __rank
+
+
+def prefer_non_promo(promo_attr: str) -> PrintingPolicy:
+    def __rank(card: dict, position: int) -> tuple:
+        return not card.get(promo_attr),
+    return __rank
+
+
+def prefer_language(lang_attr: str, language: str) -> PrintingPolicy:
+    def __rank(card: dict, position: int) -> tuple:
+        return card.get(lang_attr) == language,
+    return __rank
+
+
+def prefer_first() -> PrintingPolicy:
+    def __rank(card: dict, position: int) -> tuple:
+        return -position,
+    return __rank
+
+
+def prefer_last() -> PrintingPolicy:
+    def __rank(card: dict, position: int) -> tuple:
+        return position,
+    return __rank
+
+
+def combine_policies(*policies: PrintingPolicy) -> PrintingPolicy:
+    # Ranks by the first policy, then breaks ties with the next one, and so
+    # on; end with prefer_first() or prefer_last() to make the choice stable.
+    def __rank(card: dict, position: int) -> tuple:
+        rank: tuple = ()
+        for policy in policies:
+            rank += policy(card, position)
+        return rank
+    return __rank
@@ -0,0 +1,138 @@
+import itertools
+import sqlite3
+import json
+import sys
+
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+CARD_STORE_PATH = Path('cards.sqlite')
+CARD_STORE_INSERT_BATCH_SIZE = 10_000
+
+# Scryfall cards are looked up in the memory-mapped store instead; see
+# mapped_card_store.
+CARD_STORE_TABLE_MTG = 'mtg_cards'
+CARD_STORE_TABLES = (CARD_STORE_TABLE_MTG,)
+
+# Format strings to build the schema of a card table as follows:
+# {0} - Table name
+CARD_STORE_SCHEMA = (
+    'CREATE TABLE {0} ('
+    'card_key INTEGER PRIMARY KEY, '
+    'id TEXT, '
+    'name TEXT, '
+    'set_code TEXT, '
+    'collector_number TEXT, '
+    'lang TEXT, '
+    'data TEXT NOT NULL)',
+    'CREATE TABLE {0}_multiverse_ids ('
+    'multiverse_id INTEGER NOT NULL, '
+    'card_key INTEGER NOT NULL)',
+)
+CARD_STORE_SCHEMA_TABLE_VERSIONS = 'CREATE TABLE IF NOT EXISTS card_table_versions (name TEXT PRIMARY KEY, version TEXT)'
+CARD_STORE_INDEXES = (
+    'CREATE INDEX {0}_by_printing ON {0} (set_code, collector_number, lang)',
+    'CREATE INDEX {0}_by_name ON {0} (name)',
+    'CREATE INDEX {0}_by_multiverse_id ON {0}_multiverse_ids (multiverse_id)',
+)
+
+
+def main():
+    conn: sqlite3.Connection = connect_card_store()
+    for table in CARD_STORE_TABLES:
+        if card_store_has_table(conn, table):
+            count: int = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            print(f"{table}: {count} cards")
+        else:
+            print(f"{table}: not populated")
+
+
+def connect_card_store(path: Path = CARD_STORE_PATH, check_same_thread: bool = True) -> sqlite3.Connection:
+    # Transactions are managed explicitly so that rebuilding a table, which
+    # mixes DDL and inserts, is atomic.
+    conn = sqlite3.connect(str(path), isolation_level=None, check_same_thread=check_same_thread)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def card_store_has_table(conn: sqlite3.Connection, table: str) -> bool:
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    return row is not None
+
+
+def get_table_version(conn: sqlite3.Connection, table: str) -> Optional[str]:
+    conn.execute(CARD_STORE_SCHEMA_TABLE_VERSIONS)
+    row = conn.execute('SELECT version FROM card_table_versions WHERE name = ?', (table,)).fetchone()
+    return row[0] if row else None
+
+
+def populate_mtg_cards(conn: sqlite3.Connection, cards: Iterable[dict], version: Optional[str] = None) -> int:
+    def __card_row(card: dict) -> tuple:
+        multiverse_id = card.get("multiverseid")
+        # The MTG API only lists English printings at the top level.
+        return (card.get("id"), card.get("name"), card.get("set"),
+                card.get("number"), "en", [multiverse_id] if multiverse_id else [])
+    return populate_table(conn, CARD_STORE_TABLE_MTG, cards, __card_row, version)
+
+
+def populate_table(
+        conn: sqlite3.Connection, table: str, cards: Iterable[dict], card_row: Callable[[dict], tuple],
+        version: Optional[str] = None) -> int:
+    count: int = 0
+    conn.execute('BEGIN')
+    try:
+        conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.execute(f'DROP TABLE IF EXISTS {table}_multiverse_ids')
+        for statement in CARD_STORE_SCHEMA:
+            conn.execute(statement.format(table))
+        cards_iter: Iterator[dict] = iter(cards)
+        while batch := list(itertools.islice(cards_iter, CARD_STORE_INSERT_BATCH_SIZE)):
+            card_rows: list[tuple] = []
+            multiverse_rows: list[tuple[int, int]] = []
+            for card_key, card in enumerate(batch, start=count):
+                id_, name, set_code, collector_number, lang, multiverse_ids = card_row(card)
+                card_rows.append((card_key, id_, name, normalize_key(set_code),
+                                  collector_number, normalize_key(lang), json.dumps(card)))
+                multiverse_rows.extend((int(multiverse_id), card_key) for multiverse_id in multiverse_ids)
+            conn.executemany(f'INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?)', card_rows)
+            conn.executemany(f'INSERT INTO {table}_multiverse_ids VALUES (?, ?)', multiverse_rows)
+            count += len(batch)
+        # Building the indexes once after the bulk insert is much cheaper than
+        # maintaining them row by row.
+        for statement in CARD_STORE_INDEXES:
+            conn.execute(statement.format(table))
+        conn.execute(CARD_STORE_SCHEMA_TABLE_VERSIONS)
+        conn.execute('INSERT OR REPLACE INTO card_table_versions VALUES (?, ?)', (table, version))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return count
+
+
+def normalize_key(value: Optional[str]) -> Optional[str]:
+    return value.lower() if value else value
+
+
+def find_card_by_printing(
+        conn: sqlite3.Connection, table: str,
+        set_code: str, collector_number: str, lang: str) -> Optional[dict]:
+    row = conn.execute(f'SELECT data FROM {table} WHERE set_code = ? AND collector_number = ? AND lang = ? '
+                       f'ORDER BY card_key LIMIT 1',
+                       (normalize_key(set_code), collector_number, normalize_key(lang))).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def find_cards_by_name(conn: sqlite3.Connection, table: str, name: str) -> list[dict]:
+    rows = conn.execute(f'SELECT data FROM {table} WHERE name = ? ORDER BY card_key', (name,))
+    return [json.loads(data) for data, in rows]
+
+
+def find_cards_by_multiverse_id(conn: sqlite3.Connection, table: str, multiverse_id: int) -> list[dict]:
+    rows = conn.execute(f'SELECT data FROM {table} JOIN {table}_multiverse_ids USING (card_key) '
+                        f'WHERE multiverse_id = ? ORDER BY card_key', (int(multiverse_id),))
+    return [json.loads(data) for data, in rows]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
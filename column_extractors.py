@@ -0,0 +1,41 @@
+from typing import Any, Callable, Iterable, Optional, Sequence
+
+Extractor = Callable[[dict], Any]
+
+
+def derived_column(registry: dict[str, Extractor], name: str) -> Callable[[Extractor], Extractor]:
+    # Registers `func` as the extractor for the header value `name`; header
+    # values that are not registered are read from the card as they are.
+    def __register(func: Extractor) -> Extractor:
+        registry[name] = func
+        return func
+    return __register
+
+
+def compile_column_extractors(attrs: Iterable[str], registry: dict[str, Extractor]) -> tuple[Extractor, ...]:
+    # Resolves every column of the header to the function that produces its
+    # cell once, so building a row is one call per cell with no dispatch on
+    # the attribute name.
+    return tuple(registry.get(attr) or make_attribute_extractor(attr) for attr in attrs)
+
+
+def make_attribute_extractor(attr: str) -> Extractor:
+    def __extract(card: dict) -> Any:
+        value = card.get(attr)
+        return value[0] if type(value) is list and value else value
+    return __extract
+
+
+def compile_column_indexes(header: Sequence[Any], names: Iterable[str]) -> tuple[Optional[int], ...]:
+    # Position of each of `names` in the header row, or None when the sheet
+    # has no such column. A name that appears twice resolves to its last
+    # column.
+    positions: dict[Any, int] = {value: idx for idx, value in enumerate(header)}
+    return tuple(positions.get(name) for name in names)
+
+
+def decode_row(row: Sequence[Any], indexes: tuple[Optional[int], ...]) -> list[Any]:
+    # Sheets omits trailing empty cells, so a column past the end of the row
+    # decodes to None like a missing column.
+    row_len: int = len(row)
+    return [row[idx] if idx is not None and idx < row_len else None for idx in indexes]
@@ -0,0 +1,333 @@
+import mapped_card_store
+import scryfall_api
+import http_client
+import threading
+import profiling
+import argparse
+import datetime
+import logging
+import metrics
+import mtg_api
+import sqlite3
+import signal
+import json
+import time
+import sys
+
+from main import MAIN_JOBS, JobResult, format_job_result, obtain_shared_sheet, run_jobs_on_sheet
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from card_info import CardInfo, FoilType
+from prices import price_cache, scryfall_prices
+from urllib.parse import parse_qs, unquote, urlsplit
+from typing import Any, Callable, Optional
+
+# Lookups are served on localhost only:
+# GET /cards/{set}/{collector number}/{lang}?foil={none|traditional|surge|gold_stamp}
+# GET /mtg/cards/{set}/{number}
+# GET /mtg/names/{name}
+# GET /mtg/multiverse/{multiverse id}
+# GET /status
+DAEMON_HOST = '127.0.0.1'
+DAEMON_PORT = 8765
+
+# The bulk data is checked for updates on its own schedule; the jobs then
+# run every interval, counted from the end of their previous run. All of
+# them run once right after startup.
+DAEMON_BULK_DATA_INTERVAL = scryfall_api.SCRYFALL_CACHE_CHECK_INTERVAL
+DAEMON_JOB_INTERVALS: dict[str, datetime.timedelta] = {
+    'mtg': datetime.timedelta(days=1),
+    'scryfall': datetime.timedelta(hours=6),
+    'scryfall prices': datetime.timedelta(hours=1),
+}
+
+# Jobs whose sheet only follows the cached card data are skipped while that
+# data is still the version they last synced successfully. The price job
+# always runs: prices are looked up for rows that may have been edited.
+DAEMON_JOB_VERSIONS: dict[str, Callable[[], Optional[str]]] = {
+    'mtg': mtg_api.get_mtg_cards_version,
+    'scryfall': lambda: scryfall_api.load_scryfall_cache_info().get("updated_at"),
+}
+
+logger = logging.getLogger(__name__)
+
+
+class CardDaemon:
+    # Keeps what every run of the jobs used to set up again: the Sheets
+    # client, the mapped Scryfall card store and the MTG card store, which
+    # lookups read from.
+    def __init__(self, job_intervals: dict[str, datetime.timedelta] = DAEMON_JOB_INTERVALS,
+                 bulk_data_interval: datetime.timedelta = DAEMON_BULK_DATA_INTERVAL):
+        self.job_intervals: dict[str, datetime.timedelta] = job_intervals
+        self.bulk_data_interval: datetime.timedelta = bulk_data_interval
+        self.store: Optional[mapped_card_store.MappedCardStore] = None
+        # SQLite connections cannot be used by two threads at once.
+        self.mtg_conn: Optional[sqlite3.Connection] = None
+        self.mtg_version: Optional[str] = None
+        self.mtg_lock = threading.Lock()
+        self.sheet: Any = None
+        self.next_runs: dict[str, float] = {}
+        self.synced_versions: dict[str, Optional[str]] = {}
+        self.results: dict[str, JobResult] = {}
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        next_refresh: float = time.monotonic()
+        self.next_runs = {name: time.monotonic() for name in self.job_intervals}
+        while not self.stopped.is_set():
+            if time.monotonic() >= next_refresh:
+                self.refresh_card_data()
+                next_refresh = time.monotonic() + self.bulk_data_interval.total_seconds()
+            due: list[str] = [name for name, run_at in self.next_runs.items() if run_at <= time.monotonic()]
+            if due:
+                self.run_jobs(due)
+                for name in due:
+                    self.next_runs[name] = time.monotonic() + self.job_intervals[name].total_seconds()
+            wake_at: float = min([next_refresh, *self.next_runs.values()])
+            self.stopped.wait(max(0.0, wake_at - time.monotonic()))
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def refresh_card_data(self) -> None:
+        self.refresh_mtg_cards()
+        # A new store is only swapped in when the bulk data changed; lookups
+        # still holding the previous one keep reading its mapping, which is
+        # released once the last of them is done with it.
+        try:
+            store: mapped_card_store.MappedCardStore = scryfall_api.load_scryfall_mapped_card_store()
+        except Exception:
+            logger.exception("Refreshing the Scryfall cards failed")
+            return
+        if self.store is not None and store.version == self.store.version:
+            store.close()
+            return
+        self.store = store
+        logger.info("Serving %d Scryfall cards from bulk data of %s", len(store), store.version)
+
+    def refresh_mtg_cards(self) -> None:
+        # Only the MTG job crawls the cards; until it has, there is nothing to
+        # serve.
+        version: Optional[str] = mtg_api.get_mtg_cards_version()
+        if version is None or version == self.mtg_version:
+            return
+        try:
+            conn: sqlite3.Connection = mtg_api.load_mtg_card_store(check_same_thread=False)
+        except Exception:
+            logger.exception("Refreshing the MTG cards failed")
+            return
+        with self.mtg_lock:
+            previous: Optional[sqlite3.Connection] = self.mtg_conn
+            self.mtg_conn, self.mtg_version = conn, version
+        if previous is not None:
+            previous.close()
+        logger.info("Serving MTG cards crawled at %s", version)
+
+    def run_jobs(self, names: list[str]) -> None:
+        jobs: dict[str, Callable[[Any], None]] = {}
+        for name in names:
+            version: Optional[str] = get_job_version(name)
+            if version is not None and self.synced_versions.get(name) == version:
+                logger.info("Skipping job '%s': card data unchanged since %s", name, version)
+            else:
+                jobs[name] = MAIN_JOBS[name]
+        if not jobs:
+            return
+        try:
+            if self.sheet is None:
+                self.sheet = obtain_shared_sheet()
+        except Exception:
+            logger.exception("Obtaining the Sheets service failed")
+            return
+        for result in run_jobs_on_sheet(jobs, self.sheet):
+            logger.log(logging.INFO if result.succeeded else logging.ERROR, format_job_result(result))
+            self.results[result.name] = result
+            # Read after the run: a job that had to build the cache first has
+            # synced the cache it built.
+            if result.succeeded:
+                self.synced_versions[result.name] = get_job_version(result.name)
+        if 'mtg' in jobs:
+            self.refresh_mtg_cards()
+        logger.debug(http_client.format_retry_stats())
+
+    def lookup(self, card_info: CardInfo) -> Optional[dict]:
+        # Printings missing from the bulk data are answered from the price
+        # cache, which the price job fills from the Scryfall API; a lookup
+        # never makes a request itself.
+        store: Optional[mapped_card_store.MappedCardStore] = self.store
+        source: str = "bulk_data"
+        card: Optional[dict] = None
+        if store is not None:
+            card = scryfall_prices.find_card_in_card_store(store, card_info)
+        if card is None:
+            source = "price_cache"
+            _, card = price_cache.get_price_cache().get(f"card:{price_cache.card_info_key(card_info)}")
+        metrics.increment(f"daemon.lookups.{source if card else 'not_found'}")
+        if card is None:
+            return None
+        return dict(
+            set=card.get("set"),
+            collector_number=card.get("collector_number"),
+            lang=card.get("lang"),
+            foil=card_info.foil_type.name.lower(),
+            name=card.get("name"),
+            price=scryfall_prices.get_price_for_foil_type(scryfall_prices.get_prices_from_card(card),
+                                                          card_info.foil_type),
+            source=source,
+            version=None if store is None else store.version,
+            card=card,
+        )
+
+    def lookup_mtg(self, find: Callable[[sqlite3.Connection], list[dict]]) -> Optional[dict]:
+        with self.mtg_lock:
+            cards: list[dict] = [] if self.mtg_conn is None else find(self.mtg_conn)
+            version: Optional[str] = self.mtg_version
+        metrics.increment(f"daemon.mtg_lookups.{'found' if cards else 'not_found'}")
+        if not cards:
+            return None
+        return dict(version=version, cards=cards)
+
+    def get_status(self) -> dict:
+        return dict(
+            cards=None if self.store is None else len(self.store),
+            version=None if self.store is None else self.store.version,
+            mtg_version=self.mtg_version,
+            jobs={name: self.get_job_status(name) for name in self.job_intervals},
+        )
+
+    def get_job_status(self, name: str) -> dict:
+        status: dict = dict(synced_version=self.synced_versions.get(name), next_run_in_seconds=None)
+        if name in self.next_runs:
+            status["next_run_in_seconds"] = round(max(0.0, self.next_runs[name] - time.monotonic()), 1)
+        result: Optional[JobResult] = self.results.get(name)
+        if result is not None:
+            status.update(succeeded=result.succeeded, seconds=round(result.seconds, 3),
+                          error=None if result.error is None else repr(result.error))
+        return status
+
+    def close(self) -> None:
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        with self.mtg_lock:
+            if self.mtg_conn is not None:
+                self.mtg_conn.close()
+                self.mtg_conn = None
+
+
+class CardLookupServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], card_daemon: CardDaemon):
+        super().__init__(address, CardLookupHandler)
+        self.card_daemon: CardDaemon = card_daemon
+
+
+class CardLookupHandler(BaseHTTPRequestHandler):
+    server: CardLookupServer
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        parts: list[str] = [unquote(part) for part in url.path.strip('/').split('/')]
+        query: dict[str, list[str]] = parse_qs(url.query)
+        if url.path == '/status':
+            self.send_json(200, self.server.card_daemon.get_status())
+        elif len(parts) == 4 and parts[0] == 'cards':
+            try:
+                foil_type: FoilType = parse_foil_type(query.get('foil', ['none'])[0])
+            except ValueError as err:
+                self.send_json(400, dict(error=str(err)))
+                return
+            card_info: CardInfo = CardInfo('', parts[1], parts[2], parts[3], foil_type)
+            with metrics.stage("daemon.lookup"):
+                result: Optional[dict] = self.server.card_daemon.lookup(card_info)
+            if result is None:
+                self.send_json(404, dict(error=f"No card {parts[1]}/{parts[2]}/{parts[3]}"))
+            else:
+                self.send_json(200, result)
+        elif len(parts) == 4 and parts[:2] == ['mtg', 'cards']:
+            self.send_mtg_cards(lambda conn: list(filter(None, [mtg_api.find_mtg_card(conn, parts[2], parts[3])])),
+                                f"{parts[2]}/{parts[3]}")
+        elif len(parts) == 3 and parts[:2] == ['mtg', 'names']:
+            self.send_mtg_cards(lambda conn: mtg_api.find_mtg_cards_by_name(conn, parts[2]), f"named {parts[2]}")
+        elif len(parts) == 3 and parts[:2] == ['mtg', 'multiverse'] and parts[2].isdigit():
+            self.send_mtg_cards(lambda conn: mtg_api.find_mtg_cards_by_multiverse_id(conn, int(parts[2])),
+                                f"with multiverse id {parts[2]}")
+        else:
+            self.send_json(404, dict(error=f"Unknown path: {url.path}"))
+
+    def send_mtg_cards(self, find: Callable[[sqlite3.Connection], list[dict]], description: str) -> None:
+        with metrics.stage("daemon.mtg_lookup"):
+            result: Optional[dict] = self.server.card_daemon.lookup_mtg(find)
+        if result is None:
+            self.send_json(404, dict(error=f"No MTG card {description}"))
+        else:
+            self.send_json(200, result)
+
+    def send_json(self, status: int, body: dict) -> None:
+        data: bytes = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep the card data loaded, re-run the sheet jobs on a schedule and serve card lookups.")
+    parser.add_argument("--host", default=DAEMON_HOST)
+    parser.add_argument("--port", type=int, default=DAEMON_PORT)
+    parser.add_argument("--bulk-data-interval", type=float, metavar="MINUTES",
+                        default=DAEMON_BULK_DATA_INTERVAL.total_seconds() / 60)
+    parser.add_argument("--mtg-interval", type=float, metavar="MINUTES",
+                        default=DAEMON_JOB_INTERVALS['mtg'].total_seconds() / 60)
+    parser.add_argument("--scryfall-interval", type=float, metavar="MINUTES",
+                        default=DAEMON_JOB_INTERVALS['scryfall'].total_seconds() / 60)
+    parser.add_argument("--prices-interval", type=float, metavar="MINUTES",
+                        default=DAEMON_JOB_INTERVALS['scryfall prices'].total_seconds() / 60)
+    parser.add_argument(profiling.PROFILE_ARGUMENT, nargs="?", const=profiling.PROFILE_MODES,
+                        type=profiling.parse_profile_argument, metavar="cpu,memory",
+                        help="profile the daemon until it exits; see profiling")
+    args = parser.parse_args()
+    metrics.start_run()
+    if args.profile:
+        profiling.start_profiling(args.profile)
+    card_daemon: CardDaemon = CardDaemon(
+        {'mtg': datetime.timedelta(minutes=args.mtg_interval),
+         'scryfall': datetime.timedelta(minutes=args.scryfall_interval),
+         'scryfall prices': datetime.timedelta(minutes=args.prices_interval)},
+        datetime.timedelta(minutes=args.bulk_data_interval))
+    server: CardLookupServer = CardLookupServer((args.host, args.port), card_daemon)
+    threading.Thread(target=server.serve_forever, name='card-lookup-server', daemon=True).start()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: card_daemon.stop())
+    logger.info("Serving card lookups on http://%s:%d", *server.server_address[:2])
+    try:
+        card_daemon.run()
+    finally:
+        server.shutdown()
+        server.server_close()
+        card_daemon.close()
+    logger.info("Stopped")
+    return 0
+
+
+def parse_foil_type(value: str) -> FoilType:
+    # Accepts the enum names in any case as well as the sheet's spelling,
+    # e.g. "gold_stamp" or "Gold Stamp".
+    try:
+        return FoilType[value.strip().upper().replace(' ', '_')]
+    except KeyError:
+        raise ValueError(f"Unknown foil type: {value}") from None
+
+
+def get_job_version(name: str) -> Optional[str]:
+    return DAEMON_JOB_VERSIONS[name]() if name in DAEMON_JOB_VERSIONS else None
+
+
+if __name__ == "__main__":
+    sys.exit(main())
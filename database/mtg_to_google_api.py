@@ -1,15 +1,19 @@
-import sheets_range
+import column_extractors
+import card_records
+import sheets_writer
+import sheets_sync
+import http_client
 import google_api
-import datetime
+import profiling
+import logging
+import metrics
 import mtg_api
 import util
 import sys
 
 from google.oauth2.credentials import Credentials
 from googleapiclient.errors import HttpError
-from sheets_range import SheetsRange
-from collections import OrderedDict
-from typing import Any
+from typing import Any, Iterable, Iterator
 
 # The ID of the target spreadsheet.
 GOOGLE_SPREADSHEET_ID = '1c9XOUGjgSvjcJ_dOG1nCdsLlAP5YFavsFhzEPJIhaKI'
@@ -20,6 +24,7 @@ GOOGLE_SPREADSHEET_HEADER_COL_START = util.number_to_column_letter(GOOGLE_SPREAD
 
 GOOGLE_SPREADSHEET_RANGE_HEADER = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!{GOOGLE_SPREADSHEET_HEADER_COL_START}1:1'
 GOOGLE_SPREADSHEET_RANGE_ALL_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!A2:Z'
+GOOGLE_SPREADSHEET_RANGE_CARD_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!{GOOGLE_SPREADSHEET_HEADER_COL_START}2:Z'
 GOOGLE_SPREADSHEET_CELL_TIMESTAMP = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!A2'
 GOOGLE_SPREADSHEET_SELECT_COLUMN_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!' + '{0}2:{0}'
 
@@ -30,94 +35,104 @@ GOOGLE_SPREADSHEET_SELECT_COLUMN_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!' + '{
 # {3} - Row End
 GOOGLE_SPREADSHEET_SELECT_RANGE_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!' + '{0}{2}:{1}{3}'
 
+# Write only the cells that differ from what the sheet already holds instead
+# of clearing the sheet and rewriting every row.
+GOOGLE_SPREADSHEET_DIFF_SYNC = True
+
+logger = logging.getLogger(__name__)
+
+# Header values whose cells are computed from the card rather than read from
+# the attribute of the same name.
+MTG_DERIVED_COLUMNS: dict[str, column_extractors.Extractor] = {}
+
+# Which printing of a card name ends up in the sheet; see card_records for
+# the other policies.
+MTG_PRINTING_POLICY = card_records.prefer_last_with_image("imageUrl")
+
 
 def main():
+    metrics.start_run()
+    profiling.start_profiling_if_requested()
     update_spreadsheet_with_mtg_data()
+    logger.info(http_client.format_retry_stats())
 
 
 def update_spreadsheet_with_mtg_data() -> None:
-    mtg_cards: list = mtg_api.load_all_mtg_cards()
-    mtg_cards: list = process_mtg_cards(mtg_cards)
-    creds: Credentials = google_api.obtain_google_api_credentials()
     try:
-        sheet = google_api.obtain_google_api_service(creds)
-        print(clear_all_data_in_sheet(sheet))
-        print(update_refresh_timestamp(sheet))
-        columns: list[tuple[str, str]] = obtain_target_columns(sheet)
-        print(columns)
-        update_all_ranges_with_mtg_data(sheet, mtg_cards, columns)
+        with metrics.stage("auth"):
+            creds: Credentials = google_api.obtain_google_api_credentials()
+            sheet = google_api.obtain_google_api_service(creds)
+        sync_spreadsheet_with_mtg_data(sheet)
     except HttpError as err:
-        print(err)
+        logger.error("Sheets request failed: %s", err)
+
+
+def sync_spreadsheet_with_mtg_data(sheet: Any) -> None:
+    writer = sheets_writer.SheetsWriter(sheet, GOOGLE_SPREADSHEET_ID)
+    with metrics.stage("mtg.header_fetch"):
+        header_values, current_values = writer.batch_get(
+            [GOOGLE_SPREADSHEET_RANGE_HEADER, GOOGLE_SPREADSHEET_RANGE_CARD_DATA])
+    columns: list[tuple[str, str]] = obtain_target_columns(header_values)
+    logger.debug("Sheet columns: %s", columns)
+    mtg_cards: list[card_records.CardRecord] = load_mtg_card_records(columns)
+    if not GOOGLE_SPREADSHEET_DIFF_SYNC:
+        clear_all_data_in_sheet(writer)
+    update_refresh_timestamp(writer)
+    if GOOGLE_SPREADSHEET_DIFF_SYNC:
+        sync_all_ranges_with_mtg_data(writer, mtg_cards, columns, current_values)
+    else:
+        update_all_ranges_with_mtg_data(writer, mtg_cards)
+    with metrics.stage("mtg.upload"):
+        responses: list[Any] = writer.flush()
+    logger.debug("Sheets responses: %s", responses)
+    logger.info(writer.format_stats())
+
+
+def load_mtg_card_records(columns: list[tuple[str, str]]) -> list[card_records.CardRecord]:
+    extractors: tuple[column_extractors.Extractor, ...] = column_extractors.compile_column_extractors(
+        [attr for attr, _ in columns], MTG_DERIVED_COLUMNS)
+    with metrics.stage("mtg.load"):
+        cards: list = mtg_api.load_all_mtg_cards()
+    profiling.snapshot("mtg.load_all_mtg_cards")
+    with metrics.stage("mtg.dedup"):
+        mtg_cards: list[card_records.CardRecord] = process_mtg_cards(cards, extractors)
+    profiling.snapshot("mtg.process_mtg_cards")
+    return mtg_cards
+
+
+def process_mtg_cards(
+        cards: Iterable[dict], extractors: tuple[column_extractors.Extractor, ...]) -> list[card_records.CardRecord]:
+    return card_records.collect_card_records(cards, extractors, "name", MTG_PRINTING_POLICY)
+
+
+def sync_all_ranges_with_mtg_data(
+        writer: sheets_writer.SheetsWriter, mtg_cards: list[card_records.CardRecord],
+        columns: list[tuple[str, str]], current_values: list[list[Any]]) -> None:
+    with metrics.stage("mtg.build"):
+        rows: list[list[str]] = build_rows_from_mtg_data(mtg_cards)
+        col_start: int = GOOGLE_SPREADSHEET_HEADER_COL_OFFSET
+        sheets_sync.sync_values(writer, GOOGLE_SPREADSHEET_SHEET_NAME,
+                                col_start, col_start + len(columns) - 1, 2, current_values, rows)
 
 
-def process_mtg_cards(cards: list) -> list:
-    cards_by_name: OrderedDict[str, dict] = OrderedDict()
-
-    def __sort_by_name(card_: dict) -> str:
-        return card_["name"]
-    cards_sorted: list = sorted(cards, key=__sort_by_name)
+def update_all_ranges_with_mtg_data(
+        writer: sheets_writer.SheetsWriter, mtg_cards: list[card_records.CardRecord]) -> None:
+    # Rows are built lazily and uploaded piece by piece while the next piece
+    # is being built, so building and uploading are timed as one stage.
+    rows: Iterator[list[str]] = iterate_rows_from_mtg_data(mtg_cards)
+    with metrics.stage("mtg.upload"):
+        piece_count: int = writer.stream_rows(
+            GOOGLE_SPREADSHEET_SHEET_NAME, GOOGLE_SPREADSHEET_HEADER_COL_OFFSET, 2, rows)
+    logger.info("Uploaded %d rows in %d requests", len(mtg_cards), piece_count)
 
-    for card in cards_sorted:
-        card_name = card["name"]
-        if card_name not in cards_by_name or card.get("imageUrl") is not None:
-            cards_by_name[card_name] = card
 
-    def __map_mtg_cards(card_: dict):
-        return dict(card_.items())
-    return list(map(__map_mtg_cards, cards_by_name.values()))
+def build_rows_from_mtg_data(mtg_cards: list[card_records.CardRecord]) -> list[list[str]]:
+    return list(iterate_rows_from_mtg_data(mtg_cards))
 
 
-def update_all_ranges_with_mtg_data(
-        sheet: Any, mtg_cards: list, columns: list[tuple[str, str]]) -> None:
-    rows_chunk_count: int = 100_000
-    row_start: int = 2
-    target_range = sheets_range.range_from_integers(1, 8, row_start, row_start + rows_chunk_count)
-    populating: bool = True
-    while populating:
-        populating = update_one_range_with_mtg_data(sheet, mtg_cards, columns, target_range)
-        target_range = SheetsRange(
-            target_range.col_start,
-            target_range.col_end,
-            target_range.row_start + rows_chunk_count,
-            target_range.row_end + rows_chunk_count
-        )
-
-
-def update_one_range_with_mtg_data(
-        sheet: Any, mtg_cards: list, columns: list[tuple[str, str]], target_range: SheetsRange) -> bool:
-    populating: bool = False
-    cols: list[list[str]] = []
-    for attr, _ in columns:
-        col: list[str] = []
-        for card in mtg_cards[target_range.row_start:target_range.row_end]:
-            populating = True
-            value: str = get_attribute_from_card(card, attr)
-            col.append(value)
-        cols.append(col)
-    if populating:
-        print(update_range_with_data(sheet, target_range, cols, major_dimension="COLUMNS"))
-    return populating
-
-
-def get_attribute_from_card(card: dict, attr: str) -> str:
-    value = card.get(attr)
-    if type(value) is list:
-        value: str = value[0]
-    return value
-
-
-def update_range_with_data(
-        sheet: Any, range_: SheetsRange, data: list[list[str]], major_dimension: str = "ROWS") -> Any:
-    column_range = GOOGLE_SPREADSHEET_SELECT_RANGE_DATA.format(
-        range_.col_start, range_.col_end, range_.row_start, range_.row_end)
-    result = sheet.values().update(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                   range=column_range,
-                                   valueInputOption='RAW',
-                                   body=dict(
-                                       majorDimension=major_dimension,
-                                       values=data
-                                   )).execute()
-    return result
+def iterate_rows_from_mtg_data(mtg_cards: Iterable[card_records.CardRecord]) -> Iterator[list[str]]:
+    for card in mtg_cards:
+        yield list(card.values)
 
 
 # def update_all_columns_with_mtg_data(sheet: Any, mtg_cards: list, columns: list[tuple[str, str]]) -> None:
@@ -143,30 +158,17 @@ def update_range_with_data(
 #     return result
 
 
-def update_refresh_timestamp(sheet: Any) -> Any:
-    result = sheet.values().update(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                   range=GOOGLE_SPREADSHEET_CELL_TIMESTAMP,
-                                   valueInputOption='RAW',
-                                   body=dict(
-                                       majorDimension='ROWS',
-                                       values=[[str(datetime.datetime.now())]]
-                                   )).execute()
-    return result
+def update_refresh_timestamp(writer: sheets_writer.SheetsWriter) -> None:
+    writer.update(GOOGLE_SPREADSHEET_CELL_TIMESTAMP, sheets_writer.refresh_timestamp_values())
 
 
-def clear_all_data_in_sheet(sheet: Any) -> Any:
-    result = sheet.values().clear(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                  range=GOOGLE_SPREADSHEET_RANGE_ALL_DATA).execute()
-    return result
+def clear_all_data_in_sheet(writer: sheets_writer.SheetsWriter) -> None:
+    writer.clear(GOOGLE_SPREADSHEET_RANGE_ALL_DATA)
 
 
-def obtain_target_columns(sheet: Any) -> list[tuple[str, str]]:
-    result = sheet.values().get(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                range=GOOGLE_SPREADSHEET_RANGE_HEADER).execute()
-    header = result.get('values', [])[0]
-    return [(value, util.number_to_column_letter(col))
-            for col, value in
-            enumerate(header, start=GOOGLE_SPREADSHEET_HEADER_COL_OFFSET)]
+def obtain_target_columns(header_values: list[list[str]]) -> list[tuple[str, str]]:
+    return sheets_writer.columns_from_header(
+        sheets_writer.first_row(header_values), GOOGLE_SPREADSHEET_HEADER_COL_OFFSET)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,19 @@
-import sheets_range
+import column_extractors
+import card_records
+import sheets_writer
+import sheets_sync
 import scryfall_api
+import http_client
 import google_api
-import datetime
+import profiling
+import logging
+import metrics
 import util
 import sys
 
 from google.oauth2.credentials import Credentials
 from googleapiclient.errors import HttpError
-from sheets_range import SheetsRange
-from collections import OrderedDict
-from typing import Any, Optional
+from typing import Any, Iterable, Iterator, Optional
 
 # The ID of the target spreadsheet.
 GOOGLE_SPREADSHEET_ID = '1c9XOUGjgSvjcJ_dOG1nCdsLlAP5YFavsFhzEPJIhaKI'
@@ -20,6 +24,7 @@ GOOGLE_SPREADSHEET_HEADER_COL_START = util.number_to_column_letter(GOOGLE_SPREAD
 
 GOOGLE_SPREADSHEET_RANGE_HEADER = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!{GOOGLE_SPREADSHEET_HEADER_COL_START}1:1'
 GOOGLE_SPREADSHEET_RANGE_ALL_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!A2:Z'
+GOOGLE_SPREADSHEET_RANGE_CARD_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!{GOOGLE_SPREADSHEET_HEADER_COL_START}2:Z'
 GOOGLE_SPREADSHEET_CELL_TIMESTAMP = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!A2'
 GOOGLE_SPREADSHEET_SELECT_COLUMN_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!' + '{0}2:{0}'
 
@@ -30,76 +35,128 @@ GOOGLE_SPREADSHEET_SELECT_COLUMN_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!' + '{
 # {3} - Row End
 GOOGLE_SPREADSHEET_SELECT_RANGE_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!' + '{0}{2}:{1}{3}'
 
+# Write only the cells that differ from what the sheet already holds instead
+# of clearing the sheet and rewriting every row.
+GOOGLE_SPREADSHEET_DIFF_SYNC = True
+
+logger = logging.getLogger(__name__)
+
+# Header values whose cells are computed from the card rather than read from
+# the attribute of the same name; see the derived_column functions below.
+SCRYFALL_DERIVED_COLUMNS: dict[str, column_extractors.Extractor] = {}
+
+# Which printing of a card name ends up in the sheet. Other policies can be
+# built from card_records, e.g. the newest English non-promo printing:
+# combine_policies(prefer_non_promo("promo"), prefer_language("lang", "en"),
+#                  prefer_newest("released_at"), prefer_first())
+SCRYFALL_PRINTING_POLICY = card_records.prefer_last_with_image(scryfall_api.SCRYFALL_CARD_ATTR_IMAGE_URIS)
+
 
 def main():
+    metrics.start_run()
+    profiling.start_profiling_if_requested()
     update_spreadsheet_with_scryfall_data()
+    logger.info(http_client.format_retry_stats())
 
 
 def update_spreadsheet_with_scryfall_data() -> None:
-    scryfall_cards: list = scryfall_api.load_all_scryfall_cards()
-    scryfall_cards: list = process_scryfall_cards(scryfall_cards)
-    creds: Credentials = google_api.obtain_google_api_credentials()
     try:
-        sheet = google_api.obtain_google_api_service(creds)
-        print(clear_all_data_in_sheet(sheet))
-        print(update_refresh_timestamp(sheet))
-        columns: list[tuple[str, str]] = obtain_target_columns(sheet)
-        print(columns)
-        update_all_ranges_with_scryfall_data(sheet, scryfall_cards, columns)
+        with metrics.stage("auth"):
+            creds: Credentials = google_api.obtain_google_api_credentials()
+            sheet = google_api.obtain_google_api_service(creds)
+        sync_spreadsheet_with_scryfall_data(sheet)
     except HttpError as err:
-        print(err)
+        logger.error("Sheets request failed: %s", err)
+
+
+def sync_spreadsheet_with_scryfall_data(sheet: Any) -> None:
+    writer = sheets_writer.SheetsWriter(sheet, GOOGLE_SPREADSHEET_ID)
+    with metrics.stage("scryfall.header_fetch"):
+        header_values, current_values = writer.batch_get(
+            [GOOGLE_SPREADSHEET_RANGE_HEADER, GOOGLE_SPREADSHEET_RANGE_CARD_DATA])
+    columns: list[tuple[str, str]] = obtain_target_columns(header_values)
+    logger.debug("Sheet columns: %s", columns)
+    scryfall_cards: list[card_records.CardRecord] = load_scryfall_card_records(columns)
+    if not GOOGLE_SPREADSHEET_DIFF_SYNC:
+        clear_all_data_in_sheet(writer)
+    update_refresh_timestamp(writer)
+    if GOOGLE_SPREADSHEET_DIFF_SYNC:
+        sync_all_ranges_with_scryfall_data(writer, scryfall_cards, columns, current_values)
+    else:
+        update_all_ranges_with_scryfall_data(writer, scryfall_cards)
+    with metrics.stage("scryfall.upload"):
+        responses: list[Any] = writer.flush()
+    logger.debug("Sheets responses: %s", responses)
+    logger.info(writer.format_stats())
+
+
+def load_scryfall_card_records(columns: list[tuple[str, str]]) -> list[card_records.CardRecord]:
+    # The header is read before the cards so that only its columns are kept
+    # of each card while streaming through the cached printings.
+    extractors: tuple[column_extractors.Extractor, ...] = column_extractors.compile_column_extractors(
+        [attr for attr, _ in columns], SCRYFALL_DERIVED_COLUMNS)
+    # The cards are read from the cache while they are deduplicated, so the
+    # time spent reading them is taken out of the dedup stage.
+    cards: metrics.TimedIterator = metrics.TimedIterator(scryfall_api.load_all_scryfall_cards())
+    profiling.snapshot("scryfall.load_all_scryfall_cards")
+    with metrics.stage("scryfall.dedup") as dedup_stage:
+        scryfall_cards: list[card_records.CardRecord] = process_scryfall_cards(cards, extractors)
+        dedup_stage.exclude(cards.seconds)
+    profiling.snapshot("scryfall.process_scryfall_cards")
+    metrics.record_stage("scryfall.load", cards.seconds)
+    return scryfall_cards
+
+
+def process_scryfall_cards(
+        cards: Iterable[dict], extractors: tuple[column_extractors.Extractor, ...]) -> list[card_records.CardRecord]:
+    return card_records.collect_card_records(
+        cards, extractors, scryfall_api.SCRYFALL_CARD_ATTR_NAME, SCRYFALL_PRINTING_POLICY)
+
+
+def sync_all_ranges_with_scryfall_data(
+        writer: sheets_writer.SheetsWriter, scryfall_cards: list[card_records.CardRecord],
+        columns: list[tuple[str, str]], current_values: list[list[Any]]) -> None:
+    with metrics.stage("scryfall.build"):
+        rows: list[list[str]] = build_rows_from_scryfall_data(scryfall_cards)
+        col_start: int = GOOGLE_SPREADSHEET_HEADER_COL_OFFSET
+        sheets_sync.sync_values(writer, GOOGLE_SPREADSHEET_SHEET_NAME,
+                                col_start, col_start + len(columns) - 1, 2, current_values, rows)
 
 
-def process_scryfall_cards(cards: list) -> list:
-    cards_by_name: OrderedDict[str, dict] = OrderedDict()
+def update_all_ranges_with_scryfall_data(
+        writer: sheets_writer.SheetsWriter, scryfall_cards: list[card_records.CardRecord]) -> None:
+    # Rows are built lazily and uploaded piece by piece while the next piece
+    # is being built, so building and uploading are timed as one stage.
+    rows: Iterator[list[str]] = iterate_rows_from_scryfall_data(scryfall_cards)
+    with metrics.stage("scryfall.upload"):
+        piece_count: int = writer.stream_rows(
+            GOOGLE_SPREADSHEET_SHEET_NAME, GOOGLE_SPREADSHEET_HEADER_COL_OFFSET, 2, rows)
+    logger.info("Uploaded %d rows in %d requests", len(scryfall_cards), piece_count)
 
-    def __sort_by_name(card_: dict) -> str:
-        return card_[scryfall_api.SCRYFALL_CARD_ATTR_NAME]
-    cards_sorted: list = sorted(cards, key=__sort_by_name)
 
-    for card in cards_sorted:
-        card_name = card["name"]
-        if card_name not in cards_by_name or card.get(scryfall_api.SCRYFALL_CARD_ATTR_IMAGE_URIS) is not None:
-            cards_by_name[card_name] = card
+def build_rows_from_scryfall_data(scryfall_cards: list[card_records.CardRecord]) -> list[list[str]]:
+    return list(iterate_rows_from_scryfall_data(scryfall_cards))
 
-    def __map_mtg_cards(card_: dict):
-        return dict(card_.items())
-    return list(map(__map_mtg_cards, cards_by_name.values()))
 
+def iterate_rows_from_scryfall_data(scryfall_cards: Iterable[card_records.CardRecord]) -> Iterator[list[str]]:
+    # The cells were extracted when the cards were projected.
+    for card in scryfall_cards:
+        yield list(card.values)
 
-def update_all_ranges_with_scryfall_data(
-        sheet: Any, scryfall_cards: list, columns: list[tuple[str, str]]) -> None:
-    rows_chunk_count: int = 100_000
-    row_start: int = 2
-    target_range = sheets_range.range_from_integers(1, 8, row_start, row_start + rows_chunk_count)
-    populating: bool = True
-    while populating:
-        populating = update_one_range_with_scryfall_data(sheet, scryfall_cards, columns, target_range)
-        target_range = SheetsRange(
-            target_range.col_start,
-            target_range.col_end,
-            target_range.row_start + rows_chunk_count,
-            target_range.row_end + rows_chunk_count
-        )
-
-
-def update_one_range_with_scryfall_data(
-        sheet: Any, scryfall_cards: list, columns: list[tuple[str, str]], target_range: SheetsRange) -> bool:
-    populating: bool = False
-    cols: list[list[str]] = []
-    for attr, _ in columns:
-        col: list[str] = []
-        for card in scryfall_cards[target_range.row_start:target_range.row_end]:
-            populating = True
-            value: str = get_attribute_from_card(card, attr)
-            col.append(value)
-        cols.append(col)
-    if populating:
-        print(update_range_with_data(sheet, target_range, cols, major_dimension="COLUMNS"))
-    return populating
+
+@column_extractors.derived_column(SCRYFALL_DERIVED_COLUMNS, scryfall_api.SCRYFALL_CARD_ATTR_IMAGE_URIS)
+def extract_normal_image_uri(card: dict) -> Optional[str]:
+    return scryfall_api.find_normal_image_uri_in_card(card)
+
+
+@column_extractors.derived_column(SCRYFALL_DERIVED_COLUMNS, "type_line")
+def extract_primary_type(card: dict) -> Optional[str]:
+    return parse_primary_type_from_type_line(card.get("type_line"))
 
 
 def get_attribute_from_card(card: dict, attr: str) -> Optional[str]:
+    # Per-cell equivalent of the compiled extractors, kept as the reference
+    # for benchmarks.sheet_rows.
     value: Optional[str] = card.get(attr)
     if attr == scryfall_api.SCRYFALL_CARD_ATTR_IMAGE_URIS:
         value = scryfall_api.find_normal_image_uri_in_card(card)
@@ -122,44 +179,17 @@ def parse_primary_type_from_type_line(type_line: Optional[str]) -> Optional[str]
     return primary_type
 
 
-def update_range_with_data(
-        sheet: Any, range_: SheetsRange, data: list[list[str]], major_dimension: str = "ROWS") -> Any:
-    column_range = GOOGLE_SPREADSHEET_SELECT_RANGE_DATA.format(
-        range_.col_start, range_.col_end, range_.row_start, range_.row_end)
-    result = sheet.values().update(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                   range=column_range,
-                                   valueInputOption='RAW',
-                                   body=dict(
-                                       majorDimension=major_dimension,
-                                       values=data
-                                   )).execute()
-    return result
-
-
-def update_refresh_timestamp(sheet: Any) -> Any:
-    result = sheet.values().update(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                   range=GOOGLE_SPREADSHEET_CELL_TIMESTAMP,
-                                   valueInputOption='RAW',
-                                   body=dict(
-                                       majorDimension='ROWS',
-                                       values=[[str(datetime.datetime.now())]]
-                                   )).execute()
-    return result
-
-
-def clear_all_data_in_sheet(sheet: Any) -> Any:
-    result = sheet.values().clear(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                  range=GOOGLE_SPREADSHEET_RANGE_ALL_DATA).execute()
-    return result
-
-
-def obtain_target_columns(sheet: Any) -> list[tuple[str, str]]:
-    result = sheet.values().get(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                range=GOOGLE_SPREADSHEET_RANGE_HEADER).execute()
-    header = result.get('values', [])[0]
-    return [(value, util.number_to_column_letter(col))
-            for col, value in
-            enumerate(header, start=GOOGLE_SPREADSHEET_HEADER_COL_OFFSET)]
+def update_refresh_timestamp(writer: sheets_writer.SheetsWriter) -> None:
+    writer.update(GOOGLE_SPREADSHEET_CELL_TIMESTAMP, sheets_writer.refresh_timestamp_values())
+
+
+def clear_all_data_in_sheet(writer: sheets_writer.SheetsWriter) -> None:
+    writer.clear(GOOGLE_SPREADSHEET_RANGE_ALL_DATA)
+
+
+def obtain_target_columns(header_values: list[list[str]]) -> list[tuple[str, str]]:
+    return sheets_writer.columns_from_header(
+        sheets_writer.first_row(header_values), GOOGLE_SPREADSHEET_HEADER_COL_OFFSET)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,17 @@
+import http_client
+import functools
+import httplib2
 import pprint
 import json
 import sys
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import HttpRequest
 from pathlib import Path
 from typing import Any, Optional
 
@@ -15,17 +21,43 @@ GOOGLE_API_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 GOOGLE_API_TOKEN = Path('token.json')
 GOOGLE_API_CREDENTIALS = Path('credentials.json')
 
+GOOGLE_API_SERVICE_NAME = 'sheets'
+GOOGLE_API_SERVICE_VERSION = 'v4'
+GOOGLE_API_DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+
 
 def main():
     creds: Credentials = obtain_google_api_credentials()
     pprint.pprint(json.loads(creds.to_json()))
 
 
-def obtain_google_api_service(creds: Credentials) -> Any:
-    service = build('sheets', 'v4', credentials=creds)
+def obtain_google_api_service(creds: Credentials, thread_safe: bool = False) -> Any:
+    document: str = obtain_google_api_discovery_document()
+    if not thread_safe:
+        service = build_from_document(document, credentials=creds)
+        return service.spreadsheets()
+
+    # httplib2 connections must not be shared between threads, so a service
+    # used from several threads gives every request its own connection.
+    def __build_request(http: Any, *args, **kwargs) -> HttpRequest:
+        return HttpRequest(AuthorizedHttp(creds, http=httplib2.Http()), *args, **kwargs)
+    service = build_from_document(document, requestBuilder=__build_request,
+                                  http=AuthorizedHttp(creds, http=httplib2.Http()))
     return service.spreadsheets()
 
 
+@functools.cache
+def obtain_google_api_discovery_document() -> str:
+    # The Sheets discovery document ships with the client library; it is read
+    # once per process and only fetched when the bundled copy is missing.
+    document: Optional[str] = discovery_cache.get_static_doc(GOOGLE_API_SERVICE_NAME, GOOGLE_API_SERVICE_VERSION)
+    if document is None:
+        resp = http_client.get(GOOGLE_API_DISCOVERY_URL)
+        resp.raise_for_status()
+        document = resp.text
+    return document
+
+
 def obtain_google_api_credentials() -> Credentials:
     creds: Optional[Credentials] = None
     # The file GOOGLE_API_TOKEN stores the user's access and refresh tokens, and is
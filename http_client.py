@@ -0,0 +1,289 @@
+import email.utils
+import itertools
+import threading
+import requests
+import metrics
+import logging
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from requests import Response
+from requests.adapters import HTTPAdapter
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+HTTP_POOL_SIZE = 16
+# Threads available to map_concurrently; how many of them have a request in
+# flight to the same host at once is decided by that host's
+# ConcurrencyController.
+HTTP_MAX_WORKERS = HTTP_POOL_SIZE
+
+# Requests per second allowed for each API host. Scryfall asks for 50-100 ms
+# between requests; the MTG API allows 5000 requests per hour. Hosts that are
+# not listed (such as Scryfall's bulk file host) are not throttled.
+HTTP_RATE_LIMITS = {
+    'api.scryfall.com': 10.0,
+    'api.magicthegathering.io': 5000 / 3600,
+}
+
+# AIMD bounds for the number of requests in flight per host: every request
+# answered normally adds 1/limit (so about one more slot per round of
+# requests), while throttling halves the limit, at most once per interval
+# so that the requests already in flight do not collapse it to the minimum.
+HTTP_CONCURRENCY_INITIAL = 4
+HTTP_CONCURRENCY_MIN = 1
+HTTP_CONCURRENCY_MAX = HTTP_POOL_SIZE
+HTTP_CONCURRENCY_DECREASE_FACTOR = 0.5
+HTTP_CONCURRENCY_DECREASE_INTERVAL = 1.0
+
+# Statuses that mean the server is shedding load; they shrink the
+# concurrency of the host as well as being retried.
+HTTP_THROTTLE_STATUSES = frozenset({429, 503})
+HTTP_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    # Token bucket: tokens refill continuously at `rate` per second up to
+    # `capacity`, and every request takes one token, waiting if none is left.
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate: float = rate
+        self.capacity: float = capacity if capacity is not None else max(1.0, rate)
+        self.tokens: float = self.capacity
+        self.updated_at: float = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now: float = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait: float = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ConcurrencyController:
+    # Additive-increase/multiplicative-decrease limit on the requests in
+    # flight to one host, plus a pause that holds back every request to the
+    # host when the server asks for it with Retry-After.
+    def __init__(self, limit: float = HTTP_CONCURRENCY_INITIAL,
+                 min_limit: float = HTTP_CONCURRENCY_MIN, max_limit: float = HTTP_CONCURRENCY_MAX):
+        self.limit: float = limit
+        self.min_limit: float = min_limit
+        self.max_limit: float = max_limit
+        self.in_flight: int = 0
+        self.paused_until: float = 0.0
+        self.decreased_at: float = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while True:
+                wait: float = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self.condition.wait(wait if wait > 0 else None)
+
+    def release(self, throttled: bool) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            now: float = time.monotonic()
+            if not throttled:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif now - self.decreased_at >= HTTP_CONCURRENCY_DECREASE_INTERVAL:
+                self.limit = max(self.min_limit, self.limit * HTTP_CONCURRENCY_DECREASE_FACTOR)
+                self.decreased_at = now
+            self.condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RetryPolicy(NamedTuple):
+    # Exponential backoff with full jitter: the n-th retry waits a random time
+    # between 0 and min(max_delay, base_delay * 2 ** n), or what the server
+    # asked for with Retry-After (up to max_retry_after) plus a little jitter.
+    max_retries: int = 5
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    max_retry_after: float = 300.0
+
+    def get_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+HTTP_RETRY_POLICY = RetryPolicy()
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests: int = 0
+        self.retries: int = 0
+        self.throttled: int = 0
+        self.failures: int = 0
+
+
+__session: Optional[requests.Session] = None
+__session_lock = threading.Lock()
+__rate_limiters: dict[str, RateLimiter] = {}
+__concurrency_controllers: dict[str, ConcurrencyController] = {}
+__endpoint_stats: dict[str, EndpointStats] = {}
+
+
+def get_session() -> requests.Session:
+    # One session for the whole process so that connections are pooled and
+    # kept alive across requests instead of repeating the TCP/TLS handshake.
+    global __session
+    with __session_lock:
+        if __session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            __session = session
+        return __session
+
+
+def get_rate_limiter(url: str) -> Optional[RateLimiter]:
+    host: str = urlsplit(url).hostname or ''
+    with __session_lock:
+        if host not in __rate_limiters and host in HTTP_RATE_LIMITS:
+            __rate_limiters[host] = RateLimiter(HTTP_RATE_LIMITS[host])
+        return __rate_limiters.get(host)
+
+
+def get_concurrency_controller(host: str) -> ConcurrencyController:
+    with __session_lock:
+        if host not in __concurrency_controllers:
+            __concurrency_controllers[host] = ConcurrencyController()
+        return __concurrency_controllers[host]
+
+
+def get_endpoint_name(url: str) -> str:
+    # Host and path without the query, e.g. "api.scryfall.com/cards/search".
+    # Callers whose paths embed identifiers pass the URL template instead.
+    parts = urlsplit(url)
+    return f"{parts.hostname or ''}{parts.path}"
+
+
+def record_endpoint_stats(endpoint: str, requests_: int = 0, retries: int = 0,
+                          throttled: int = 0, failures: int = 0) -> None:
+    with __session_lock:
+        if endpoint not in __endpoint_stats:
+            __endpoint_stats[endpoint] = EndpointStats()
+        stats: EndpointStats = __endpoint_stats[endpoint]
+        stats.requests += requests_
+        stats.retries += retries
+        stats.throttled += throttled
+        stats.failures += failures
+    for name, amount in (("retries", retries), ("throttled", throttled), ("failures", failures)):
+        if amount:
+            metrics.increment(f"http.{name}.{endpoint}", amount)
+
+
+def format_retry_stats() -> str:
+    with __session_lock:
+        lines: list[str] = [f"{endpoint}: {stats.requests} requests, {stats.retries} retries, "
+                            f"{stats.throttled} throttled, {stats.failures} failed"
+                            for endpoint, stats in sorted(__endpoint_stats.items())]
+        lines.extend(f"{host}: concurrency limit {controller.limit:.1f}"
+                     for host, controller in sorted(__concurrency_controllers.items()))
+    return '\n'.join(["HTTP retries:"] + lines)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Either a number of seconds or an HTTP date.
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def request(method: str, url: str, endpoint: Optional[str] = None,
+            policy: RetryPolicy = HTTP_RETRY_POLICY, **kwargs) -> Response:
+    # Throttled (429/503) and failed (5xx) responses as well as connection
+    # errors are retried with backoff; once the retries run out the last
+    # response is returned, or the last error raised, like without retries.
+    host: str = urlsplit(url).hostname or ''
+    endpoint_name: str = get_endpoint_name(endpoint or url)
+    controller: ConcurrencyController = get_concurrency_controller(host)
+    for attempt in itertools.count():
+        rate_limiter: Optional[RateLimiter] = get_rate_limiter(url)
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        controller.acquire()
+        retry_after: Optional[float] = None
+        try:
+            response: Response = send_request(method, url, host, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            controller.release(throttled=True)
+            record_endpoint_stats(endpoint_name, requests_=1)
+            if attempt >= policy.max_retries:
+                record_endpoint_stats(endpoint_name, failures=1)
+                raise
+            reason: str = type(err).__name__
+        else:
+            throttled: bool = response.status_code in HTTP_THROTTLE_STATUSES
+            controller.release(throttled)
+            record_endpoint_stats(endpoint_name, requests_=1, throttled=int(throttled))
+            if response.status_code not in HTTP_RETRY_STATUSES:
+                return response
+            if attempt >= policy.max_retries:
+                record_endpoint_stats(endpoint_name, failures=1)
+                return response
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                controller.pause(retry_after)
+            reason: str = str(response.status_code)
+            response.close()
+        delay: float = policy.get_delay(attempt, retry_after)
+        record_endpoint_stats(endpoint_name, retries=1)
+        logger.warning("%s %s failed with %s, retry %d of %d in %.1fs",
+                       method, url, reason, attempt + 1, policy.max_retries, delay)
+        time.sleep(delay)
+
+
+def send_request(method: str, url: str, host: str, **kwargs) -> Response:
+    started_at: float = time.perf_counter()
+    response: Response = get_session().request(method, url, **kwargs)
+    seconds: float = time.perf_counter() - started_at
+    # Streamed bodies have not been read yet, so they are counted by their
+    # announced length instead.
+    size: int = int(response.headers.get('Content-Length') or 0) if kwargs.get('stream') else len(response.content)
+    metrics.record_stage(f"http.{host}", seconds)
+    metrics.increment(f"http.requests.{host}")
+    metrics.increment(f"http.bytes_received.{host}", size)
+    if response.status_code >= 400:
+        metrics.increment(f"http.errors.{host}")
+    logger.debug("%s %s %s (%d bytes, %.3fs)", method, response.status_code, response.url, size, seconds)
+    return response
+
+
+def get(url: str, **kwargs) -> Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> Response:
+    return request('POST', url, **kwargs)
+
+
+def map_concurrently(func: Callable[[Any], Any], items: Iterable, max_workers: int = HTTP_MAX_WORKERS) -> list:
+    # Results come back in the order of `items` regardless of which request
+    # finishes first; the per-host rate limiters and concurrency controllers
+    # still apply to every call.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, items))
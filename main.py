@@ -1,13 +1,81 @@
 import prices.scryfall_prices_to_google_api
 import database.scryfall_to_google_api
 import database.mtg_to_google_api
+import http_client
+import google_api
+import profiling
+import logging
+import metrics
+import time
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
+from google.oauth2.credentials import Credentials
+from typing import Any, Callable, NamedTuple, Optional
+
+# The jobs write to different sheets and only share the cached card data, so
+# they can all run at the same time.
+MAIN_JOBS: dict[str, Callable[[Any], None]] = {
+    'mtg': database.mtg_to_google_api.sync_spreadsheet_with_mtg_data,
+    'scryfall': database.scryfall_to_google_api.sync_spreadsheet_with_scryfall_data,
+    'scryfall prices': prices.scryfall_prices_to_google_api.sync_spreadsheet_with_scryfall_price_data,
+}
+MAIN_MAX_WORKERS = len(MAIN_JOBS)
+
+logger = logging.getLogger(__name__)
+
+
+class JobResult(NamedTuple):
+    name: str
+    succeeded: bool
+    error: Optional[BaseException]
+    seconds: float
+
 
 def main():
-    database.mtg_to_google_api.main()
-    database.scryfall_to_google_api.main()
-    prices.scryfall_prices_to_google_api.main()
+    metrics.start_run()
+    profiling.start_profiling_if_requested()
+    results: list[JobResult] = run_jobs(MAIN_JOBS)
+    for result in results:
+        logger.log(logging.INFO if result.succeeded else logging.ERROR, format_job_result(result))
+    logger.info(http_client.format_retry_stats())
+    metrics.annotate("jobs", {result.name: dict(succeeded=result.succeeded, seconds=round(result.seconds, 6),
+                                                error=None if result.error is None else repr(result.error))
+                              for result in results})
+    return 0 if all(result.succeeded for result in results) else 1
+
+
+def run_jobs(jobs: dict[str, Callable[[Any], None]], max_workers: int = MAIN_MAX_WORKERS) -> list[JobResult]:
+    return run_jobs_on_sheet(jobs, obtain_shared_sheet(), max_workers)
+
+
+def obtain_shared_sheet() -> Any:
+    # Credentials and the Sheets service are created once and shared by all
+    # jobs instead of every job reading token.json and building its own client.
+    with metrics.stage("auth"):
+        creds: Credentials = google_api.obtain_google_api_credentials()
+        return google_api.obtain_google_api_service(creds, thread_safe=True)
+
+
+def run_jobs_on_sheet(
+        jobs: dict[str, Callable[[Any], None]], sheet: Any, max_workers: int = MAIN_MAX_WORKERS) -> list[JobResult]:
+    def __run_job(name: str) -> JobResult:
+        started_at: float = time.perf_counter()
+        try:
+            jobs[name](sheet)
+        except Exception as err:
+            # One failing job must not hide the outcome of the others.
+            logger.exception("Job '%s' failed", name)
+            return JobResult(name, False, err, time.perf_counter() - started_at)
+        return JobResult(name, True, None, time.perf_counter() - started_at)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(__run_job, jobs))
+
+
+def format_job_result(result: JobResult) -> str:
+    status: str = "succeeded" if result.succeeded else f"failed: {result.error!r}"
+    return f"Job '{result.name}' {status} ({result.seconds:.1f}s)"
 
 
 if __name__ == '__main__':
@@ -0,0 +1,163 @@
+import struct
+import mmap
+import json
+import sys
+import os
+
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+# File layout, all integers little-endian:
+# - Header: magic, record count, the offset, entry count and key width of
+#   both indexes and the version of the data the file was written from.
+# - Records: every card as a 4-byte length followed by its compact JSON.
+# - Index by id, then index by printing: fixed-width entries of a key padded
+#   with zero bytes and the offset of the card's record, sorted by key.
+# Opening a file only reads the header; a lookup is a binary search over the
+# mapped index that touches a few pages plus the page of the record itself.
+MAPPED_CARD_STORE_MAGIC = b'CARDMAP1'
+MAPPED_CARD_STORE_HEADER = struct.Struct('<8sIQIIQII64s')
+MAPPED_CARD_STORE_RECORD_LENGTH = struct.Struct('<I')
+MAPPED_CARD_STORE_OFFSET = struct.Struct('<Q')
+
+
+class IndexInfo(NamedTuple):
+    offset: int
+    count: int
+    key_width: int
+
+
+class MappedCardStore:
+    def __init__(self, path: Path):
+        with path.open(mode='rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, *index_fields, version = MAPPED_CARD_STORE_HEADER.unpack_from(self.mm, 0)
+        if magic != MAPPED_CARD_STORE_MAGIC:
+            self.mm.close()
+            raise ValueError(f"Not a mapped card store: {path}")
+        self.count: int = count
+        self.version: Optional[str] = version.rstrip(b'\0').decode() or None
+        self.id_index: IndexInfo = IndexInfo(*index_fields[:3])
+        self.printing_index: IndexInfo = IndexInfo(*index_fields[3:])
+
+    def __len__(self) -> int:
+        return self.count
+
+    def find_by_id(self, id_: str) -> Optional[dict]:
+        return self.find(self.id_index, id_)
+
+    def find_by_printing(self, set_code: str, collector_number: str, lang: str) -> Optional[dict]:
+        return self.find(self.printing_index, printing_key(set_code, collector_number, lang))
+
+    def find(self, index: IndexInfo, key: Optional[str]) -> Optional[dict]:
+        if key is None:
+            return None
+        key_width: int = index.key_width
+        encoded_key: bytes = key.encode()
+        if len(encoded_key) > key_width:
+            return None
+        encoded_key = encoded_key.ljust(key_width, b'\0')
+        entry_size: int = key_width + MAPPED_CARD_STORE_OFFSET.size
+        # Leftmost match, so that a key shared by several cards resolves to
+        # the one written first.
+        low: int = 0
+        high: int = index.count
+        while low < high:
+            middle: int = (low + high) // 2
+            entry_offset: int = index.offset + middle * entry_size
+            if self.mm[entry_offset:entry_offset + key_width] < encoded_key:
+                low = middle + 1
+            else:
+                high = middle
+        entry_offset: int = index.offset + low * entry_size
+        if low == index.count or self.mm[entry_offset:entry_offset + key_width] != encoded_key:
+            return None
+        return self.read_record(MAPPED_CARD_STORE_OFFSET.unpack_from(self.mm, entry_offset + key_width)[0])
+
+    def read_record(self, offset: int) -> dict:
+        length: int = MAPPED_CARD_STORE_RECORD_LENGTH.unpack_from(self.mm, offset)[0]
+        start: int = offset + MAPPED_CARD_STORE_RECORD_LENGTH.size
+        return json.loads(self.mm[start:start + length])
+
+    def iterate_cards(self) -> Iterator[dict]:
+        offset: int = MAPPED_CARD_STORE_HEADER.size
+        for _ in range(self.count):
+            length: int = MAPPED_CARD_STORE_RECORD_LENGTH.unpack_from(self.mm, offset)[0]
+            yield self.read_record(offset)
+            offset += MAPPED_CARD_STORE_RECORD_LENGTH.size + length
+
+    def close(self) -> None:
+        self.mm.close()
+
+
+def main():
+    store: MappedCardStore = MappedCardStore(Path(sys.argv[1]))
+    print(f"{len(store)} cards, version {store.version}")
+    store.close()
+
+
+def printing_key(set_code: Optional[str], collector_number: Optional[str], lang: Optional[str]) -> Optional[str]:
+    if not set_code or not collector_number or not lang:
+        return None
+    return f"{set_code.lower()}|{collector_number}|{lang.lower()}"
+
+
+def write_mapped_card_store(
+        path: Path, cards: Iterable[dict],
+        id_key: Callable[[dict], Optional[str]], card_printing_key: Callable[[dict], Optional[str]],
+        version: Optional[str] = None) -> int:
+    # Records are streamed to disk as they come; only the keys and offsets
+    # are kept in memory to sort the indexes. The file is written next to the
+    # target and renamed into place, so processes that have the previous file
+    # mapped keep reading it undisturbed.
+    part_path: Path = path.with_name(path.name + '.part')
+    id_entries: list[tuple[bytes, int]] = []
+    printing_entries: list[tuple[bytes, int]] = []
+    count: int = 0
+    with part_path.open(mode='wb') as fp:
+        fp.write(bytes(MAPPED_CARD_STORE_HEADER.size))
+        offset: int = MAPPED_CARD_STORE_HEADER.size
+        for card in cards:
+            data: bytes = json.dumps(card, separators=(',', ':'), ensure_ascii=False).encode()
+            fp.write(MAPPED_CARD_STORE_RECORD_LENGTH.pack(len(data)))
+            fp.write(data)
+            for entries, key in ((id_entries, id_key(card)), (printing_entries, card_printing_key(card))):
+                if key is not None:
+                    entries.append((key.encode(), offset))
+            offset += MAPPED_CARD_STORE_RECORD_LENGTH.size + len(data)
+            count += 1
+        id_index: IndexInfo = write_index(fp, offset, id_entries)
+        printing_index: IndexInfo = write_index(fp, fp.tell(), printing_entries)
+        fp.seek(0)
+        fp.write(MAPPED_CARD_STORE_HEADER.pack(
+            MAPPED_CARD_STORE_MAGIC, count, *id_index, *printing_index, (version or '').encode()))
+    os.replace(part_path, path)
+    return count
+
+
+def write_index(fp, offset: int, entries: list[tuple[bytes, int]]) -> IndexInfo:
+    # The sort is stable, so cards sharing a key stay in the order they were
+    # written in.
+    key_width: int = max((len(key) for key, _ in entries), default=1)
+    entries.sort(key=lambda entry: entry[0])
+    entry = struct.Struct(f'<{key_width}sQ')
+    for key, record_offset in entries:
+        fp.write(entry.pack(key, record_offset))
+    return IndexInfo(offset, len(entries), key_width)
+
+
+def read_mapped_card_store_version(path: Path) -> Optional[str]:
+    if not path.exists():
+        return None
+    with path.open(mode='rb') as fp:
+        header: bytes = fp.read(MAPPED_CARD_STORE_HEADER.size)
+    if len(header) < MAPPED_CARD_STORE_HEADER.size:
+        return None
+    magic, *_, version = MAPPED_CARD_STORE_HEADER.unpack(header)
+    if magic != MAPPED_CARD_STORE_MAGIC:
+        return None
+    return version.rstrip(b'\0').decode() or None
+
+
+if __name__ == "__main__":
+    sys.exit(main())
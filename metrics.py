@@ -0,0 +1,176 @@
+import contextlib
+import threading
+import datetime
+import logging
+import atexit
+import json
+import time
+import sys
+
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional
+
+# Every run appends one JSON line to this file when the process exits, so the
+# timings and counters of nightly runs can be compared over time.
+METRICS_REPORT_PATH = Path('run_reports.jsonl')
+
+METRICS_LOG_LEVEL = logging.INFO
+METRICS_LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+logger = logging.getLogger(__name__)
+
+
+class StageTiming:
+    # Aggregate of every time a stage ran: how often, for how long in total
+    # and the longest single run.
+    def __init__(self):
+        self.count: int = 0
+        self.seconds: float = 0.0
+        self.max_seconds: float = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self) -> dict:
+        return dict(count=self.count, seconds=round(self.seconds, 6), max_seconds=round(self.max_seconds, 6))
+
+
+class Stage:
+    # Times one run of a stage. Time spent in a nested piece of work that is
+    # reported as a stage of its own can be excluded from it.
+    def __init__(self, name: str):
+        self.name: str = name
+        self.started_at: float = time.perf_counter()
+        self.excluded_seconds: float = 0.0
+
+    def exclude(self, seconds: float) -> None:
+        self.excluded_seconds += seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at - self.excluded_seconds
+
+
+class TimedIterator:
+    # Wraps an iterator and adds up the time spent producing its items, e.g.
+    # reading cards from the cache while a consumer deduplicates them.
+    def __init__(self, iterable: Iterable):
+        self.iterator: Iterator = iter(iterable)
+        self.seconds: float = 0.0
+
+    def __iter__(self) -> 'TimedIterator':
+        return self
+
+    def __next__(self) -> Any:
+        started_at: float = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - started_at
+
+
+__lock = threading.Lock()
+__stages: dict[str, StageTiming] = {}
+__counters: dict[str, float] = {}
+__annotations: dict[str, Any] = {}
+__started_at: datetime.datetime = datetime.datetime.now(datetime.timezone.utc)
+__started_at_perf: float = time.perf_counter()
+__run_report_registered: bool = False
+
+
+def main():
+    count: int = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    for report in read_run_reports()[-count:]:
+        print(format_run_report(report))
+
+
+def start_run(report_path: Optional[Path] = METRICS_REPORT_PATH, level: int = METRICS_LOG_LEVEL) -> None:
+    # Called by the entry points: sets up leveled logging and registers the
+    # run report to be written when the process exits.
+    global __run_report_registered
+    logging.basicConfig(level=level, format=METRICS_LOG_FORMAT)
+    with __lock:
+        if report_path is not None and not __run_report_registered:
+            atexit.register(write_run_report, report_path)
+            __run_report_registered = True
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[Stage]:
+    timer: Stage = Stage(name)
+    try:
+        yield timer
+    finally:
+        seconds: float = timer.elapsed()
+        record_stage(name, seconds)
+        logger.debug("Stage %s took %.3fs", name, seconds)
+
+
+def record_stage(name: str, seconds: float) -> None:
+    with __lock:
+        if name not in __stages:
+            __stages[name] = StageTiming()
+        __stages[name].add(seconds)
+
+
+def increment(name: str, amount: float = 1) -> None:
+    with __lock:
+        __counters[name] = __counters.get(name, 0) + amount
+
+
+def annotate(name: str, value: Any) -> None:
+    # Adds a JSON-serializable value to the run report, such as job outcomes.
+    with __lock:
+        __annotations[name] = value
+
+
+def build_run_report() -> dict:
+    with __lock:
+        return dict(
+            started_at=__started_at.isoformat(),
+            seconds=round(time.perf_counter() - __started_at_perf, 6),
+            argv=sys.argv,
+            peak_memory_bytes=get_peak_memory_bytes(),
+            stages={name: timing.to_dict() for name, timing in sorted(__stages.items())},
+            counters=dict(sorted(__counters.items())),
+            **__annotations)
+
+
+def write_run_report(path: Path = METRICS_REPORT_PATH) -> dict:
+    report: dict = build_run_report()
+    with path.open(mode='a', encoding='utf-8') as fp:
+        fp.write(json.dumps(report, default=str) + '\n')
+    logger.info("Wrote run report to %s", path)
+    return report
+
+
+def read_run_reports(path: Path = METRICS_REPORT_PATH) -> list[dict]:
+    if not path.exists():
+        return []
+    with path.open(mode='r', encoding='utf-8') as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def format_run_report(report: dict) -> str:
+    lines: list[str] = [f"Run {report['started_at']} ({report['seconds']:.1f}s): {' '.join(report['argv'])}"]
+    for name, timing in report['stages'].items():
+        lines.append(f"  {name}: {timing['seconds']:.3f}s in {timing['count']} runs")
+    for name, value in report['counters'].items():
+        lines.append(f"  {name} = {value}")
+    return '\n'.join(lines)
+
+
+def get_peak_memory_bytes() -> Optional[int]:
+    # The resource module only exists on Unix, where ru_maxrss is in
+    # kilobytes except on macOS, which reports bytes.
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,40 +1,106 @@
+import card_store
+import cache_codec
 import itertools
-import requests
-import pickle
+import http_client
+import profiling
+import sqlite3
+import logging
+import metrics
+import datetime
+import shutil
+import json
+import math
 import sys
 
 from collections import OrderedDict
 from pathlib import Path
-from typing import Iterable
+from typing import Any, Iterable, Optional
+from requests import Response
 
 MTG_API_ENDPOINT_CARDS = 'https://api.magicthegathering.io/v1/cards'
 MTG_CARDS_PICKLE_PATH = Path('mtg_cards.db')
+# How the cached cards are written; see cache_codec.
+MTG_CARDS_CACHE_CODEC = cache_codec.CacheCodec('pickle')
+MTG_CARD_PAGES_CHECKPOINT_PATH = Path('mtg_card_pages')
+MTG_CARD_PAGES_CHECKPOINT_INFO_PATH = MTG_CARD_PAGES_CHECKPOINT_PATH / 'crawl.json'
+MTG_API_MAX_WORKERS = 4
+
+# Pages are 1-based in the MTG API documentation, but the crawl has always
+# started at page 0 (which the API serves like page 1), so keep doing that
+# to produce the same card list.
+MTG_API_FIRST_PAGE = 0
+
+logger = logging.getLogger(__name__)
 
 
 def main():
+    metrics.start_run()
+    profiling.start_profiling_if_requested()
     mtg_cards: list = load_all_mtg_cards()
-    print(f"Loaded {len(mtg_cards)} cards from MTG API")
+    logger.info("Loaded %d cards from MTG API", len(mtg_cards))
 
 
 def load_all_mtg_cards() -> list:
     mtg_cards: list
     if not MTG_CARDS_PICKLE_PATH.exists():
-        mtg_cards = list(get_all_mtg_cards_from_api())
+        metrics.increment("cache.mtg_cards.misses")
+        with metrics.stage("mtg.crawl"):
+            mtg_cards = list(get_all_mtg_cards_from_api())
         dump_all_mtg_cards_into_pickle(mtg_cards)
+        remove_mtg_card_page_checkpoints()
     else:
+        metrics.increment("cache.mtg_cards.hits")
         mtg_cards = load_all_mtg_cards_from_pickle()
     return mtg_cards
 
 
+def get_mtg_cards_version() -> Optional[str]:
+    # The cached cards are only ever written by a full crawl, so the time they
+    # were written tells the crawls apart.
+    if not MTG_CARDS_PICKLE_PATH.exists():
+        return None
+    return datetime.datetime.fromtimestamp(
+        MTG_CARDS_PICKLE_PATH.stat().st_mtime, datetime.timezone.utc).isoformat()
+
+
+def load_mtg_card_store(check_same_thread: bool = True) -> sqlite3.Connection:
+    # The store is rebuilt whenever the cards were crawled again after it was
+    # populated.
+    conn: sqlite3.Connection = card_store.connect_card_store(check_same_thread=check_same_thread)
+    table: str = card_store.CARD_STORE_TABLE_MTG
+    if not card_store.card_store_has_table(conn, table) \
+            or card_store.get_table_version(conn, table) != get_mtg_cards_version():
+        mtg_cards: list = load_all_mtg_cards()
+        count: int = card_store.populate_mtg_cards(conn, mtg_cards, get_mtg_cards_version())
+        logger.info("Populated card store with %d MTG API cards", count)
+    return conn
+
+
+def find_mtg_card(conn: sqlite3.Connection, set_id: str, number: str) -> Optional[dict]:
+    return card_store.find_card_by_printing(conn, card_store.CARD_STORE_TABLE_MTG, set_id, number, "en")
+
+
+def find_mtg_cards_by_name(conn: sqlite3.Connection, name: str) -> list[dict]:
+    return card_store.find_cards_by_name(conn, card_store.CARD_STORE_TABLE_MTG, name)
+
+
+def find_mtg_cards_by_multiverse_id(conn: sqlite3.Connection, multiverse_id: int) -> list[dict]:
+    return card_store.find_cards_by_multiverse_id(conn, card_store.CARD_STORE_TABLE_MTG, multiverse_id)
+
+
 def load_all_mtg_cards_from_pickle() -> list:
-    with MTG_CARDS_PICKLE_PATH.open(mode='br') as fp:
-        mtg_cards: list = list(pickle.load(fp))
+    mtg_cards: list = []
+    for item in cache_codec.load_records(MTG_CARDS_PICKLE_PATH):
+        if type(item) is list:
+            # Caches written as a single pickled list before codecs.
+            mtg_cards.extend(item)
+        else:
+            mtg_cards.append(item)
     return mtg_cards
 
 
-def dump_all_mtg_cards_into_pickle(mtg_cards: iter) -> None:
-    with MTG_CARDS_PICKLE_PATH.open(mode='bw') as fp:
-        pickle.dump(list(mtg_cards), fp)
+def dump_all_mtg_cards_into_pickle(mtg_cards: Iterable[dict]) -> None:
+    cache_codec.dump_records(MTG_CARDS_PICKLE_PATH, mtg_cards, MTG_CARDS_CACHE_CODEC)
 
 
 def get_all_mtg_cards_from_api() -> iter:
@@ -42,23 +108,100 @@ def get_all_mtg_cards_from_api() -> iter:
 
 
 def get_all_mtg_card_pages() -> Iterable[iter]:
-    page: int = 0  # 787 is roughly the last page
+    # The first response tells us how many pages there are, so the rest can be
+    # fetched concurrently. Every page is checkpointed to disk as soon as it
+    # arrives, so an interrupted crawl picks up where it stopped.
+    first_page_resp = get_mtg_cards_page_response(MTG_API_FIRST_PAGE)
+    first_page_resp.raise_for_status()
+    page_count: Optional[int] = get_page_count_from_headers(first_page_resp.headers)
+    prepare_mtg_card_page_checkpoints(first_page_resp.headers)
+    save_mtg_card_page_checkpoint(MTG_API_FIRST_PAGE, first_page_resp.json()["cards"])
+    if page_count is None:
+        yield from get_all_mtg_card_pages_sequentially()
+        return
+
+    last_page: int = page_count
+    pending_pages: list[int] = [page for page in range(MTG_API_FIRST_PAGE, last_page + 1)
+                                if not get_mtg_card_page_checkpoint_path(page).exists()]
+    logger.info("Crawling %d of %d MTG API pages", len(pending_pages), last_page - MTG_API_FIRST_PAGE + 1)
+    http_client.map_concurrently(fetch_mtg_card_page_into_checkpoint, pending_pages, MTG_API_MAX_WORKERS)
+    for page in range(MTG_API_FIRST_PAGE, last_page + 1):
+        yield load_mtg_card_page_checkpoint(page)
+
+
+def get_all_mtg_card_pages_sequentially() -> Iterable[iter]:
+    page: int = MTG_API_FIRST_PAGE  # 787 is roughly the last page
     while True:
-        mtg_cards_page_raw: dict = get_raw_mtg_cards_from_page(page)
-        if not mtg_cards_page_raw["cards"]:
+        if not get_mtg_card_page_checkpoint_path(page).exists():
+            fetch_mtg_card_page_into_checkpoint(page)
+        mtg_cards_page: list = load_mtg_card_page_checkpoint(page)
+        if not mtg_cards_page:
             break
         page += 1
-        mtg_cards_page: iter = mtg_cards_page_raw["cards"]
         yield mtg_cards_page
 
 
+def get_page_count_from_headers(headers: Any) -> Optional[int]:
+    total_count: Optional[str] = headers.get("Total-Count")
+    page_size: Optional[str] = headers.get("Page-Size")
+    if not total_count or not page_size:
+        return None
+    return math.ceil(int(total_count) / int(page_size))
+
+
+def prepare_mtg_card_page_checkpoints(headers: Any) -> None:
+    # Checkpoints from a crawl of a different card count or page size would
+    # not line up with this one, so they are discarded.
+    crawl_info: dict = {"total_count": headers.get("Total-Count"), "page_size": headers.get("Page-Size")}
+    if MTG_CARD_PAGES_CHECKPOINT_INFO_PATH.exists():
+        with MTG_CARD_PAGES_CHECKPOINT_INFO_PATH.open(mode='r') as fp:
+            if json.load(fp) != crawl_info:
+                logger.info("Discarding MTG API page checkpoints from a different crawl")
+                remove_mtg_card_page_checkpoints()
+    MTG_CARD_PAGES_CHECKPOINT_PATH.mkdir(exist_ok=True)
+    with MTG_CARD_PAGES_CHECKPOINT_INFO_PATH.open(mode='w') as fp:
+        json.dump(crawl_info, fp)
+
+
+def get_mtg_card_page_checkpoint_path(page: int) -> Path:
+    return MTG_CARD_PAGES_CHECKPOINT_PATH / f'page_{page:05}.json'
+
+
+def fetch_mtg_card_page_into_checkpoint(page: int) -> None:
+    save_mtg_card_page_checkpoint(page, get_raw_mtg_cards_from_page(page)["cards"])
+
+
+def save_mtg_card_page_checkpoint(page: int, mtg_cards_page: list) -> None:
+    # Write to a temporary file first so a crash never leaves a partial page
+    # that would be mistaken for a finished one.
+    path: Path = get_mtg_card_page_checkpoint_path(page)
+    tmp_path: Path = path.with_suffix('.tmp')
+    with tmp_path.open(mode='w') as fp:
+        json.dump(mtg_cards_page, fp)
+    tmp_path.replace(path)
+
+
+def load_mtg_card_page_checkpoint(page: int) -> list:
+    with get_mtg_card_page_checkpoint_path(page).open(mode='r') as fp:
+        return json.load(fp)
+
+
+def remove_mtg_card_page_checkpoints() -> None:
+    if MTG_CARD_PAGES_CHECKPOINT_PATH.exists():
+        shutil.rmtree(MTG_CARD_PAGES_CHECKPOINT_PATH)
+
+
 def get_raw_mtg_cards_from_page(page=0) -> dict:
+    resp = get_mtg_cards_page_response(page)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def get_mtg_cards_page_response(page=0) -> Response:
     url: str = MTG_API_ENDPOINT_CARDS
     params: dict = {"page": page}
     data: dict = {}
-    resp = requests.get(url, params=params, json=data)
-    print(resp.status_code, resp.url)
-    return resp.json()
+    return http_client.get(url, params=params, json=data)
 
 
 if __name__ == "__main__":
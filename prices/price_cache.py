@@ -0,0 +1,132 @@
+import threading
+import datetime
+import sqlite3
+import metrics
+import json
+import time
+import sys
+
+from card_info import CardInfo
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+PRICE_CACHE_PATH = Path('price_cache.sqlite')
+PRICE_CACHE_TTL = datetime.timedelta(hours=6)
+PRICE_CACHE_MAX_ENTRIES = 50_000
+
+# Eviction trims the table back to the size bound after this many writes
+# rather than on every write.
+PRICE_CACHE_EVICTION_INTERVAL = 1_000
+
+
+class LookupCache:
+    # Disk-backed memoization table with a time-to-live per entry and
+    # least-recently-used eviction once it grows past `max_entries`.
+    def __init__(self, path: Path = PRICE_CACHE_PATH,
+                 ttl: datetime.timedelta = PRICE_CACHE_TTL,
+                 max_entries: int = PRICE_CACHE_MAX_ENTRIES):
+        self.name: str = path.stem
+        self.ttl_seconds: float = ttl.total_seconds()
+        self.max_entries: int = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                          'key TEXT PRIMARY KEY, '
+                          'value TEXT NOT NULL, '
+                          'stored_at REAL NOT NULL, '
+                          'accessed_at REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_by_accessed_at ON entries (accessed_at)')
+        self.writes_since_eviction: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.expired: int = 0
+        self.evicted: int = 0
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        now: float = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT value, stored_at FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.expired += 1
+                metrics.increment(f"cache.{self.name}.expired")
+                row = None
+            if row is None:
+                self.misses += 1
+                metrics.increment(f"cache.{self.name}.misses")
+                return False, None
+            self.conn.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            metrics.increment(f"cache.{self.name}.hits")
+            return True, json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        now: float = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                              (key, json.dumps(value), now, now))
+            self.writes_since_eviction += 1
+            if self.writes_since_eviction >= PRICE_CACHE_EVICTION_INTERVAL:
+                self.evict()
+
+    def evict(self) -> None:
+        self.writes_since_eviction = 0
+        count: int = self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute('DELETE FROM entries WHERE key IN '
+                              '(SELECT key FROM entries ORDER BY accessed_at LIMIT ?)',
+                              (count - self.max_entries,))
+            self.evicted += count - self.max_entries
+
+    def close(self) -> None:
+        with self.lock:
+            self.evict()
+            self.conn.close()
+
+    def format_stats(self) -> str:
+        lookups: int = self.hits + self.misses
+        hit_rate: float = 100 * self.hits / lookups if lookups else 0.0
+        return (f"Price cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+                f"{self.expired} expired, {self.evicted} evicted")
+
+
+__price_cache: Optional[LookupCache] = None
+
+
+def main():
+    print(get_price_cache().format_stats())
+
+
+def get_price_cache() -> LookupCache:
+    global __price_cache
+    if __price_cache is None:
+        __price_cache = LookupCache()
+    return __price_cache
+
+
+def card_info_key(card_info: CardInfo, with_foil_type: bool = False) -> str:
+    # Rows are identified by printing; the card name is free text in the sheet
+    # and does not affect the lookup. Foil type only matters for prices.
+    key: str = f"{card_info.set_id.lower()}|{card_info.collector_number}|{card_info.language.lower()}"
+    if with_foil_type:
+        key += f"|{card_info.foil_type.name}"
+    return key
+
+
+def cached_by_card_info(namespace: str, with_foil_type: bool = False) -> Callable:
+    def __decorator(func: Callable[[CardInfo], Any]) -> Callable[[CardInfo], Any]:
+        def __cached(card_info: CardInfo) -> Any:
+            cache: LookupCache = get_price_cache()
+            key: str = f"{namespace}:{card_info_key(card_info, with_foil_type)}"
+            found, value = cache.get(key)
+            if not found:
+                value = func(card_info)
+                cache.put(key, value)
+            return value
+        __cached.__wrapped__ = func
+        return __cached
+    return __decorator
+
+
+if __name__ == "__main__":
+    sys.exit(main())
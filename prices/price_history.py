@@ -0,0 +1,283 @@
+import threading
+import argparse
+import datetime
+import logging
+import struct
+import bisect
+import array
+import zlib
+import sys
+
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+# File layout, all integers little-endian: the magic, then one segment per
+# recorded run, appended and never rewritten. A segment is a 4-byte length
+# followed by the zlib-compressed segment data:
+# - Header: the time of the run, the byte length and count of the card keys
+#   seen for the first time, and the number of changed printings.
+# - The new keys, separated by zero bytes; they are numbered in order of
+#   first appearance across all segments.
+# - Three columns of the changed printings: key number, USD and USD foil
+#   price. Only printings whose prices differ from the ones last recorded
+#   for them are written, so a run where nothing moved costs a few bytes.
+# Prices are kept in cents; PRICE_HISTORY_NO_PRICE stands for no price.
+PRICE_HISTORY_PATH = Path('price_history.bin')
+PRICE_HISTORY_MAGIC = b'PRICEHS1'
+PRICE_HISTORY_SEGMENT_LENGTH = struct.Struct('<I')
+PRICE_HISTORY_SEGMENT_HEADER = struct.Struct('<dIII')
+PRICE_HISTORY_COMPRESSION_LEVEL = 9
+PRICE_HISTORY_NO_PRICE = -1
+
+logger = logging.getLogger(__name__)
+
+
+class PriceChange(NamedTuple):
+    key: str
+    changed_at: datetime.datetime
+    old_usd: Optional[float]
+    new_usd: Optional[float]
+    old_usd_foil: Optional[float]
+    new_usd_foil: Optional[float]
+
+    def percent(self) -> Optional[float]:
+        # Largest relative move of the two prices; prices that appeared or
+        # disappeared have none.
+        percents: list[float] = [abs(new - old) / old * 100
+                                 for old, new in ((self.old_usd, self.new_usd), (self.old_usd_foil, self.new_usd_foil))
+                                 if old and new is not None]
+        return max(percents, default=None)
+
+
+class PriceSeries:
+    # The prices of one printing at every run where they changed.
+    def __init__(self):
+        self.runs = array.array('I')
+        self.usd = array.array('i')
+        self.usd_foil = array.array('i')
+
+    def append(self, run: int, usd: int, usd_foil: int) -> None:
+        self.runs.append(run)
+        self.usd.append(usd)
+        self.usd_foil.append(usd_foil)
+
+    def at(self, run: int) -> Optional[tuple[int, int]]:
+        idx: int = bisect.bisect_right(self.runs, run) - 1
+        if idx < 0:
+            return None
+        return self.usd[idx], self.usd_foil[idx]
+
+    def latest(self) -> tuple[int, int]:
+        return self.usd[-1], self.usd_foil[-1]
+
+
+class PriceHistory:
+    # Loaded from disk in full when opened; every recorded run appends one
+    # segment to the file and to the in-memory series.
+    def __init__(self, path: Path = PRICE_HISTORY_PATH):
+        self.path: Path = path
+        self.run_times = array.array('d')
+        self.keys: list[str] = []
+        self.key_numbers: dict[str, int] = {}
+        self.series: list[PriceSeries] = []
+        self.lock = threading.Lock()
+        if path.exists():
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def load(self) -> None:
+        data: bytes = self.path.read_bytes()
+        if not data.startswith(PRICE_HISTORY_MAGIC):
+            raise ValueError(f"Not a price history: {self.path}")
+        offset: int = len(PRICE_HISTORY_MAGIC)
+        while offset < len(data):
+            start: int = offset + PRICE_HISTORY_SEGMENT_LENGTH.size
+            length: int = PRICE_HISTORY_SEGMENT_LENGTH.unpack_from(data, offset)[0] if start <= len(data) else 0
+            if start + length > len(data):
+                # A run that was cut short while appending; it is overwritten
+                # by the next one.
+                logger.warning("Ignoring incomplete last run in %s", self.path)
+                with self.path.open(mode='r+b') as fp:
+                    fp.truncate(offset)
+                break
+            self.apply_segment(zlib.decompress(data[start:start + length]))
+            offset = start + length
+
+    def apply_segment(self, segment: bytes) -> None:
+        run_time, keys_length, new_key_count, change_count = PRICE_HISTORY_SEGMENT_HEADER.unpack_from(segment, 0)
+        offset: int = PRICE_HISTORY_SEGMENT_HEADER.size
+        if new_key_count:
+            for key in segment[offset:offset + keys_length].decode().split('\0'):
+                self.add_key(key)
+        offset += keys_length
+        columns: list[array.array] = []
+        for typecode in ('I', 'i', 'i'):
+            column: array.array = array_from_bytes(typecode, segment[offset:offset + change_count * 4])
+            columns.append(column)
+            offset += change_count * 4
+        run: int = len(self.run_times)
+        self.run_times.append(run_time)
+        for key_number, usd, usd_foil in zip(*columns):
+            self.series[key_number].append(run, usd, usd_foil)
+
+    def add_key(self, key: str) -> None:
+        self.key_numbers[key] = len(self.keys)
+        self.keys.append(key)
+        self.series.append(PriceSeries())
+
+    def record_run(self, prices: dict[str, tuple[Optional[str], Optional[str]]],
+                   recorded_at: Optional[datetime.datetime] = None) -> int:
+        # `prices` maps card keys (price_cache.card_info_key) to the USD and
+        # USD foil prices as Scryfall returns them. Printings that are not
+        # listed keep their last recorded prices. Returns the number of
+        # printings that are new or whose prices changed.
+        run_time: float = (recorded_at or datetime.datetime.now(datetime.timezone.utc)).timestamp()
+        with self.lock:
+            new_keys: list[str] = []
+            columns: tuple[array.array, array.array, array.array] = (
+                array.array('I'), array.array('i'), array.array('i'))
+            for key, (usd, usd_foil) in prices.items():
+                cents: tuple[int, int] = (parse_price_cents(usd), parse_price_cents(usd_foil))
+                key_number: Optional[int] = self.key_numbers.get(key)
+                if key_number is None:
+                    new_keys.append(key)
+                    key_number = len(self.keys) + len(new_keys) - 1
+                elif self.series[key_number].latest() == cents:
+                    continue
+                for column, value in zip(columns, (key_number, *cents)):
+                    column.append(value)
+            encoded_keys: bytes = '\0'.join(new_keys).encode()
+            segment: bytes = b''.join([
+                PRICE_HISTORY_SEGMENT_HEADER.pack(run_time, len(encoded_keys), len(new_keys), len(columns[0])),
+                encoded_keys, *map(array_to_bytes, columns)])
+            compressed: bytes = zlib.compress(segment, PRICE_HISTORY_COMPRESSION_LEVEL)
+            with self.path.open(mode='ab') as fp:
+                if fp.tell() == 0:
+                    fp.write(PRICE_HISTORY_MAGIC)
+                fp.write(PRICE_HISTORY_SEGMENT_LENGTH.pack(len(compressed)) + compressed)
+            self.apply_segment(segment)
+        return len(columns[0])
+
+    def changed_since(self, since: datetime.datetime) -> list[PriceChange]:
+        # Compares the prices as of the last run at or before `since` with
+        # the latest ones; printings first recorded after it have no old
+        # prices.
+        return self.changed_after_run(bisect.bisect_right(self.run_times, since.timestamp()) - 1)
+
+    def changed_since_previous_run(self) -> list[PriceChange]:
+        return self.changed_after_run(len(self.run_times) - 2)
+
+    def changed_by_percent(self, percent: float, since: Optional[datetime.datetime] = None) -> list[PriceChange]:
+        # Without `since`, compared with the previous run. Printings whose
+        # prices appeared or disappeared have no percentage and are left out.
+        changes: list[PriceChange] = self.changed_since_previous_run() if since is None \
+            else self.changed_since(since)
+        return [change for change in changes if (change.percent() or 0.0) > percent]
+
+    def changed_after_run(self, run: int) -> list[PriceChange]:
+        changes: list[PriceChange] = []
+        with self.lock:
+            for key, series in zip(self.keys, self.series):
+                # The series only holds changes, so a printing whose last
+                # change is not after `run` has not moved since.
+                if series.runs[-1] <= run:
+                    continue
+                old: Optional[tuple[int, int]] = series.at(run)
+                new: tuple[int, int] = series.latest()
+                if old == new:
+                    continue
+                old_usd, old_usd_foil = old or (PRICE_HISTORY_NO_PRICE, PRICE_HISTORY_NO_PRICE)
+                changes.append(PriceChange(
+                    key, to_datetime(self.run_times[series.runs[-1]]),
+                    format_price(old_usd), format_price(new[0]), format_price(old_usd_foil), format_price(new[1])))
+        return changes
+
+    def get_history(self, key: str) -> list[tuple[datetime.datetime, Optional[float], Optional[float]]]:
+        with self.lock:
+            key_number: Optional[int] = self.key_numbers.get(key)
+            if key_number is None:
+                return []
+            series: PriceSeries = self.series[key_number]
+            return [(to_datetime(self.run_times[run]), format_price(usd), format_price(usd_foil))
+                    for run, usd, usd_foil in zip(series.runs, series.usd, series.usd_foil)]
+
+
+__price_history: Optional[PriceHistory] = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the price changes recorded by the price job.")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat,
+                        help="compare with the prices at this time instead of the previous run")
+    parser.add_argument("--percent", type=float,
+                        help="only moves larger than this; leaves out new and no longer priced printings")
+    parser.add_argument("--key", help="print the recorded prices of one printing, e.g. 'ltr|225|en'")
+    args = parser.parse_args()
+    history: PriceHistory = get_price_history()
+    if args.key:
+        for recorded_at, usd, usd_foil in history.get_history(args.key):
+            print(f"{recorded_at.isoformat()}  {format_dollars(usd)}  {format_dollars(usd_foil)}")
+        return
+    changes: list[PriceChange]
+    if args.percent is not None:
+        changes = history.changed_by_percent(args.percent, args.since)
+    elif args.since is not None:
+        changes = history.changed_since(args.since)
+    else:
+        changes = history.changed_since_previous_run()
+    print(f"{len(history)} printings over {len(history.run_times)} runs, {len(changes)} changed")
+    for change in sorted(changes, key=lambda change: -(change.percent() or 0.0)):
+        print(format_price_change(change))
+
+
+def get_price_history() -> PriceHistory:
+    global __price_history
+    if __price_history is None:
+        __price_history = PriceHistory()
+    return __price_history
+
+
+def parse_price_cents(price: Union[str, float, None]) -> int:
+    if price is None or price == '':
+        return PRICE_HISTORY_NO_PRICE
+    return round(float(price) * 100)
+
+
+def format_price(cents: int) -> Optional[float]:
+    return None if cents == PRICE_HISTORY_NO_PRICE else cents / 100
+
+
+def format_dollars(price: Optional[float]) -> str:
+    return '-' if price is None else f"${price:.2f}"
+
+
+def format_price_change(change: PriceChange) -> str:
+    percent: Optional[float] = change.percent()
+    return f"{change.key}: {format_dollars(change.old_usd)} -> {format_dollars(change.new_usd)}, " \
+           f"foil {format_dollars(change.old_usd_foil)} -> {format_dollars(change.new_usd_foil)}" \
+           f"{'' if percent is None else f' ({percent:.1f}%)'} at {change.changed_at.isoformat()}"
+
+
+def to_datetime(run_time: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(run_time, datetime.timezone.utc)
+
+
+def array_to_bytes(column: array.array) -> bytes:
+    if sys.byteorder == 'big':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def array_from_bytes(typecode: str, data: bytes) -> array.array:
+    column: array.array = array.array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+if __name__ == "__main__":
+    sys.exit(main())
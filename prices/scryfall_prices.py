@@ -1,7 +1,12 @@
-import requests
+import mapped_card_store
+import http_client
+import logging
 import sys
 
 from card_info import CardInfo, FoilType
+from prices import price_cache
+from typing import Optional, Sequence
+from urllib.parse import quote
 
 # Format string to select a range as follows:
 # {0} - Set ID (LTR, etc.)
@@ -11,37 +16,112 @@ SCRYFALL_API_ENDPOINT_CARD_SEARCH = 'https://api.scryfall.com/cards/search?inclu
                                     'include_multilingual=true&include_variations=true&unique=prints&' \
                                     'q=e%3A{0}+cn%3A"{1}"+lang%3A{2}'
 
+# Format string to select a single printing as follows:
+# {0} - Set ID (LTR, etc.)
+# {1} - Collector Number (225, 235, etc.)
+# {2} - Language (EN, RU, etc.)
+SCRYFALL_API_ENDPOINT_CARD_BY_PRINTING = 'https://api.scryfall.com/cards/{0}/{1}/{2}'
+SCRYFALL_API_ENDPOINT_CARD_COLLECTION = 'https://api.scryfall.com/cards/collection'
+SCRYFALL_API_COLLECTION_MAX_IDENTIFIERS = 75
+SCRYFALL_API_DEFAULT_LANGUAGE = 'en'
+
+logger = logging.getLogger(__name__)
+
 
 def main():
     example_card_info: CardInfo = CardInfo("dummy name", "LTR", "225", "EN", FoilType.SURGE)
     print(find_price_for_card_info(example_card_info))
+    print(price_cache.get_price_cache().format_stats())
 
 
+@price_cache.cached_by_card_info("price", with_foil_type=True)
 def find_price_for_card_info(card_info: CardInfo):
     results = search_for_card(card_info)
     cards: list = get_cards_from_search_results(results)
     first_card: dict = cards[0]
-    prices: dict = get_prices_from_card(first_card)
-    price: str
-    if card_info.foil_type == FoilType.NONE:
-        price = prices["usd"]
-    else:
-        price = prices["usd_foil"]
-    return price
+    return get_price_for_foil_type(get_prices_from_card(first_card), card_info.foil_type)
 
 
+@price_cache.cached_by_card_info("search")
 def search_for_card(card_info: CardInfo) -> dict:
     url: str = SCRYFALL_API_ENDPOINT_CARD_SEARCH.format(
         card_info.set_id, card_info.collector_number, card_info.language)
     params: dict = {}
     data: dict = {}
-    resp = requests.get(url, params=params, json=data)
-    print(resp.status_code, resp.url)
+    resp = http_client.get(url, params=params, json=data)
+    resp.raise_for_status()
     return resp.json()
 
 
+def find_cards_for_all_card_info_batched(all_card_info: Sequence[Optional[CardInfo]]) -> list[Optional[dict]]:
+    # /cards/collection resolves up to 75 set + collector number identifiers
+    # per request but always answers with the default (English) printing, so
+    # only English rows are batched and other languages are fetched one
+    # printing at a time. Identical printings are only requested once.
+    cards: list[Optional[dict]] = [None] * len(all_card_info)
+    rows_by_printing: dict[tuple[str, str], list[int]] = {}
+    rows_by_localized_printing: dict[tuple[str, str, str], list[int]] = {}
+    for idx, card_info in enumerate(all_card_info):
+        if not card_info:
+            continue
+        set_id: str = card_info.set_id.lower()
+        language: str = card_info.language.lower()
+        if language == SCRYFALL_API_DEFAULT_LANGUAGE:
+            rows_by_printing.setdefault((set_id, card_info.collector_number), []).append(idx)
+        else:
+            rows_by_localized_printing.setdefault((set_id, card_info.collector_number, language), []).append(idx)
+
+    printings: list[tuple[str, str]] = list(rows_by_printing)
+    batches: list[list[tuple[str, str]]] = [printings[start:start + SCRYFALL_API_COLLECTION_MAX_IDENTIFIERS]
+                                            for start in range(0, len(printings),
+                                                               SCRYFALL_API_COLLECTION_MAX_IDENTIFIERS)]
+    for result in http_client.map_concurrently(get_card_collection, batches):
+        for card in result.get("data", []):
+            for idx in rows_by_printing.get((card["set"].lower(), card["collector_number"]), []):
+                cards[idx] = card
+        for identifier in result.get("not_found", []):
+            logger.warning("Scryfall could not find card: %s", identifier)
+
+    def __get_card_by_printing(printing: tuple[str, str, str]) -> Optional[dict]:
+        return get_card_by_printing(*printing)
+    localized_printings: list[tuple[str, str, str]] = list(rows_by_localized_printing)
+    localized_cards: list[Optional[dict]] = http_client.map_concurrently(__get_card_by_printing, localized_printings)
+    for printing, card in zip(localized_printings, localized_cards):
+        if card is None:
+            logger.warning("Scryfall could not find card: %s", printing)
+        for idx in rows_by_localized_printing[printing]:
+            cards[idx] = card
+    return cards
+
+
+def get_card_collection(printings: Sequence[tuple[str, str]]) -> dict:
+    url: str = SCRYFALL_API_ENDPOINT_CARD_COLLECTION
+    data: dict = {"identifiers": [{"set": set_id, "collector_number": collector_number}
+                                  for set_id, collector_number in printings]}
+    resp = http_client.post(url, json=data)
+    logger.debug("Requested %d identifiers from %s", len(printings), resp.url)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def get_card_by_printing(set_id: str, collector_number: str, language: str) -> Optional[dict]:
+    url: str = SCRYFALL_API_ENDPOINT_CARD_BY_PRINTING.format(
+        quote(set_id, safe=''), quote(collector_number, safe=''), quote(language, safe=''))
+    resp = http_client.get(url, endpoint=SCRYFALL_API_ENDPOINT_CARD_BY_PRINTING)
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.json()
+
+
+def find_card_in_card_store(store: mapped_card_store.MappedCardStore, card_info: CardInfo) -> Optional[dict]:
+    return store.find_by_printing(card_info.set_id, card_info.collector_number, card_info.language)
+
+
 def get_cards_from_search_results(results: dict) -> list:
-    print(results)
+    # Only the size of the results is logged; a search answers with every
+    # matching printing in full.
+    logger.debug("Search returned %d cards", len(results["data"]))
     return results["data"]
 
 
@@ -49,5 +129,11 @@ def get_prices_from_card(card: dict) -> dict:
     return card["prices"]
 
 
+def get_price_for_foil_type(prices: dict, foil_type: FoilType) -> Optional[str]:
+    if foil_type == FoilType.NONE:
+        return prices["usd"]
+    return prices["usd_foil"]
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,18 +1,22 @@
-import sheets_range
+import column_extractors
+import mapped_card_store
+import sheets_writer
+import sheets_sync
 import scryfall_api
+import http_client
 import google_api
-import datetime
-import pprint
+import profiling
+import logging
+import metrics
 import util
 import sys
 
 from google.oauth2.credentials import Credentials
 from googleapiclient.errors import HttpError
-from sheets_range import SheetsRange
 from collections import OrderedDict
 from card_info import CardInfo, FoilType
-from typing import Any, Optional
-from prices import scryfall_prices
+from typing import Any, Optional, Sequence
+from prices import scryfall_prices, price_cache, price_history
 
 # The ID of the target spreadsheet.
 GOOGLE_SPREADSHEET_ID = '12BXt6lJo7ianQ6jLRUhm4_LWBtvs7sOqH9fncMbAw8k'
@@ -21,129 +25,205 @@ GOOGLE_SPREADSHEET_SHEET_NAME = 'Collection'
 GOOGLE_SPREADSHEET_HEADER_COL_OFFSET = 0
 GOOGLE_SPREADSHEET_HEADER_COL_START = util.number_to_column_letter(GOOGLE_SPREADSHEET_HEADER_COL_OFFSET)
 
-GOOGLE_SPREADSHEET_RANGE_HEADER = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!{GOOGLE_SPREADSHEET_HEADER_COL_START}1:1'
-GOOGLE_SPREADSHEET_RANGE_CARD_INFO = f'{GOOGLE_SPREADSHEET_SHEET_NAME}' \
-                                     f'!{GOOGLE_SPREADSHEET_HEADER_COL_START}:E'
+GOOGLE_SPREADSHEET_RANGE_ALL = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!{GOOGLE_SPREADSHEET_HEADER_COL_START}:Z'
+GOOGLE_SPREADSHEET_CARD_INFO_COL_COUNT = 5
+GOOGLE_SPREADSHEET_CARD_INFO_COLUMNS = ("Card Name", "Collector Number", "Set", "Language", "Foil Type / Art Stamp")
 GOOGLE_SPREADSHEET_SELECT_COLUMN_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!' + '{0}2:{0}'
 
-# Format string to select a range as follows:
-# {0} - Column Start
-# {1} - Column End
-# {2} - Row Start
-# {3} - Row End
-GOOGLE_SPREADSHEET_SELECT_RANGE_DATA = f'{GOOGLE_SPREADSHEET_SHEET_NAME}!' + '{0}{2}:{1}{3}'
+# Resolve rows against the local Scryfall bulk data first and only search the
+# Scryfall API for rows that are not found there.
+SCRYFALL_PRICES_OFFLINE = True
+
+# Write only the prices and names that differ from what the sheet already
+# holds instead of clearing both columns and rewriting them.
+GOOGLE_SPREADSHEET_DIFF_SYNC = True
+
+# Append the USD and USD foil prices of every printing found to the local
+# price history (see prices.price_history), which answers which prices
+# changed since a given run without asking Scryfall again.
+SCRYFALL_PRICES_RECORD_HISTORY = True
+
+logger = logging.getLogger(__name__)
 
 
 def main():
+    metrics.start_run()
+    profiling.start_profiling_if_requested()
     update_spreadsheet_with_scryfall_price_data()
+    logger.info(http_client.format_retry_stats())
 
 
 def update_spreadsheet_with_scryfall_price_data() -> None:
-    creds: Credentials = google_api.obtain_google_api_credentials()
     try:
-        sheet = google_api.obtain_google_api_service(creds)
-        header: list[tuple[str, str]] = obtain_header_from_sheet(sheet)
+        with metrics.stage("auth"):
+            creds: Credentials = google_api.obtain_google_api_credentials()
+            sheet = google_api.obtain_google_api_service(creds)
+        sync_spreadsheet_with_scryfall_price_data(sheet)
+    except HttpError as err:
+        logger.error("Sheets request failed: %s", err)
+
+
+def sync_spreadsheet_with_scryfall_price_data(sheet: Any) -> None:
+    try:
+        writer = sheets_writer.SheetsWriter(sheet, GOOGLE_SPREADSHEET_ID)
+        # The collection is small enough to read in one request; the header,
+        # the card info columns and the current prices all come from it.
+        with metrics.stage("prices.header_fetch"):
+            all_values: list[list[Any]] = writer.batch_get([GOOGLE_SPREADSHEET_RANGE_ALL])[0]
+        header: list[tuple[str, str]] = obtain_header_from_sheet(all_values)
         price_column: str = get_column_from_header(header, "Prices")
         scryfall_name_column: str = get_column_from_header(header, "Scryfall Name")
-        print(clear_column_in_sheet(sheet, price_column))
-        print(clear_column_in_sheet(sheet, scryfall_name_column))
-        raw_card_info: list[list[str]] = obtain_raw_card_info_from_sheet(sheet)
+        price_col_idx: int = util.column_letter_to_number(price_column)
+        scryfall_name_col_idx: int = util.column_letter_to_number(scryfall_name_column)
+        if not GOOGLE_SPREADSHEET_DIFF_SYNC:
+            clear_column_in_sheet(writer, price_column)
+            clear_column_in_sheet(writer, scryfall_name_column)
+        raw_card_info: list[list[str]] = obtain_raw_card_info_from_sheet(all_values)
         all_card_info: list[Optional[CardInfo]] = process_raw_card_info(raw_card_info)
-        scryfall_cards: list[dict] = find_cards_for_all_card_info(all_card_info)
-
-        prices_and_names = []
-        for scryfall_card, card_info in zip(scryfall_cards, all_card_info):
-            price_and_name = ['', '']
-            if card_info and scryfall_card:
-                prices = scryfall_card["prices"]
-                price = prices["usd"]
-                if card_info.foil_type != FoilType.NONE:
-                    price = prices["usd_foil"]
-                if price:
-                    price = float(price)
-                price_and_name = [price, scryfall_card["name"]]
-            prices_and_names.append(price_and_name)
-
-        price_range: SheetsRange = SheetsRange(price_column, scryfall_name_column, 2, 100_000)
-        print(update_range_with_data(sheet, price_range, prices_and_names))
-    except HttpError as err:
-        print(err)
+        with metrics.stage("prices.lookup"):
+            scryfall_cards: list[dict] = find_cards_for_all_card_info(all_card_info)
+        profiling.snapshot("prices.lookup")
+        if SCRYFALL_PRICES_RECORD_HISTORY:
+            with metrics.stage("prices.history"):
+                record_price_history(all_card_info, scryfall_cards)
+
+        with metrics.stage("prices.build"):
+            prices_and_names = []
+            for scryfall_card, card_info in zip(scryfall_cards, all_card_info):
+                price_and_name = ['', '']
+                if card_info and scryfall_card:
+                    price = scryfall_prices.get_price_for_foil_type(
+                        scryfall_prices.get_prices_from_card(scryfall_card), card_info.foil_type)
+                    if price:
+                        price = float(price)
+                    price_and_name = [price, scryfall_card["name"]]
+                prices_and_names.append(price_and_name)
+
+            if GOOGLE_SPREADSHEET_DIFF_SYNC:
+                current_values: list[list[Any]] = [row[price_col_idx:scryfall_name_col_idx + 1]
+                                                   for row in all_values[1:]]
+                sheets_sync.sync_values(writer, GOOGLE_SPREADSHEET_SHEET_NAME,
+                                        price_col_idx, scryfall_name_col_idx, 2, current_values, prices_and_names)
+            else:
+                writer.update_rows(GOOGLE_SPREADSHEET_SHEET_NAME, price_col_idx, 2, prices_and_names)
+        profiling.snapshot("prices.build")
+        with metrics.stage("prices.upload"):
+            responses: list[Any] = writer.flush()
+        logger.debug("Sheets responses: %s", responses)
+        logger.info(writer.format_stats())
+    finally:
+        logger.info(price_cache.get_price_cache().format_stats())
 
 
-def find_cards_for_all_card_info(all_card_info: list[Optional[CardInfo]]) -> list[dict]:
+def record_price_history(all_card_info: list[Optional[CardInfo]], scryfall_cards: list[Optional[dict]]) -> None:
+    # Rows whose printing was not found are left out rather than recorded
+    # as unpriced, so they keep their last known prices.
+    prices: dict[str, tuple[Optional[str], Optional[str]]] = {}
+    for card_info, scryfall_card in zip(all_card_info, scryfall_cards):
+        if card_info and scryfall_card:
+            card_prices: dict = scryfall_prices.get_prices_from_card(scryfall_card)
+            prices[price_cache.card_info_key(card_info)] = (card_prices.get("usd"), card_prices.get("usd_foil"))
+    changed: int = price_history.get_price_history().record_run(prices)
+    metrics.increment("prices.history.changed", changed)
+    logger.info("Recorded the prices of %d printings, %d new or changed since the previous run", len(prices), changed)
+
+
+def find_cards_for_all_card_info(
+        all_card_info: list[Optional[CardInfo]], offline: bool = SCRYFALL_PRICES_OFFLINE) -> list[dict]:
+    # Collections often list the same printing on several rows (different
+    # foils, duplicates), so every distinct printing is looked up only once.
+    rows_by_key: dict[str, list[int]] = {}
+    unique_card_info: list[CardInfo] = []
+    for idx, card_info in enumerate(all_card_info):
+        if card_info:
+            key: str = price_cache.card_info_key(card_info)
+            if key not in rows_by_key:
+                rows_by_key[key] = []
+                unique_card_info.append(card_info)
+            rows_by_key[key].append(idx)
+    logger.info("Looking up %d distinct printings for %d rows", len(unique_card_info), len(all_card_info))
+
+    cards: list[Optional[dict]] = [None] * len(all_card_info)
+    for card_info, card in zip(unique_card_info, find_cards_for_unique_card_info(unique_card_info, offline)):
+        for idx in rows_by_key[price_cache.card_info_key(card_info)]:
+            cards[idx] = card
+    return cards
+
+
+def find_cards_for_unique_card_info(unique_card_info: list[CardInfo], offline: bool) -> list[Optional[dict]]:
+    cards: list[Optional[dict]] = [None] * len(unique_card_info)
+    if offline:
+        cards = find_cards_for_all_card_info_in_bulk_data(unique_card_info)
+    misses: list[int] = [idx for idx, card in enumerate(cards) if card is None]
+    hits: int = len(cards) - len(misses)
+
+    # Rows missing from the bulk data go through the persistent lookup cache
+    # before falling back to the Scryfall API.
+    cache: price_cache.LookupCache = price_cache.get_price_cache()
+    api_misses: list[int] = []
+    for idx in misses:
+        found, card = cache.get(f"card:{price_cache.card_info_key(unique_card_info[idx])}")
+        if found:
+            cards[idx] = card
+        else:
+            api_misses.append(idx)
+    if api_misses:
+        missed_cards: list[Optional[dict]] = scryfall_prices.find_cards_for_all_card_info_batched(
+            [unique_card_info[idx] for idx in api_misses])
+        for idx, card in zip(api_misses, missed_cards):
+            cards[idx] = card
+            cache.put(f"card:{price_cache.card_info_key(unique_card_info[idx])}", card)
+    logger.info("Resolved %d printings from bulk data, %d from the price cache, %d through the Scryfall API",
+                hits, len(misses) - len(api_misses), len(api_misses))
+    metrics.increment("prices.printings.bulk_data", hits)
+    metrics.increment("prices.printings.price_cache", len(misses) - len(api_misses))
+    metrics.increment("prices.printings.api", len(api_misses))
+    return cards
+
+
+def find_cards_for_all_card_info_in_bulk_data(
+        all_card_info: Sequence[Optional[CardInfo]]) -> list[Optional[dict]]:
+    # Opening the mapped store only reads its header; each lookup touches the
+    # index and record pages of that one card.
+    store: mapped_card_store.MappedCardStore = scryfall_api.load_scryfall_mapped_card_store()
     cards: list[Optional[dict]] = []
     for card_info in all_card_info:
         card: Optional[dict] = None
         if card_info:
-            try:
-                search_result = scryfall_prices.search_for_card(card_info)
-                print(search_result)
-                if search_result and search_result["total_cards"] > 0:
-                    card = search_result["data"][0]
-            except KeyError:
-                print(f"Failed to lookup the price of card: {card_info}")
-                pass
+            card = scryfall_prices.find_card_in_card_store(store, card_info)
         cards.append(card)
+    store.close()
     return cards
 
 
-def update_range_with_data(
-        sheet: Any, range_: SheetsRange, data: list[list[str]], major_dimension: str = "ROWS") -> Any:
-    column_range = GOOGLE_SPREADSHEET_SELECT_RANGE_DATA.format(
-        range_.col_start, range_.col_end, range_.row_start, range_.row_end)
-    result = sheet.values().update(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                   range=column_range,
-                                   valueInputOption='RAW',
-                                   body=dict(
-                                       majorDimension=major_dimension,
-                                       values=data
-                                   )).execute()
-    return result
-
-
-def obtain_header_from_sheet(sheet: Any) -> list[tuple[str, str]]:
-    result = sheet.values().get(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                range=GOOGLE_SPREADSHEET_RANGE_HEADER).execute()
-    header = result.get('values', [])[0]
-    return [(value, util.number_to_column_letter(col))
-            for col, value in
-            enumerate(header, start=GOOGLE_SPREADSHEET_HEADER_COL_OFFSET)]
+def obtain_header_from_sheet(all_values: list[list[Any]]) -> list[tuple[str, str]]:
+    return sheets_writer.columns_from_header(sheets_writer.first_row(all_values), GOOGLE_SPREADSHEET_HEADER_COL_OFFSET)
 
 
-def obtain_raw_card_info_from_sheet(sheet: Any) -> list[list[str]]:
-    result = sheet.values().get(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                range=GOOGLE_SPREADSHEET_RANGE_CARD_INFO).execute()
-    return result.get('values', [])
+def obtain_raw_card_info_from_sheet(all_values: list[list[Any]]) -> list[list[Any]]:
+    return [row[:GOOGLE_SPREADSHEET_CARD_INFO_COL_COUNT] for row in all_values]
 
 
-def process_raw_card_info(raw_card_info: list[list[str]]) -> list[Optional[CardInfo]]:
-    header = raw_card_info[0]
+def process_raw_card_info(raw_card_info: list[list[Any]]) -> list[Optional[CardInfo]]:
+    # The header is resolved to column positions once; every row is then
+    # decoded by position instead of comparing each cell's header name.
+    indexes: tuple[Optional[int], ...] = column_extractors.compile_column_indexes(
+        raw_card_info[0], GOOGLE_SPREADSHEET_CARD_INFO_COLUMNS)
     all_card_info: list[Optional[CardInfo]] = []
     for row in raw_card_info[1:]:
         card_info: Optional[CardInfo] = None
-        card_name: Optional[str] = None
-        collector_number: Optional[str] = None
-        set_id: Optional[str] = None
-        language: Optional[str] = None
+        # The sheet is read unformatted, so a numeric collector number comes
+        # back as a number; lookups and cache keys use Scryfall's strings.
+        card_name, collector_number, set_id, language, foil_type_str = [
+            None if value is None else str(value) for value in column_extractors.decode_row(row, indexes)]
         foil_type: Optional[FoilType] = None
-        for attr, value in zip(header, row):
-            if attr == "Card Name":
-                card_name = value
-            elif attr == "Collector Number":
-                collector_number = value
-            elif attr == "Set":
-                set_id = value
-            elif attr == "Language":
-                language = value
-            elif attr == "Foil Type / Art Stamp":
-                foil_type = get_foil_type_from_str(value)
-            else:
-                # Ignore this attribute
-                pass
+        if foil_type_str is not None:
+            foil_type = get_foil_type_from_str(foil_type_str)
         if card_name and collector_number and set_id and language and foil_type:
             card_info = CardInfo(card_name, set_id, collector_number, language, foil_type)
         all_card_info.append(card_info)
-        print(f"Card info: '{card_name}'\t'{collector_number}'\t'{set_id}'\t'{language}'\t'{foil_type}'\t'{card_info}'")
+        logger.debug("Card info: '%s'\t'%s'\t'%s'\t'%s'\t'%s'\t'%s'",
+                     card_name, collector_number, set_id, language, foil_type, card_info)
     return all_card_info
 
 
@@ -172,11 +252,8 @@ def get_column_from_header(header: list[tuple[str, str]], column_name: str) -> s
     return price_column
 
 
-def clear_column_in_sheet(sheet: Any, column: str) -> Any:
-    sheet_range: str = GOOGLE_SPREADSHEET_SELECT_COLUMN_DATA.format(column)
-    result = sheet.values().clear(spreadsheetId=GOOGLE_SPREADSHEET_ID,
-                                  range=sheet_range).execute()
-    return result
+def clear_column_in_sheet(writer: sheets_writer.SheetsWriter, column: str) -> None:
+    writer.clear(GOOGLE_SPREADSHEET_SELECT_COLUMN_DATA.format(column))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,287 @@
+import tracemalloc
+import threading
+import datetime
+import argparse
+import cProfile
+import logging
+import metrics
+import atexit
+import pstats
+import time
+import sys
+import io
+import os
+
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+from typing import Any, NamedTuple, Optional
+
+# `--profile` on the command line of an entry point turns on both profilers,
+# `--profile=cpu` or `--profile=memory` only one of them. Every profiled run
+# writes its files to a directory of its own under PROFILE_OUTPUT_PATH:
+# cpu.pstats (for pstats or snakeviz), cpu.collapsed (for flamegraph.pl or
+# speedscope), memory.tracemalloc (the snapshot of the stage boundary with the
+# most memory, for tracemalloc.Snapshot.load) and report.txt with the top
+# functions and allocation sites.
+PROFILE_ARGUMENT = '--profile'
+PROFILE_MODES = ('cpu', 'memory')
+PROFILE_OUTPUT_PATH = Path('profiles')
+PROFILE_TOP_N = 25
+
+# cProfile only knows callers and callees, not whole stacks, so the stacks of
+# every thread are also sampled for the collapsed-stack file.
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Frames kept per allocation: enough to see which function of the jobs an
+# allocation in json or pickle belongs to. Every allocation pays for every
+# frame; with 4 the scryfall job runs about 10 times slower, with 16 about 70.
+PROFILE_TRACEMALLOC_FRAMES = 4
+PROFILE_TRACEMALLOC_TRACEBACKS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class MemorySnapshot(NamedTuple):
+    # traced_bytes: memory allocated by Python at the stage boundary
+    # peak_traced_bytes: highest traced memory since the previous boundary
+    # peak_rss_bytes: peak resident memory of the process so far, which
+    # includes the short-lived memory of taking the previous snapshots
+    label: str
+    seconds: float
+    traced_bytes: int
+    peak_traced_bytes: int
+    peak_rss_bytes: Optional[int]
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.interval: float = interval
+        self.stacks: Counter = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            thread_names: dict[int, str] = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != self.ident:
+                    self.stacks[collapse_stack(thread_names.get(ident, str(ident)), frame)] += 1
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+    def write_collapsed(self, path: Path) -> None:
+        with path.open(mode='w', encoding='utf-8') as fp:
+            for stack, count in sorted(self.stacks.items()):
+                fp.write(f"{stack} {count}\n")
+
+
+class CpuProfiler:
+    # Before Python 3.12 a cProfile.Profile only sees the thread that enabled
+    # it, while the jobs run in worker threads; every thread started after
+    # start() gets a profiler of its own and their stats are merged in
+    # stop(). From 3.12 on one profiler sees every thread.
+    def __init__(self):
+        self.profiles: list[cProfile.Profile] = []
+        self.sampler: StackSampler = StackSampler()
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        # The sampler is started first so that it is not profiled itself.
+        self.sampler.start()
+        if sys.version_info < (3, 12):
+            threading.setprofile(self.profile_new_thread)
+        self.enable_for_current_thread()
+
+    def enable_for_current_thread(self) -> None:
+        profile: cProfile.Profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def profile_new_thread(self, frame: FrameType, event: str, arg: Any) -> None:
+        # The first profiling event of a new thread replaces this function
+        # by a profiler of that thread.
+        sys.setprofile(None)
+        self.enable_for_current_thread()
+
+    def stop(self) -> pstats.Stats:
+        threading.setprofile(None)
+        self.sampler.stop()
+        with self.lock:
+            profiles: list[cProfile.Profile] = list(self.profiles)
+        for profile in profiles:
+            profile.disable()
+        stats: pstats.Stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+class MemoryProfiler:
+    # Only the snapshot of the boundary with the most traced memory is kept,
+    # and on disk: a snapshot in memory would add to the resident memory of
+    # the later boundaries, and grouping the traces is much slower than
+    # taking them, so it is only done once for the report.
+    def __init__(self, snapshot_path: Path, top_n: int = PROFILE_TOP_N):
+        self.snapshot_path: Path = snapshot_path
+        self.top_n: int = top_n
+        self.started_at: float = 0.0
+        self.snapshots: list[MemorySnapshot] = []
+        self.largest: Optional[MemorySnapshot] = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        self.started_at = time.perf_counter()
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+
+    def take_snapshot(self, label: str) -> MemorySnapshot:
+        with self.lock:
+            traced_bytes, peak_traced_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            memory_snapshot: MemorySnapshot = MemorySnapshot(
+                label, time.perf_counter() - self.started_at, traced_bytes, peak_traced_bytes,
+                metrics.get_peak_memory_bytes())
+            self.snapshots.append(memory_snapshot)
+            if self.largest is None or traced_bytes > self.largest.traced_bytes:
+                tracemalloc.take_snapshot().dump(self.snapshot_path)
+                self.largest = memory_snapshot
+        logger.debug("Memory at %s: %.1f MB traced, %.1f MB peak", label, traced_bytes / 1e6,
+                     peak_traced_bytes / 1e6)
+        return memory_snapshot
+
+    def stop(self) -> None:
+        self.take_snapshot('end')
+        tracemalloc.stop()
+
+    def format_report(self) -> str:
+        lines: list[str] = ["Memory at stage boundaries (MB):",
+                            f"{'seconds':>9} {'traced':>9} {'peak':>9} {'peak RSS':>9}  stage"]
+        for snapshot in self.snapshots:
+            peak_rss: str = '-' if snapshot.peak_rss_bytes is None else f"{snapshot.peak_rss_bytes / 1e6:.1f}"
+            lines.append(f"{snapshot.seconds:9.2f} {snapshot.traced_bytes / 1e6:9.1f} "
+                         f"{snapshot.peak_traced_bytes / 1e6:9.1f} {peak_rss:>9}  {snapshot.label}")
+        if self.largest is not None:
+            snapshot: tracemalloc.Snapshot = tracemalloc.Snapshot.load(self.snapshot_path)
+            lines.append('')
+            lines.append(f"Top {self.top_n} allocation sites at '{self.largest.label}' "
+                         f"({self.largest.traced_bytes / 1e6:.1f} MB traced):")
+            for statistic in snapshot.statistics('lineno')[:self.top_n]:
+                frame: tracemalloc.Frame = statistic.traceback[0]
+                lines.append(f"{statistic.size / 1e6:9.1f} MB {statistic.count:9} blocks  "
+                             f"{frame.filename}:{frame.lineno}")
+            for statistic in snapshot.statistics('traceback')[:PROFILE_TRACEMALLOC_TRACEBACKS]:
+                lines.append('')
+                lines.append(f"{statistic.size / 1e6:.1f} MB in {statistic.count} blocks allocated from:")
+                lines.extend(statistic.traceback.format(most_recent_first=True))
+        return '\n'.join(lines)
+
+
+__cpu_profiler: Optional[CpuProfiler] = None
+__memory_profiler: Optional[MemoryProfiler] = None
+__output_path: Optional[Path] = None
+
+
+def main():
+    # Prints the top functions of a cpu.pstats file written by a profiled run.
+    stats: pstats.Stats = pstats.Stats(sys.argv[1])
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(int(sys.argv[2]) if len(sys.argv) > 2 else PROFILE_TOP_N)
+
+
+def start_profiling_if_requested(argv: Optional[list[str]] = None) -> Optional[Path]:
+    # Called by the entry points after metrics.start_run().
+    modes: tuple[str, ...] = parse_profile_modes(sys.argv[1:] if argv is None else argv)
+    return start_profiling(modes) if modes else None
+
+
+def parse_profile_modes(argv: list[str]) -> tuple[str, ...]:
+    modes: tuple[str, ...] = ()
+    for arg in argv:
+        if arg == PROFILE_ARGUMENT:
+            modes = PROFILE_MODES
+        elif arg.startswith(PROFILE_ARGUMENT + '='):
+            modes = tuple(arg.partition('=')[2].split(','))
+            for mode in modes:
+                if mode not in PROFILE_MODES:
+                    raise ValueError(f"Unknown profile mode: {mode}")
+    return modes
+
+
+def parse_profile_argument(value: str) -> tuple[str, ...]:
+    # argparse type of PROFILE_ARGUMENT for entry points that parse their
+    # command line themselves; they pass the modes to start_profiling().
+    try:
+        return parse_profile_modes([f"{PROFILE_ARGUMENT}={value}"])
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err)) from None
+
+
+def start_profiling(modes: tuple[str, ...] = PROFILE_MODES, output_path: Path = PROFILE_OUTPUT_PATH) -> Path:
+    global __cpu_profiler, __memory_profiler, __output_path
+    if __output_path is not None:
+        raise ValueError("Profiling has already been started")
+    __output_path = output_path / f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
+    __output_path.mkdir(parents=True)
+    if 'memory' in modes:
+        __memory_profiler = MemoryProfiler(__output_path / 'memory.tracemalloc')
+        __memory_profiler.start()
+    if 'cpu' in modes:
+        __cpu_profiler = CpuProfiler()
+        __cpu_profiler.start()
+    metrics.annotate("profile", str(__output_path))
+    atexit.register(stop_profiling)
+    logger.info("Profiling %s into %s", ' and '.join(modes), __output_path)
+    return __output_path
+
+
+def snapshot(label: str) -> None:
+    # Stage boundary of the jobs; does nothing unless memory is profiled.
+    if __memory_profiler is not None:
+        __memory_profiler.take_snapshot(label)
+
+
+def stop_profiling() -> Optional[Path]:
+    global __cpu_profiler, __memory_profiler, __output_path
+    if __output_path is None:
+        return None
+    output_path: Path = __output_path
+    sections: list[str] = []
+    if __cpu_profiler is not None:
+        stats: pstats.Stats = __cpu_profiler.stop()
+        stats.dump_stats(output_path / 'cpu.pstats')
+        __cpu_profiler.sampler.write_collapsed(output_path / 'cpu.collapsed')
+        sections.append(format_cpu_report(stats))
+    if __memory_profiler is not None:
+        __memory_profiler.stop()
+        sections.append(__memory_profiler.format_report())
+    with (output_path / 'report.txt').open(mode='w', encoding='utf-8') as fp:
+        fp.write('\n\n'.join(sections) + '\n')
+    __cpu_profiler, __memory_profiler, __output_path = None, None, None
+    logger.info("Wrote profile to %s", output_path)
+    return output_path
+
+
+def format_cpu_report(stats: pstats.Stats, top_n: int = PROFILE_TOP_N) -> str:
+    stream: io.StringIO = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top_n)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(top_n)
+    return stream.getvalue().strip('\n')
+
+
+def collapse_stack(thread_name: str, frame: Optional[FrameType]) -> str:
+    # One line of the collapsed-stack format, outermost frame first:
+    # thread;module:function;module:function
+    names: list[str] = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ';'.join(reversed(names)).replace(' ', '_')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,67 @@
+import mapped_card_store
+import cache_codec
 import itertools
-import requests
-import pickle
+import http_client
+import threading
+import profiling
+import datetime
+import hashlib
+import logging
+import metrics
 import json
 import util
 import sys
+import os
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence
 from requests import Response
 
 SCRYFALL_API_ENDPOINT_CARD_NAMES = 'https://api.scryfall.com/catalog/card-names'
 SCRYFALL_API_ENDPOINT_BULK_DATA = 'https://api.scryfall.com/bulk-data'
 SCRYFALL_ALL_CARDS_BULK_DATA_PATH = Path('scryfall-all-cards.json')
+SCRYFALL_ALL_CARDS_BULK_DATA_PART_PATH = Path('scryfall-all-cards.json.part')
+SCRYFALL_ALL_CARDS_BULK_DATA_PART_INFO_PATH = Path('scryfall-all-cards.json.part.json')
 SCRYFALL_ALL_CARDS_PICKLE_PATH = Path('scryfall_cards.db')
+SCRYFALL_ALL_CARDS_CACHE_INFO_PATH = Path('scryfall_cards.json')
+SCRYFALL_ALL_CARDS_MAPPED_STORE_PATH = Path('scryfall_cards.bin')
+
+# How the cached cards are written; see cache_codec. Existing caches are read
+# back with whatever codec they were written with.
+SCRYFALL_ALL_CARDS_CACHE_CODEC = cache_codec.CacheCodec('pickle')
+
+# Staleness policy for the cached cards:
+# - The bulk data listing is checked at most once per CHECK_INTERVAL; runs in
+#   between use the cache without making any request.
+# - When Scryfall has published newer bulk data, the cache is still used until
+#   it lags the published data by more than MAX_STALENESS.
+SCRYFALL_CACHE_CHECK_INTERVAL = datetime.timedelta(hours=1)
+SCRYFALL_CACHE_MAX_STALENESS = datetime.timedelta(0)
+
+SCRYFALL_BULK_DATA_CHUNK_SIZE = 1024 * 1024
+SCRYFALL_BULK_DATA_PROGRESS_STEP = 64 * 1024 * 1024
+SCRYFALL_BULK_DATA_SEPARATORS = frozenset('[],\r\n\t ')
 
 SCRYFALL_CARD_ATTR_NAME = "name"
 SCRYFALL_CARD_ATTR_IMAGE_URIS = "image_uris"
 
+# Jobs running in parallel share the cached cards; only the first one to get
+# here checks and refreshes them, the others wait and reuse the result.
+__refresh_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
 
 def main():
-    scryfall_cards: list = load_all_scryfall_cards()
-    example_card: dict = scryfall_cards[0]
-    print(f"Loaded {len(scryfall_cards)} cards from Scryfall API")
-    print(f"Link to image for '{example_card[SCRYFALL_CARD_ATTR_NAME]}': "
-          f"{find_normal_image_uri_in_card(example_card)}")
+    metrics.start_run()
+    profiling.start_profiling_if_requested()
+    store: mapped_card_store.MappedCardStore = load_scryfall_mapped_card_store()
+    scryfall_cards_count: int = len(store)
+    example_card: Optional[dict] = next(store.iterate_cards(), None)
+    logger.info("Loaded %d cards from Scryfall API", scryfall_cards_count)
+    logger.info("Link to image for '%s': %s",
+                example_card[SCRYFALL_CARD_ATTR_NAME], find_normal_image_uri_in_card(example_card))
 
 
 def find_normal_image_uri_in_card(card: dict):
@@ -36,34 +74,112 @@ def find_normal_image_uri_in_card(card: dict):
     return normal_image_uri
 
 
-def load_all_scryfall_cards() -> list:
-    scryfall_cards: list
-    if not SCRYFALL_ALL_CARDS_PICKLE_PATH.exists():
-        scryfall_cards = get_scryfall_cards_from_api()
-        dump_all_scryfall_cards_into_pickle(scryfall_cards)
-        util.try_remove_file(SCRYFALL_ALL_CARDS_BULK_DATA_PATH)
+def load_all_scryfall_cards() -> Iterator[dict]:
+    with __refresh_lock, metrics.stage("scryfall.refresh"):
+        refresh_scryfall_cards_if_needed()
+    return load_scryfall_cards_from_pickle()
+
+
+def refresh_scryfall_cards_if_needed() -> bool:
+    cache_info: dict = load_scryfall_cache_info()
+    now: datetime.datetime = datetime.datetime.now(datetime.timezone.utc)
+    bulk_data_info_item: Optional[dict] = None
+    if SCRYFALL_ALL_CARDS_PICKLE_PATH.exists():
+        checked_at: Optional[str] = cache_info.get("checked_at")
+        if checked_at and now - datetime.datetime.fromisoformat(checked_at) < SCRYFALL_CACHE_CHECK_INTERVAL:
+            return False
+        bulk_data_info_resp = get_bulk_data_info_response(cache_info.get("bulk_data_etag"))
+        cache_info["checked_at"] = now.isoformat()
+        if bulk_data_info_resp.status_code != 304:
+            bulk_data_info_resp.raise_for_status()
+            cache_info["bulk_data_etag"] = bulk_data_info_resp.headers.get("ETag")
+            bulk_data_info_item = find_bulk_all_card_data(bulk_data_info_resp.json())
+        if bulk_data_info_item is None or not is_scryfall_cache_stale(cache_info, bulk_data_info_item):
+            logger.info("Scryfall cards are up to date (bulk data from %s)", cache_info.get('updated_at'))
+            metrics.increment("cache.scryfall_cards.hits")
+            save_scryfall_cache_info(cache_info)
+            return False
     else:
-        scryfall_cards = load_scryfall_cards_from_pickle()
-    return scryfall_cards
+        bulk_data_info_item = find_bulk_all_card_data(get_bulk_data_info())
+    logger.info("Refreshing Scryfall cards with bulk data from %s", bulk_data_info_item['updated_at'])
+    metrics.increment("cache.scryfall_cards.misses")
+    with metrics.stage("scryfall.download"):
+        response = download_bulk_data(bulk_data_info_item)
+    with metrics.stage("scryfall.decode"):
+        dump_all_scryfall_cards_into_pickle(iterate_scryfall_cards_from_bulk_data())
+    util.try_remove_file(SCRYFALL_ALL_CARDS_BULK_DATA_PATH)
+    cache_info.update({
+        "checked_at": now.isoformat(),
+        "updated_at": bulk_data_info_item.get("updated_at"),
+        "size": bulk_data_info_item.get("size"),
+        "download_uri": bulk_data_info_item.get("download_uri"),
+        "etag": response.headers.get("ETag"),
+    })
+    save_scryfall_cache_info(cache_info)
+    return True
+
+
+def is_scryfall_cache_stale(cache_info: dict, bulk_data_info_item: dict) -> bool:
+    if (cache_info.get("updated_at") == bulk_data_info_item.get("updated_at")
+            and cache_info.get("size") == bulk_data_info_item.get("size")):
+        return False
+    if not cache_info.get("updated_at"):
+        return True
+    cached_updated_at = datetime.datetime.fromisoformat(cache_info["updated_at"])
+    published_updated_at = datetime.datetime.fromisoformat(bulk_data_info_item["updated_at"])
+    return published_updated_at - cached_updated_at > SCRYFALL_CACHE_MAX_STALENESS
+
 
+def load_scryfall_cache_info() -> dict:
+    cache_info: dict = {}
+    if SCRYFALL_ALL_CARDS_CACHE_INFO_PATH.exists():
+        with SCRYFALL_ALL_CARDS_CACHE_INFO_PATH.open(mode='r') as fp:
+            cache_info = json.load(fp)
+    return cache_info
 
-def dump_all_scryfall_cards_into_pickle(scryfall_cards: list) -> None:
-    with SCRYFALL_ALL_CARDS_PICKLE_PATH.open(mode='bw') as fp:
-        pickle.dump(scryfall_cards, fp)
 
+def save_scryfall_cache_info(cache_info: dict) -> None:
+    with SCRYFALL_ALL_CARDS_CACHE_INFO_PATH.open(mode='w') as fp:
+        json.dump(cache_info, fp, indent=2)
 
-def load_scryfall_cards_from_pickle() -> list:
-    with SCRYFALL_ALL_CARDS_PICKLE_PATH.open(mode='br') as fp:
-        scryfall_cards: list = list(pickle.load(fp))
-    return scryfall_cards
 
+def load_scryfall_mapped_card_store() -> mapped_card_store.MappedCardStore:
+    # The mapped store is rewritten whenever the cached cards come from newer
+    # bulk data than the ones it was written from.
+    cards: Iterator[dict] = load_all_scryfall_cards()
+    version: Optional[str] = load_scryfall_cache_info().get("updated_at")
+    path: Path = SCRYFALL_ALL_CARDS_MAPPED_STORE_PATH
+    with __refresh_lock:
+        if not path.exists() or mapped_card_store.read_mapped_card_store_version(path) != version:
+            with metrics.stage("scryfall.mapped_store"):
+                count: int = mapped_card_store.write_mapped_card_store(
+                    path, cards, get_scryfall_card_id, get_scryfall_card_printing_key, version)
+            logger.info("Wrote %d Scryfall cards to %s", count, path)
+            metrics.increment("cache.scryfall_mapped_store.misses")
+        else:
+            metrics.increment("cache.scryfall_mapped_store.hits")
+    return mapped_card_store.MappedCardStore(path)
 
-def get_scryfall_cards_from_api() -> list:
-    bulk_data_info: dict = get_bulk_data_info()
-    bulk_data_info_all_data: dict = find_bulk_all_card_data(bulk_data_info)
-    print(util.format_response(download_bulk_data(bulk_data_info_all_data)))
-    scryfall_cards: list = load_scryfall_cards_from_bulk_data()
-    return scryfall_cards
+
+def get_scryfall_card_id(card: dict) -> Optional[str]:
+    return card.get("id")
+
+
+def get_scryfall_card_printing_key(card: dict) -> Optional[str]:
+    return mapped_card_store.printing_key(card.get("set"), card.get("collector_number"), card.get("lang"))
+
+
+def dump_all_scryfall_cards_into_pickle(scryfall_cards: Iterable[dict]) -> None:
+    cache_codec.dump_records(SCRYFALL_ALL_CARDS_PICKLE_PATH, scryfall_cards, SCRYFALL_ALL_CARDS_CACHE_CODEC)
+
+
+def load_scryfall_cards_from_pickle() -> Iterator[dict]:
+    for item in cache_codec.load_records(SCRYFALL_ALL_CARDS_PICKLE_PATH):
+        if type(item) is list:
+            # Caches written before cards were pickled individually.
+            yield from item
+        else:
+            yield item
 
 
 def load_scryfall_cards_from_bulk_data() -> list:
@@ -72,13 +188,190 @@ def load_scryfall_cards_from_bulk_data() -> list:
     return all_cards_data
 
 
+def iterate_scryfall_cards_from_bulk_data() -> Iterator[dict]:
+    # The bulk file is one large JSON array. Decode it one card object at a
+    # time from a sliding text buffer instead of materializing the array.
+    decoder = json.JSONDecoder()
+    buffer: str = ''
+    pos: int = 0
+    with SCRYFALL_ALL_CARDS_BULK_DATA_PATH.open(mode='r', encoding='utf-8') as fp:
+        eof: bool = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in SCRYFALL_BULK_DATA_SEPARATORS:
+                pos += 1
+            if pos < len(buffer):
+                try:
+                    card, pos = decoder.raw_decode(buffer, pos)
+                    yield card
+                    continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            elif eof:
+                break
+            chunk: str = fp.read(SCRYFALL_BULK_DATA_CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+def load_scryfall_cards_from_bulk_data_parallel(
+        workers: Optional[int] = None,
+        attributes: Optional[Sequence[str]] = None,
+        predicate: Optional[Callable[[dict], bool]] = None) -> list:
+    # The bulk file stores one card object per line, so it can be cut into
+    # byte ranges on line boundaries and each range parsed in its own process.
+    # Projection and filtering happen inside the workers so that only the
+    # requested data is sent back to the parent process.
+    workers = workers or os.cpu_count() or 1
+    path: Path = SCRYFALL_ALL_CARDS_BULK_DATA_PATH
+    shards: list[tuple[int, int]] = split_file_on_line_boundaries(path, workers)
+    if not shards:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        shard_results = executor.map(
+            parse_bulk_data_shard,
+            itertools.repeat(path), *zip(*shards),
+            itertools.repeat(attributes), itertools.repeat(predicate))
+        return list(itertools.chain.from_iterable(shard_results))
+
+
+def split_file_on_line_boundaries(path: Path, shard_count: int) -> list[tuple[int, int]]:
+    file_size: int = path.stat().st_size
+    boundaries: list[int] = [0]
+    with path.open(mode='br') as fp:
+        for shard in range(1, shard_count):
+            fp.seek(max(file_size * shard // shard_count, boundaries[-1]))
+            fp.readline()
+            boundaries.append(min(fp.tell(), file_size))
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def parse_bulk_data_shard(
+        path: Path, start: int, end: int,
+        attributes: Optional[Sequence[str]] = None,
+        predicate: Optional[Callable[[dict], bool]] = None) -> list:
+    with path.open(mode='br') as fp:
+        fp.seek(start)
+        data: bytes = fp.read(end - start)
+    # Turn the shard into a JSON array of its own so it can be decoded with a
+    # single call, which is much faster than decoding line by line.
+    data = data.strip().lstrip(b'[').rstrip(b']').strip().strip(b',')
+    cards: list = json.loads(b'[' + data + b']')
+    if predicate is not None:
+        cards = [card for card in cards if predicate(card)]
+    if attributes is not None:
+        cards = [{attr: card[attr] for attr in attributes if attr in card} for card in cards]
+    return cards
+
+
 def download_bulk_data(bulk_data_info_item: dict) -> Optional[Response]:
-    with SCRYFALL_ALL_CARDS_BULK_DATA_PATH.open(mode='bw') as fp:
-        response = requests.get(bulk_data_info_item["download_uri"])
-        fp.write(response.content)
+    url: str = bulk_data_info_item["download_uri"]
+    expected_size: Optional[int] = bulk_data_info_item.get("size")
+    part_path: Path = SCRYFALL_ALL_CARDS_BULK_DATA_PART_PATH
+    sha256 = hashlib.sha256()
+    bytes_done: int = 0
+    # Resume an interrupted transfer by hashing what is already on disk and
+    # only requesting the remaining bytes. A part is only resumed when it was
+    # downloaded from the same URI, and only with the ETag it was downloaded
+    # with as If-Range, so that a file the server has since replaced is sent
+    # in full instead of being appended to the old one.
+    part_info: dict = load_bulk_data_part_info()
+    if part_path.exists() and (part_info.get("download_uri") != url or not part_info.get("etag")):
+        logger.info("Discarding partial download of other bulk data: %s", part_info.get("download_uri"))
+        remove_bulk_data_part()
+    if part_path.exists():
+        bytes_done = hash_file_into(part_path, sha256)
+    # Ask for the identity encoding so that byte ranges and sizes refer to the
+    # file as stored on disk rather than to a compressed transfer.
+    headers: dict = {"Accept-Encoding": "identity"}
+    if bytes_done:
+        headers["Range"] = f"bytes={bytes_done}-"
+        headers["If-Range"] = part_info["etag"]
+    with http_client.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 416 and bytes_done != expected_size:
+            # The part does not fit the file being served; it is thrown away
+            # below and the download starts over.
+            logger.warning("Server rejected resuming at %d bytes, restarting the download", bytes_done)
+        elif response.status_code == 416:
+            pass  # The previous attempt finished downloading but was not renamed.
+        else:
+            response.raise_for_status()
+            mode: str = 'ba'
+            if response.status_code != 206:
+                # The server ignored the range or the file changed, so start
+                # over from scratch.
+                mode = 'bw'
+                bytes_done = 0
+                sha256 = hashlib.sha256()
+                save_bulk_data_part_info(dict(download_uri=url, etag=response.headers.get("ETag")))
+            with part_path.open(mode=mode) as fp:
+                next_progress: int = bytes_done + SCRYFALL_BULK_DATA_PROGRESS_STEP
+                for chunk in response.iter_content(chunk_size=SCRYFALL_BULK_DATA_CHUNK_SIZE):
+                    fp.write(chunk)
+                    sha256.update(chunk)
+                    bytes_done += len(chunk)
+                    if bytes_done >= next_progress:
+                        logger.info(format_download_progress(bytes_done, expected_size))
+                        next_progress += SCRYFALL_BULK_DATA_PROGRESS_STEP
+        logger.info(format_download_progress(bytes_done, expected_size))
+    if response.status_code == 416 and bytes_done != expected_size:
+        remove_bulk_data_part()
+        return download_bulk_data(bulk_data_info_item)
+    verify_bulk_data_download(part_path, bulk_data_info_item, sha256.hexdigest())
+    part_path.replace(SCRYFALL_ALL_CARDS_BULK_DATA_PATH)
+    SCRYFALL_ALL_CARDS_BULK_DATA_PART_INFO_PATH.unlink(missing_ok=True)
     return response
 
 
+def load_bulk_data_part_info() -> dict:
+    # Where the partial bulk data download came from: its download_uri and
+    # the ETag the server sent with it.
+    part_info: dict = {}
+    if SCRYFALL_ALL_CARDS_BULK_DATA_PART_INFO_PATH.exists():
+        with SCRYFALL_ALL_CARDS_BULK_DATA_PART_INFO_PATH.open(mode='r') as fp:
+            part_info = json.load(fp)
+    return part_info
+
+
+def save_bulk_data_part_info(part_info: dict) -> None:
+    with SCRYFALL_ALL_CARDS_BULK_DATA_PART_INFO_PATH.open(mode='w') as fp:
+        json.dump(part_info, fp, indent=2)
+
+
+def remove_bulk_data_part() -> None:
+    SCRYFALL_ALL_CARDS_BULK_DATA_PART_PATH.unlink(missing_ok=True)
+    SCRYFALL_ALL_CARDS_BULK_DATA_PART_INFO_PATH.unlink(missing_ok=True)
+
+
+def hash_file_into(path: Path, hash_: Any) -> int:
+    size: int = 0
+    with path.open(mode='br') as fp:
+        for chunk in iter(lambda: fp.read(SCRYFALL_BULK_DATA_CHUNK_SIZE), b''):
+            hash_.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def format_download_progress(bytes_done: int, expected_size: Optional[int]) -> str:
+    progress: str = f"Downloaded {bytes_done / 2 ** 20:.1f} MiB"
+    if expected_size:
+        progress += f" of {expected_size / 2 ** 20:.1f} MiB ({100 * bytes_done / expected_size:.1f}%)"
+    return progress
+
+
+def verify_bulk_data_download(path: Path, bulk_data_info_item: dict, sha256: str) -> None:
+    # The bulk data metadata only publishes the size of the file, so that is
+    # what we can verify; the digest is reported so runs can be compared.
+    expected_size: Optional[int] = bulk_data_info_item.get("size")
+    actual_size: int = path.stat().st_size
+    if expected_size is not None and actual_size != expected_size:
+        util.try_remove_file(path)
+        raise ValueError(f"Bulk data download is {actual_size} bytes, expected {expected_size}")
+    logger.info("Verified bulk data download: %d bytes, sha256 %s", actual_size, sha256)
+
+
 def find_bulk_all_card_data(bulk_data_info: dict) -> Optional[dict]:
     bulk_data_info_all_data: Optional[dict] = None
     target_type_name = "all_cards"
@@ -90,12 +383,16 @@ def find_bulk_all_card_data(bulk_data_info: dict) -> Optional[dict]:
 
 
 def get_bulk_data_info() -> dict:
+    return get_bulk_data_info_response().json()
+
+
+def get_bulk_data_info_response(etag: Optional[str] = None) -> Response:
+    # With the ETag of a previous listing the server can answer 304 Not
+    # Modified, which costs almost nothing.
     url: str = SCRYFALL_API_ENDPOINT_BULK_DATA
     params: dict = {}
-    data: dict = {}
-    resp = requests.get(url, params=params, json=data)
-    print(resp.status_code, resp.url)
-    return resp.json()
+    headers: dict = {"If-None-Match": etag} if etag else {}
+    return http_client.get(url, params=params, headers=headers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+import logging
+import util
+
+from sheets_writer import SheetsWriter
+from typing import Any, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SyncResult(NamedTuple):
+    data: list[dict]
+    cells_written: int
+    cells_skipped: int
+
+
+def sync_values(
+        writer: SheetsWriter, sheet_name: str, col_start: int, col_end: int, row_start: int,
+        current: list[list[Any]], desired: list[list[Any]]) -> SyncResult:
+    # Only the cells that differ from what the sheet holds now (as read by the
+    # caller, starting at col_start/row_start) are queued on the writer,
+    # instead of clearing and rewriting everything.
+    width: int = col_end - col_start + 1
+    result: SyncResult = compute_changed_ranges(sheet_name, col_start, row_start, current, desired, width)
+    writer.update_value_ranges(result.data)
+    logger.info(format_sync_result(result))
+    return result
+
+
+def compute_changed_ranges(
+        sheet_name: str, col_start: int, row_start: int,
+        current: list[list[Any]], desired: list[list[Any]], width: Optional[int] = None) -> SyncResult:
+    if width is None:
+        width = max((len(row) for row in desired), default=0)
+    data: list[dict] = []
+    cells_written: int = 0
+    cells_skipped: int = 0
+    # Blocks of changed cells keyed by their column span; a block grows
+    # downwards for as long as consecutive rows change the same span.
+    open_blocks: dict[tuple[int, int], tuple[int, list[list[Any]]]] = {}
+    row_count: int = max(len(current), len(desired))
+    for row_idx in range(row_count + 1):
+        runs: dict[tuple[int, int], list[Any]] = {}
+        if row_idx < row_count:
+            current_row: list[Any] = current[row_idx] if row_idx < len(current) else []
+            desired_row: list[Any] = desired[row_idx] if row_idx < len(desired) else []
+            run_start: Optional[int] = None
+            for col_idx in range(width + 1):
+                changed: bool = False
+                if col_idx < width:
+                    current_value: Any = normalize_cell(current_row[col_idx] if col_idx < len(current_row) else None)
+                    desired_value: Any = normalize_cell(desired_row[col_idx] if col_idx < len(desired_row) else None)
+                    changed = current_value != desired_value
+                    if changed:
+                        cells_written += 1
+                    else:
+                        cells_skipped += 1
+                if changed and run_start is None:
+                    run_start = col_idx
+                elif not changed and run_start is not None:
+                    runs[(run_start, col_idx - 1)] = [
+                        normalize_cell(desired_row[col] if col < len(desired_row) else None)
+                        for col in range(run_start, col_idx)]
+                    run_start = None
+        for span in list(open_blocks):
+            if span not in runs:
+                block_row_start, values = open_blocks.pop(span)
+                data.append(format_value_range(sheet_name, col_start, row_start, span, block_row_start, values))
+        for span, values in runs.items():
+            if span in open_blocks:
+                open_blocks[span][1].append(values)
+            else:
+                open_blocks[span] = (row_idx, [values])
+    return SyncResult(data, cells_written, cells_skipped)
+
+
+def format_value_range(
+        sheet_name: str, col_start: int, row_start: int,
+        span: tuple[int, int], block_row_start: int, values: list[list[Any]]) -> dict:
+    first_col: str = util.number_to_column_letter(col_start + span[0])
+    last_col: str = util.number_to_column_letter(col_start + span[1])
+    first_row: int = row_start + block_row_start
+    last_row: int = first_row + len(values) - 1
+    return dict(range=f'{sheet_name}!{first_col}{first_row}:{last_col}{last_row}',
+                majorDimension='ROWS',
+                values=values)
+
+
+def normalize_cell(value: Any) -> Any:
+    # Sheets omits trailing empty cells and the built data uses None for
+    # missing attributes; both mean an empty cell.
+    return '' if value is None else value
+
+
+def format_sync_result(result: SyncResult) -> str:
+    return f"Wrote {result.cells_written} changed cells in {len(result.data)} ranges, " \
+           f"skipped {result.cells_skipped} unchanged cells"
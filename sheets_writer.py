@@ -0,0 +1,257 @@
+import http_client
+import itertools
+import threading
+import profiling
+import datetime
+import metrics
+import logging
+import queue
+import json
+import time
+import util
+
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from typing import Any, Iterable, Iterator, NamedTuple, Optional
+
+# Google recommends keeping Sheets request payloads under 2 MB; the cell bound
+# keeps very narrow rows from producing huge requests that time out.
+SHEETS_MAX_REQUEST_BYTES = 2_000_000
+SHEETS_MAX_REQUEST_CELLS = 500_000
+
+# Sending several batchUpdate requests at once requires a service object that
+# is safe to share between threads, i.e. one obtained with
+# google_api.obtain_google_api_service(creds, thread_safe=True).
+SHEETS_MAX_WORKERS = 1
+
+# Number of built row pieces that may wait for the uploader thread.
+SHEETS_UPLOAD_QUEUE_DEPTH = 2
+
+# Sheets requests are retried like the other API clients; see http_client.
+SHEETS_RETRY_POLICY = http_client.HTTP_RETRY_POLICY
+SHEETS_ENDPOINT = 'sheets.googleapis.com/v4/spreadsheets/values:{0}'
+
+logger = logging.getLogger(__name__)
+
+
+class PendingValueRange(NamedTuple):
+    value_range: dict
+    size_bytes: int
+    cells: int
+
+
+class SheetsWriter:
+    # Collects the clears and value updates of a job and sends them with as few
+    # requests as the Sheets limits allow: one batchClear for every clear and
+    # batchUpdate requests packed up to SHEETS_MAX_REQUEST_BYTES and
+    # SHEETS_MAX_REQUEST_CELLS.
+    def __init__(self, sheet: Any, spreadsheet_id: str,
+                 max_request_bytes: int = SHEETS_MAX_REQUEST_BYTES,
+                 max_request_cells: int = SHEETS_MAX_REQUEST_CELLS,
+                 max_workers: int = SHEETS_MAX_WORKERS):
+        self.sheet: Any = sheet
+        self.spreadsheet_id: str = spreadsheet_id
+        self.max_request_bytes: int = max_request_bytes
+        self.max_request_cells: int = max_request_cells
+        self.max_workers: int = max_workers
+        self.pending_clears: list[str] = []
+        self.pending_value_ranges: list[PendingValueRange] = []
+        self.requests_sent: int = 0
+        self.cells_sent: int = 0
+        self.stats_lock = threading.Lock()
+
+    def batch_get(self, ranges: list[str], value_render_option: str = 'UNFORMATTED_VALUE') -> list[list[list[Any]]]:
+        with metrics.stage("sheets.batchGet"):
+            result = execute_with_retries(self.sheet.values().batchGet(spreadsheetId=self.spreadsheet_id,
+                                                                       ranges=ranges,
+                                                                       valueRenderOption=value_render_option),
+                                          'batchGet')
+        self.requests_sent += 1
+        metrics.increment("sheets.requests")
+        return [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+
+    def clear(self, range_: str) -> None:
+        self.pending_clears.append(range_)
+
+    def update(self, range_: str, values: list[list[Any]], major_dimension: str = 'ROWS') -> None:
+        self.update_value_ranges([dict(range=range_, majorDimension=major_dimension, values=values)])
+
+    def update_value_ranges(self, value_ranges: Iterable[dict]) -> None:
+        for value_range in value_ranges:
+            self.pending_value_ranges.append(PendingValueRange(
+                value_range,
+                len(json.dumps(value_range['values'], ensure_ascii=False)),
+                sum(len(values) for values in value_range['values'])))
+
+    def update_rows(self, sheet_name: str, col_start: int, row_start: int, rows: list[list[Any]]) -> None:
+        # Large row sets are cut into pieces that each fit in one request, so
+        # the chunk size follows the data rather than a fixed row count.
+        self.pending_value_ranges.extend(split_rows_into_value_ranges(
+            sheet_name, col_start, row_start, rows, self.max_request_bytes, self.max_request_cells))
+
+    def flush(self) -> list[Any]:
+        results: list[Any] = []
+        if self.pending_clears:
+            with metrics.stage("sheets.batchClear"):
+                results.append(execute_with_retries(self.sheet.values().batchClear(
+                    spreadsheetId=self.spreadsheet_id, body=dict(ranges=self.pending_clears)), 'batchClear'))
+            self.requests_sent += 1
+            metrics.increment("sheets.requests")
+        bodies: list[dict] = list(self.pack_value_ranges(self.pending_value_ranges))
+        self.pending_clears = []
+        self.pending_value_ranges = []
+        if self.max_workers > 1 and len(bodies) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results.extend(executor.map(self.send_batch_update, bodies))
+        else:
+            results.extend(map(self.send_batch_update, bodies))
+        return results
+
+    def stream_rows(self, sheet_name: str, col_start: int, row_start: int, rows: Iterable[list[Any]],
+                    queue_depth: int = SHEETS_UPLOAD_QUEUE_DEPTH) -> int:
+        # Producer/consumer upload: this thread pulls rows from `rows` and cuts
+        # them into request-sized pieces while an uploader thread sends the
+        # previous pieces, so building rows and waiting on the network overlap.
+        # At most `queue_depth` pieces are waiting at any time, which bounds
+        # memory. Anything queued before is flushed first to keep its order.
+        self.flush()
+        pieces: queue.Queue = queue.Queue(maxsize=queue_depth)
+        errors: list[BaseException] = []
+
+        def __upload() -> None:
+            while (piece := pieces.get()) is not None:
+                if not errors:
+                    try:
+                        self.send_batch_update(dict(valueInputOption='RAW', data=[piece.value_range]))
+                    except BaseException as err:
+                        errors.append(err)
+
+        uploader = threading.Thread(target=__upload, name='sheets-uploader', daemon=True)
+        uploader.start()
+        piece_count: int = 0
+        try:
+            for piece in split_rows_into_value_ranges(
+                    sheet_name, col_start, row_start, rows, self.max_request_bytes, self.max_request_cells):
+                if errors:
+                    break
+                pieces.put(piece)
+                piece_count += 1
+        finally:
+            pieces.put(None)
+            uploader.join()
+        if errors:
+            raise errors[0]
+        return piece_count
+
+    def pack_value_ranges(self, pending_value_ranges: list[PendingValueRange]) -> Iterator[dict]:
+        data: list[dict] = []
+        size_bytes: int = 0
+        cells: int = 0
+        for pending in pending_value_ranges:
+            if data and (size_bytes + pending.size_bytes > self.max_request_bytes
+                         or cells + pending.cells > self.max_request_cells):
+                yield dict(valueInputOption='RAW', data=data)
+                data, size_bytes, cells = [], 0, 0
+            data.append(pending.value_range)
+            size_bytes += pending.size_bytes
+            cells += pending.cells
+        if data:
+            yield dict(valueInputOption='RAW', data=data)
+
+    def send_batch_update(self, body: dict) -> Any:
+        profiling.snapshot("sheets.upload_chunk")
+        with metrics.stage("sheets.batchUpdate"):
+            result = execute_with_retries(
+                self.sheet.values().batchUpdate(spreadsheetId=self.spreadsheet_id, body=body), 'batchUpdate')
+        with self.stats_lock:
+            self.requests_sent += 1
+            self.cells_sent += result.get('totalUpdatedCells', 0)
+        metrics.increment("sheets.requests")
+        metrics.increment("sheets.cells_updated", result.get('totalUpdatedCells', 0))
+        return result
+
+    def format_stats(self) -> str:
+        return f"Sheets writer: {self.requests_sent} requests, {self.cells_sent} cells updated"
+
+
+def execute_with_retries(request: Any, method: str, policy: http_client.RetryPolicy = SHEETS_RETRY_POLICY) -> Any:
+    # Same policy as http_client.request: throttled and failed responses and
+    # transport errors are retried with backoff, honoring Retry-After, and
+    # counted per endpoint. Value updates are idempotent, so re-sending one
+    # whose response was lost is safe.
+    endpoint: str = SHEETS_ENDPOINT.format(method)
+    for attempt in itertools.count():
+        retry_after: Optional[float] = None
+        try:
+            result: Any = request.execute()
+        except HttpError as err:
+            status: int = err.resp.status
+            http_client.record_endpoint_stats(
+                endpoint, requests_=1, throttled=int(status in http_client.HTTP_THROTTLE_STATUSES))
+            if status not in http_client.HTTP_RETRY_STATUSES:
+                raise
+            if attempt >= policy.max_retries:
+                http_client.record_endpoint_stats(endpoint, failures=1)
+                raise
+            retry_after = http_client.parse_retry_after(err.resp.get('retry-after'))
+            reason: str = str(status)
+        except OSError as err:
+            http_client.record_endpoint_stats(endpoint, requests_=1)
+            if attempt >= policy.max_retries:
+                http_client.record_endpoint_stats(endpoint, failures=1)
+                raise
+            reason: str = type(err).__name__
+        else:
+            http_client.record_endpoint_stats(endpoint, requests_=1)
+            return result
+        delay: float = policy.get_delay(attempt, retry_after)
+        http_client.record_endpoint_stats(endpoint, retries=1)
+        logger.warning("Sheets %s failed with %s, retry %d of %d in %.1fs",
+                       method, reason, attempt + 1, policy.max_retries, delay)
+        time.sleep(delay)
+
+
+def split_rows_into_value_ranges(
+        sheet_name: str, col_start: int, row_start: int, rows: Iterable[list[Any]],
+        max_bytes: int = SHEETS_MAX_REQUEST_BYTES,
+        max_cells: int = SHEETS_MAX_REQUEST_CELLS) -> Iterator[PendingValueRange]:
+    # Consumes the rows lazily, so a generator of rows is only ever held one
+    # piece at a time.
+    piece: list[list[Any]] = []
+    piece_row_start: int = row_start
+    size_bytes: int = 0
+    cells: int = 0
+    for row in rows:
+        row_bytes: int = len(json.dumps(row, ensure_ascii=False)) + 1
+        if piece and (size_bytes + row_bytes > max_bytes or cells + len(row) > max_cells):
+            yield make_rows_value_range(sheet_name, col_start, piece_row_start, piece, size_bytes)
+            piece_row_start += len(piece)
+            piece, size_bytes, cells = [], 0, 0
+        piece.append(row)
+        size_bytes += row_bytes
+        cells += len(row)
+    if piece:
+        yield make_rows_value_range(sheet_name, col_start, piece_row_start, piece, size_bytes)
+
+
+def make_rows_value_range(
+        sheet_name: str, col_start: int, row_start: int, rows: list[list[Any]], size_bytes: int) -> PendingValueRange:
+    width: int = max(len(row) for row in rows)
+    range_: str = f'{sheet_name}!{util.number_to_column_letter(col_start)}{row_start}:' \
+                  f'{util.number_to_column_letter(col_start + width - 1)}{row_start + len(rows) - 1}'
+    return PendingValueRange(dict(range=range_, majorDimension='ROWS', values=rows),
+                             size_bytes, len(rows) * width)
+
+
+def columns_from_header(header: list[Any], col_offset: int) -> list[tuple[str, str]]:
+    return [(value, util.number_to_column_letter(col))
+            for col, value in
+            enumerate(header, start=col_offset)]
+
+
+def first_row(values: list[list[Any]]) -> list[Any]:
+    return values[0] if values else []
+
+
+def refresh_timestamp_values(now: Optional[datetime.datetime] = None) -> list[list[str]]:
+    return [[str(now or datetime.datetime.now())]]
@@ -1,11 +1,19 @@
+import logging
+
 from requests import Response
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 
 def number_to_column_letter(num: int) -> str:
     return chr(num + 65)
 
 
+def column_letter_to_number(column: str) -> int:
+    return ord(column) - 65
+
+
 def format_response(response: Response) -> tuple:
     return response.status_code, response.url
 
@@ -16,5 +24,5 @@ def try_remove_file(path: Path) -> bool:
         path.unlink()
         did_remove = True
     except PermissionError as err:
-        print(err)
+        logger.warning("Could not remove %s: %s", path, err)
     return did_remove